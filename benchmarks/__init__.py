@@ -0,0 +1,4 @@
+"""
+Performance benchmarks for the calibration service.
+Run from the repository root with PYTHONPATH=./src.
+"""
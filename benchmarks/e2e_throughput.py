@@ -0,0 +1,367 @@
+"""
+End-to-end throughput benchmark.
+
+Drives N concurrent synthetic sessions through Listener -> ClientManager ->
+BatchHandler -> UtraceCalculator on the in-memory broker, and reports
+batches/s, per-batch latency, RSS per session and time-to-report.
+
+    PYTHONPATH=./src python -m benchmarks.e2e_throughput --sessions 16 --batches 30
+
+A batch's latency runs from the moment its second half (inputs or
+predictions) was published until BatchHandler forwarded the joined batch to
+MLflow, i.e. after UtraceCalculator processed and persisted it.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+from src.database.db import Database
+from src.database.migrations import migrate
+from src.lib.config import (
+    CONNECTION_EXCHANGE,
+    INPUTS_QUEUE_NAME,
+    MLFLOW_EXCHANGE,
+    MLFLOW_ROUTING_KEY,
+    OUTPUTS_QUEUE_NAME,
+    UNCERTAINTY_LIMIT,
+    GlobalConfig,
+)
+from src.lib.db_engine import get_engine
+from src.middleware.connection_manager import SessionMiddleware
+from src.middleware.memory_broker import InMemoryBroker, InMemoryMiddleware, in_memory_connection_manager
+from src.proto import mlflow_probs_pb2
+from src.server.listener import Listener
+from src.server.utrace_calculator import UtraceCalculator
+from tests.mocks.fake_connections_service import FakeConnectionsService
+from tests.mocks.in_memory_database import InMemoryDatabase
+from utrace.uncertaintyQuantifier import UncertaintyQuantifier
+from benchmarks.stand_ins import RecordingReportBuilder
+from benchmarks.synthetic import SessionSpec, SyntheticSession
+
+COLLECTOR_QUEUE_NAME = "benchmark_mlflow_queue"
+# Sessions need every calibration stage to produce a report
+MIN_BATCHES = UNCERTAINTY_LIMIT + 2
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentiles(values, scale=1.0) -> dict:
+    if not values:
+        return {"p50": None, "p99": None, "max": None}
+    data = np.asarray(values) * scale
+    return {
+        "p50": round(float(np.percentile(data, 50)), 3),
+        "p99": round(float(np.percentile(data, 99)), 3),
+        "max": round(float(data.max()), 3),
+    }
+
+
+class RssSampler:
+    """Samples the process RSS in the background and keeps the peak."""
+
+    def __init__(self, interval_seconds=0.1):
+        self.interval_seconds = interval_seconds
+        self.baseline = current_rss_bytes()
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_bytes())
+
+
+class E2EBenchmark:
+    def __init__(
+        self,
+        spec: SessionSpec,
+        sessions: int = 8,
+        arrival_rate: float = 0.0,
+        batch_rate: float = 0.0,
+        database_url: str = None,
+        timeout_seconds: float = 300.0,
+        seed: int = 0,
+        logger=None,
+    ):
+        """
+        Args:
+            spec: Traffic of each session (batches, batch size, classes, image shape)
+            sessions: Number of concurrent sessions
+            arrival_rate: Mean new sessions per second (Poisson); 0 starts them all at once
+            batch_rate: Mean batches per second of each session (Poisson); 0 publishes them back to back
+            database_url: PostgreSQL URL to benchmark against; the in-memory stand-in when omitted
+        """
+        if spec.batches < MIN_BATCHES:
+            raise ValueError(f"Sessions need at least {MIN_BATCHES} batches to reach the report")
+        self.spec = spec
+        self.sessions = [SyntheticSession(spec, seed=seed + i) for i in range(sessions)]
+        self.arrival_rate = arrival_rate
+        self.batch_rate = batch_rate
+        self.database_url = database_url
+        self.timeout_seconds = timeout_seconds
+        self.logger = logger or logging.getLogger("e2e-benchmark")
+        self._rng = np.random.default_rng(seed)
+
+        self.broker = InMemoryBroker()
+        self.report_builders = {}
+        self.arrived_at = {}
+        self.ready_at = {}  # (user_id, batch_index) -> time both halves were published
+        self.done_at = {}
+        self._done = threading.Condition()
+
+    def _config(self) -> GlobalConfig:
+        config = GlobalConfig()
+        config.environment = "PRODUCTION"  # EOF builds and "sends" the report
+        config.server_config.session_engine = "thread"
+        config.server_config.upper_bound_clients = max(config.server_config.upper_bound_clients, len(self.sessions))
+        config.server_config.client_timeout_seconds = int(self.timeout_seconds) + 60
+        config.middleware_config.transport = "memory"
+        config.middleware_config.lag_report_interval_seconds = 0
+        if self.database_url:
+            config.database_url = self.database_url
+        return config
+
+    def _database_factory(self):
+        if self.database_url:
+            engine = get_engine(self.database_url)
+            migrate(engine)
+            return lambda: Database(engine)
+        database = InMemoryDatabase()
+        return lambda: database
+
+    def _utrace_calculator_factory(self, database=None, session_id=None):
+        calculator = UtraceCalculator(database=database, session_id=session_id)
+        if self.spec.num_classes != len(calculator.uq.classes):
+            calculator.uq = UncertaintyQuantifier(classes=np.arange(self.spec.num_classes))
+        return calculator
+
+    def _report_builder_factory(self, user_id: str):
+        builder = RecordingReportBuilder(user_id)
+        self.report_builders[user_id] = builder
+        return builder
+
+    def _on_mlflow_message(self, ch, method, properties, body):
+        message = mlflow_probs_pb2.MlflowProbs()
+        message.ParseFromString(body)
+        with self._done:
+            self.done_at[(message.client_id, message.batch_index)] = time.perf_counter()
+            self._done.notify_all()
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _start_collector(self):
+        connection = self.broker.connect()
+        channel = connection.channel()
+        channel.exchange_declare(exchange=MLFLOW_EXCHANGE, exchange_type="direct")
+        channel.queue_declare(queue=COLLECTOR_QUEUE_NAME)
+        channel.queue_bind(queue=COLLECTOR_QUEUE_NAME, exchange=MLFLOW_EXCHANGE, routing_key=MLFLOW_ROUTING_KEY)
+        channel.basic_qos(prefetch_count=256)
+        channel.basic_consume(queue=COLLECTOR_QUEUE_NAME, on_message_callback=self._on_mlflow_message)
+        thread = threading.Thread(target=channel.start_consuming, name="mlflow-collector", daemon=True)
+        thread.start()
+        return connection, channel, thread
+
+    def _schedule(self):
+        """Publish events of every session as (time offset, sequence, session, batch index or None)."""
+        events = []
+        sequence = 0
+        arrival = 0.0
+        for session in self.sessions:
+            if self.arrival_rate > 0:
+                arrival += self._rng.exponential(1 / self.arrival_rate)
+            events.append((arrival, sequence, session, None))
+            sequence += 1
+            at = arrival
+            for batch_index in range(self.spec.batches):
+                if self.batch_rate > 0:
+                    at += self._rng.exponential(1 / self.batch_rate)
+                events.append((at, sequence, session, batch_index))
+                sequence += 1
+        heapq.heapify(events)
+        return events
+
+    def _drive(self, events, messages):
+        channel = self.broker.connect().channel()
+        start = time.perf_counter()
+        while events:
+            at, _, session, batch_index = heapq.heappop(events)
+            delay = start + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if batch_index is None:
+                # The users service declares the session queues before announcing it
+                channel.queue_declare(queue=f"{session.user_id}_{INPUTS_QUEUE_NAME}", durable=True)
+                channel.queue_declare(queue=f"{session.user_id}_{OUTPUTS_QUEUE_NAME}", durable=True)
+                self.arrived_at[session.user_id] = time.perf_counter()
+                channel.basic_publish(exchange=CONNECTION_EXCHANGE, routing_key="", body=session.notification())
+                continue
+            inputs, predictions = messages[(session.user_id, batch_index)]
+            channel.basic_publish(exchange="", routing_key=f"{session.user_id}_{INPUTS_QUEUE_NAME}", body=inputs)
+            channel.basic_publish(exchange="", routing_key=f"{session.user_id}_{OUTPUTS_QUEUE_NAME}", body=predictions)
+            self.ready_at[(session.user_id, batch_index)] = time.perf_counter()
+
+    def _wait_for_completion(self, deadline) -> bool:
+        expected = len(self.sessions) * self.spec.batches
+        with self._done:
+            while len(self.done_at) < expected:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                self._done.wait(timeout=min(remaining, 0.5))
+        while any(b.sent_at is None for b in self.report_builders.values()) or len(self.report_builders) < len(self.sessions):
+            if time.perf_counter() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def run(self) -> dict:
+        status_service = FakeConnectionsService().start()
+        os.environ["CONNECTIONS_SERVICE_URL"] = status_service.url
+        config = self._config()
+
+        # Messages are generated up front so the driver never throttles the pipeline
+        messages = {
+            (session.user_id, batch_index): session.batch(batch_index)
+            for session in self.sessions
+            for batch_index in range(self.spec.batches)
+        }
+        events = self._schedule()
+
+        listener_middleware = InMemoryMiddleware(config.middleware_config, self.broker)
+        listener_channel = listener_middleware.create_channel(prefetch_count=config.server_config.upper_bound_clients)
+        listener_middleware.setup_connection_queue(listener_channel, durable=True)
+        connection_manager = in_memory_connection_manager(config.middleware_config, self.broker)
+        collector_connection, collector_channel, collector_thread = self._start_collector()
+
+        listener = Listener(
+            middleware=listener_middleware,
+            channel=listener_channel,
+            config=config,
+            cm_middleware_factory=lambda c: SessionMiddleware(config=c, connection_manager=connection_manager),
+            report_builder_factory=self._report_builder_factory,
+            utrace_calculator_factory=self._utrace_calculator_factory,
+            database_factory=self._database_factory(),
+        )
+        rss = RssSampler()
+        rss.start()
+        listener_thread = threading.Thread(target=listener.start, name="listener", daemon=True)
+        listener_thread.start()
+
+        started = time.perf_counter()
+        self._drive(events, messages)
+        completed = self._wait_for_completion(started + self.timeout_seconds)
+        elapsed = time.perf_counter() - started
+        rss.stop()
+
+        listener.handle_sigterm()
+        listener_thread.join(timeout=10)
+        collector_connection.add_callback_threadsafe(collector_channel.stop_consuming)
+        collector_thread.join(timeout=5)
+        connection_manager.close()
+        status_service.stop()
+
+        if not completed:
+            self.logger.warning(f"Benchmark timed out after {self.timeout_seconds}s")
+        return self._results(elapsed, rss)
+
+    def _results(self, elapsed, rss: RssSampler) -> dict:
+        latencies = [
+            self.done_at[key] - self.ready_at[key] for key in self.done_at if key in self.ready_at
+        ]
+        times_to_report = [
+            builder.sent_at - self.arrived_at[user_id]
+            for user_id, builder in self.report_builders.items()
+            if builder.sent_at is not None and user_id in self.arrived_at
+        ]
+        sessions = len(self.sessions)
+        return {
+            "sessions": sessions,
+            "batches_per_session": self.spec.batches,
+            "batch_size": self.spec.batch_size,
+            "num_classes": self.spec.num_classes,
+            "image_shape": list(self.spec.image_shape),
+            "arrival_rate": self.arrival_rate,
+            "batch_rate": self.batch_rate,
+            "database": "postgresql" if self.database_url else "in-memory",
+            "completed_sessions": len(times_to_report),
+            "batches_processed": len(self.done_at),
+            "elapsed_seconds": round(elapsed, 3),
+            "batches_per_second": round(len(self.done_at) / elapsed, 2) if elapsed > 0 else None,
+            "batch_latency_ms": percentiles(latencies, scale=1000),
+            "time_to_report_seconds": percentiles(times_to_report),
+            "rss_mb": {
+                "baseline": round(rss.baseline / 2**20, 1),
+                "peak": round(rss.peak / 2**20, 1),
+                "per_session": round((rss.peak - rss.baseline) / 2**20 / max(sessions, 1), 2),
+            },
+        }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent synthetic sessions")
+    parser.add_argument("--batches", type=int, default=30, help=f"batches per session (min {MIN_BATCHES})")
+    parser.add_argument("--batch-size", type=int, default=32, help="samples per batch")
+    parser.add_argument("--classes", type=int, default=10, help="number of classes")
+    parser.add_argument("--image-shape", default="28,28,1", help="comma separated shape of one sample")
+    parser.add_argument("--arrival-rate", type=float, default=0.0, help="new sessions per second, 0 = all at once")
+    parser.add_argument("--batch-rate", type=float, default=0.0, help="batches per second per session, 0 = back to back")
+    parser.add_argument("--database-url", default=None, help="PostgreSQL URL; in-memory stand-in when omitted")
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds to wait for every report")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results as JSON to this path")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+    spec = SessionSpec(
+        batches=args.batches,
+        batch_size=args.batch_size,
+        num_classes=args.classes,
+        image_shape=tuple(int(d) for d in args.image_shape.split(",")),
+    )
+    results = E2EBenchmark(
+        spec,
+        sessions=args.sessions,
+        arrival_rate=args.arrival_rate,
+        batch_rate=args.batch_rate,
+        database_url=args.database_url,
+        timeout_seconds=args.timeout,
+        seed=args.seed,
+    ).run()
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import time
+
+
+class RecordingReportBuilder:
+    """Report builder stand-in recording when the session's report was produced."""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.results = None
+        self.sent_at = None
+
+    def generate_report(self, results):
+        self.results = results
+
+    def send_report(self, recipient_email=""):
+        self.sent_at = time.perf_counter()
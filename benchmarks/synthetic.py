@@ -0,0 +1,78 @@
+import json
+import uuid
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+from src.proto import calibration_pb2, dataset_service_pb2
+
+
+class SessionSpec(NamedTuple):
+    """Shape of the traffic of one synthetic session."""
+
+    batches: int = 30
+    batch_size: int = 32
+    num_classes: int = 10
+    image_shape: Tuple[int, ...] = (28, 28, 1)
+    # Probability that the synthetic model puts its largest score on the true label
+    accuracy: float = 0.8
+
+
+class SyntheticSession:
+    """
+    Generates the messages a client session produces: the new-connection
+    notification, the labeled input batches and the model's predictions for
+    them. Predictions are softmax scores whose argmax is the true label with
+    probability `spec.accuracy`, so every calibration stage sees realistic
+    data.
+    """
+
+    def __init__(self, spec: SessionSpec, seed: int = 0, user_id: str = None, session_id: str = None):
+        self.spec = spec
+        self.user_id = user_id or f"bench-{uuid.uuid4().hex[:12]}"
+        self.session_id = session_id or str(uuid.uuid4())
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def inputs_format(self) -> str:
+        return "(" + ", ".join(str(d) for d in self.spec.image_shape) + ")"
+
+    def notification(self) -> bytes:
+        return json.dumps(
+            {
+                "user_id": self.user_id,
+                "session_id": self.session_id,
+                "inputs_format": self.inputs_format,
+                "email": f"{self.user_id}@example.com",
+            }
+        ).encode("utf-8")
+
+    def batch(self, batch_index: int) -> Tuple[bytes, bytes]:
+        """Serialized (inputs, predictions) messages of one batch."""
+        spec = self.spec
+        is_last = batch_index == spec.batches - 1
+        labels = self._rng.integers(0, spec.num_classes, size=spec.batch_size)
+
+        images = self._rng.random((spec.batch_size, *spec.image_shape), dtype=np.float32)
+        inputs = dataset_service_pb2.DataBatchLabeled()
+        inputs.data = images.tobytes()
+        inputs.labels.extend(labels.tolist())
+        inputs.batch_index = batch_index
+        inputs.is_last_batch = is_last
+
+        logits = self._rng.normal(size=(spec.batch_size, spec.num_classes))
+        hits = self._rng.random(spec.batch_size) < spec.accuracy
+        top = np.where(hits, labels, self._rng.integers(0, spec.num_classes, size=spec.batch_size))
+        logits[np.arange(spec.batch_size), top] += 4.0
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+
+        predictions = calibration_pb2.Predictions()
+        for row in probs.astype(np.float32):
+            pred = calibration_pb2.PredictionList()
+            pred.values.extend(row.tolist())
+            predictions.pred.append(pred)
+        predictions.batch_index = batch_index
+        predictions.eof = is_last
+
+        return inputs.SerializeToString(), predictions.SerializeToString()
@@ -0,0 +1,246 @@
+"""
+Micro-benchmarks for the utrace kernels.
+
+Sweeps calibration size (N), batch size (Ns) and class count (K) over
+`calibrate`, `get_uncertainty_opt`, `build_prediction_sets`, the LAC/APS
+scores and `get_coverage`. Results can be saved as a JSON baseline and later
+compared against it; slowdowns beyond the threshold make the run fail.
+
+    PYTHONPATH=./src python -m benchmarks.utrace_kernels --save benchmarks/baselines/utrace_kernels.json
+    PYTHONPATH=./src python -m benchmarks.utrace_kernels --compare benchmarks/baselines/utrace_kernels.json --threshold 0.2
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from utrace.scores import aps, aps_cal, lac, lac_cal
+from utrace.uncertaintyQuantifier import UncertaintyQuantifier
+from utrace.utils.utils import get_coverage
+
+DEFAULT_N = [500, 2000]
+DEFAULT_NS = [32, 256]
+DEFAULT_K = [10, 100]
+
+
+def synthetic_probs(rng, samples: int, num_classes: int):
+    """Softmax scores whose argmax is the true label most of the time, and the labels."""
+    labels = rng.integers(0, num_classes, size=samples)
+    logits = rng.normal(size=(samples, num_classes))
+    logits[np.arange(samples), labels] += 3.0
+    probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return (probs / probs.sum(axis=1, keepdims=True)).astype(np.float32), labels
+
+
+def calibrated_uq(rng, N: int, K: int, alpha: float = None) -> UncertaintyQuantifier:
+    uq = UncertaintyQuantifier(classes=np.arange(K))
+    probs, labels = synthetic_probs(rng, N, K)
+    uq.calibrate(probs, labels)
+    if alpha is not None:
+        uq.alpha = alpha
+    return uq
+
+
+def kernel_cases(N_values, Ns_values, K_values, seed=0):
+    """
+    Yield (kernel, params, setup) for every point of the sweep. `setup`
+    builds the inputs outside of the timed region and returns the call to time.
+    Each kernel only varies over the dimensions it depends on.
+    """
+    rng = np.random.default_rng(seed)
+
+    for N, K in itertools.product(N_values, K_values):
+        def calibrate(N=N, K=K):
+            probs, labels = synthetic_probs(rng, N, K)
+            return lambda: UncertaintyQuantifier(classes=np.arange(K)).calibrate(probs, labels)
+        yield "calibrate", {"N": N, "K": K}, calibrate
+
+    for N, Ns, K in itertools.product(N_values, Ns_values, K_values):
+        def calibrate_batched(N=N, Ns=Ns, K=K):
+            base = calibrated_uq(rng, N, K)
+            probs, labels = synthetic_probs(rng, Ns, K)
+
+            def call():
+                uq = UncertaintyQuantifier(classes=np.arange(K))
+                uq.reset(conformity_scores_=base.conformity_scores_, class_scores=base.class_scores)
+                uq.calibrate(probs, labels, batched=True)
+            return call
+        yield "calibrate_batched", {"N": N, "Ns": Ns, "K": K}, calibrate_batched
+
+        def get_uncertainty_opt(N=N, Ns=Ns, K=K):
+            uq = calibrated_uq(rng, N, K)
+            probs, labels = synthetic_probs(rng, Ns, K)
+            return lambda: uq.get_uncertainty_opt(probs, labels)
+        yield "get_uncertainty_opt", {"N": N, "Ns": Ns, "K": K}, get_uncertainty_opt
+
+    for Ns, K in itertools.product(Ns_values, K_values):
+        def build_prediction_sets(Ns=Ns, K=K):
+            uq = calibrated_uq(rng, max(N_values), K, alpha=0.1)
+            probs, _ = synthetic_probs(rng, Ns, K)
+            return lambda: uq.build_prediction_sets(probs)
+        yield "build_prediction_sets", {"Ns": Ns, "K": K}, build_prediction_sets
+
+        for name, score in [("lac", lac), ("aps", aps)]:
+            def score_case(score=score, Ns=Ns, K=K):
+                probs, _ = synthetic_probs(rng, Ns, K)
+                return lambda: score(probs)
+            yield name, {"Ns": Ns, "K": K}, score_case
+
+        for name, cal_score in [("lac_cal", lac_cal), ("aps_cal", aps_cal)]:
+            def cal_score_case(cal_score=cal_score, Ns=Ns, K=K):
+                probs, labels = synthetic_probs(rng, Ns, K)
+                return lambda: cal_score(labels, probs)
+            yield name, {"Ns": Ns, "K": K}, cal_score_case
+
+        def coverage(Ns=Ns, K=K):
+            uq = calibrated_uq(rng, max(N_values), K, alpha=0.1)
+            probs, labels = synthetic_probs(rng, Ns, K)
+            sets = uq.build_prediction_sets(probs)
+            return lambda: get_coverage(labels, sets)
+        yield "get_coverage", {"Ns": Ns, "K": K}, coverage
+
+
+def case_name(kernel: str, params: dict) -> str:
+    return f"{kernel}[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+
+
+def measure(call, repeat: int = 5, min_time: float = 0.05) -> dict:
+    """Per-call seconds: the number of calls per sample grows until a sample takes min_time."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        if time.perf_counter() - start >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        samples.append((time.perf_counter() - start) / number)
+    return {"median_s": float(np.median(samples)), "min_s": float(min(samples)), "calls_per_sample": number}
+
+
+def run_suite(N_values=DEFAULT_N, Ns_values=DEFAULT_NS, K_values=DEFAULT_K, repeat=5, min_time=0.05, kernels=None, seed=0) -> dict:
+    results = {}
+    for kernel, params, setup in kernel_cases(N_values, Ns_values, K_values, seed=seed):
+        if kernels and kernel not in kernels:
+            continue
+        # The APS scores print intermediate values; keep them out of the report but inside the timing
+        with contextlib.redirect_stdout(io.StringIO()):
+            call = setup()
+            results[case_name(kernel, params)] = {"kernel": kernel, "params": params, **measure(call, repeat, min_time)}
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "repeat": repeat,
+            "min_time": min_time,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.2) -> dict:
+    """
+    Compare median per-call times with the baseline. A case regresses when it
+    is more than `threshold` (fraction) slower, and improves when it is more
+    than `threshold` faster.
+    """
+    regressions, improvements, unchanged = [], [], []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            continue
+        ratio = result["median_s"] / reference["median_s"] if reference["median_s"] > 0 else float("inf")
+        entry = {"case": name, "baseline_s": reference["median_s"], "current_s": result["median_s"], "ratio": round(ratio, 3)}
+        if ratio > 1 + threshold:
+            regressions.append(entry)
+        elif ratio < 1 - threshold:
+            improvements.append(entry)
+        else:
+            unchanged.append(entry)
+    return {
+        "threshold": threshold,
+        "regressions": regressions,
+        "improvements": improvements,
+        "unchanged": unchanged,
+        "missing_from_baseline": sorted(set(current["results"]) - set(baseline["results"])),
+    }
+
+
+def format_results(results: dict) -> str:
+    lines = [f"{'case':<55} {'median':>12} {'min':>12}"]
+    for name, result in results["results"].items():
+        lines.append(f"{name:<55} {result['median_s'] * 1e3:>10.4f}ms {result['min_s'] * 1e3:>10.4f}ms")
+    return "\n".join(lines)
+
+
+def format_comparison(comparison: dict) -> str:
+    lines = []
+    for label in ["regressions", "improvements"]:
+        for entry in comparison[label]:
+            lines.append(
+                f"{label[:-1].upper():<12} {entry['case']:<55} "
+                f"{entry['baseline_s'] * 1e3:.4f}ms -> {entry['current_s'] * 1e3:.4f}ms (x{entry['ratio']})"
+            )
+    lines.append(
+        f"{len(comparison['regressions'])} regressions, {len(comparison['improvements'])} improvements, "
+        f"{len(comparison['unchanged'])} unchanged (threshold {comparison['threshold']:.0%})"
+    )
+    return "\n".join(lines)
+
+
+def _int_list(value: str):
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--N", type=_int_list, default=DEFAULT_N, help="calibration sizes, comma separated")
+    parser.add_argument("--Ns", type=_int_list, default=DEFAULT_NS, help="batch sizes, comma separated")
+    parser.add_argument("--K", type=_int_list, default=DEFAULT_K, help="class counts, comma separated")
+    parser.add_argument("--kernels", default=None, help="only run these kernels, comma separated")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05, help="minimum seconds per timing sample")
+    parser.add_argument("--save", default=None, help="write the results as a JSON baseline")
+    parser.add_argument("--compare", default=None, help="compare against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown as a fraction")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    kernels = set(args.kernels.split(",")) if args.kernels else None
+    results = run_suite(args.N, args.Ns, args.K, repeat=args.repeat, min_time=args.min_time, kernels=kernels)
+    print(format_results(results))
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            comparison = compare(results, json.load(baseline_file), threshold=args.threshold)
+        print(format_comparison(comparison))
+        if comparison["regressions"]:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+import logging
+import threading
+import zlib
+from typing import Callable, Dict, NamedTuple
+
+
+class Codec(NamedTuple):
+    """Compression of the message bodies stored in model_inputs/model_outputs."""
+
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+def _identity(body: bytes) -> bytes:
+    return body
+
+
+def _zlib_codec(level: int) -> Codec:
+    return Codec("zlib", lambda body: zlib.compress(body, level), zlib.decompress)
+
+
+def _lz4_codec() -> Codec:
+    import lz4.frame
+    return Codec("lz4", lz4.frame.compress, lz4.frame.decompress)
+
+
+def _zstd_codec(level: int) -> Codec:
+    import zstandard
+    # Compressor and decompressor objects are not thread-safe, and one codec serves every
+    # session thread of the process, so each thread gets its own pair
+    local = threading.local()
+
+    def compress(body: bytes) -> bytes:
+        if not hasattr(local, "compressor"):
+            local.compressor = zstandard.ZstdCompressor(level=level)
+        return local.compressor.compress(body)
+
+    def decompress(body: bytes) -> bytes:
+        if not hasattr(local, "decompressor"):
+            local.decompressor = zstandard.ZstdDecompressor()
+        # Frames carry their content size, so decompression needs no size hint
+        return local.decompressor.decompress(body)
+
+    return Codec("zstd", compress, decompress)
+
+
+NONE = Codec("none", _identity, _identity)
+
+# Codec name -> factory taking the compression level; lz4 and zstd need their optional packages
+_FACTORIES: Dict[str, Callable[[int], Codec]] = {
+    "none": lambda level: NONE,
+    "zlib": lambda level: _zlib_codec(level if level is not None else 1),
+    "lz4": lambda level: _lz4_codec(),
+    "zstd": lambda level: _zstd_codec(level if level is not None else 3),
+}
+CODEC_NAMES = tuple(_FACTORIES)
+
+
+def get_codec(name: str, level: int = None) -> Codec:
+    """
+    Codec used to write new rows. A fast codec whose package is not installed
+    falls back to zlib at its fastest level.
+    """
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown codec {name!r}, expected one of {CODEC_NAMES}")
+    try:
+        return _FACTORIES[name](level)
+    except ImportError:
+        logging.warning(f"Codec {name} is not installed, falling back to zlib")
+        return _zlib_codec(1)
+
+
+_decoders: Dict[str, Callable[[bytes], bytes]] = {}
+
+
+def decompress(codec_name: str, body: bytes) -> bytes:
+    """Decode a stored body with the codec recorded on its row (NULL/none for rows written uncompressed)."""
+    if body is None or not codec_name or codec_name == "none":
+        return body
+    decoder = _decoders.get(codec_name)
+    if decoder is None:
+        if codec_name not in _FACTORIES:
+            raise ValueError(f"Row written with unknown codec {codec_name!r}")
+        # Raises ImportError if the row's codec is not installed here; a fallback cannot read it
+        decoder = _decoders[codec_name] = _FACTORIES[codec_name](None).decompress
+    return decoder(body)
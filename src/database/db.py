@@ -1,30 +1,96 @@
 from sqlalchemy.exc import NoResultFound, SQLAlchemyError, IntegrityError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session
-from sqlalchemy import select, update, func
-from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import Integer, and_, cast, or_, select, update, delete, func, text
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+import datetime
+import hashlib
+from collections import Counter, namedtuple
+from typing import Callable, Iterable, Iterator, Sequence, Tuple
 from uuid import UUID
 import logging
 from src.models.inputs import ModelInputs
 from src.models.outputs import ModelOutputs
+from src.models.input_blobs import InputBlobs
 from src.models.scores import Scores
-from src.lib.db_engine import Base
+from src.models.stored_sessions import StoredSessions
+from src.lib.config import DatabaseConfig
+from src.database.query_timing import instrument_engine, timed_method
+from src.database.codecs import Codec, decompress, get_codec
+from src.database import partitions
+from src.lib.metrics import RETENTION_PURGED_TOTAL
+
+# Rows per multi-row INSERT; keeps statements well under PostgreSQL's 65535 bind parameters
+BULK_WRITE_CHUNK_ROWS = 1000
+# Rows fetched per round-trip when streaming a session's batches back
+RESTORE_YIELD_PER_ROWS = 8
+# Sessions deleted per transaction by the retention purge of unpartitioned tables
+RETENTION_PURGE_BATCH_SESSIONS = 100
+
 
 class Database:
-    def __init__(self, engine):
+    def __init__(
+        self,
+        engine,
+        slow_query_seconds: float = None,
+        codec: Codec | str = None,
+        dedup_inputs: bool = None,
+        clock: Callable[[], datetime.datetime] = None,
+    ):
         self.engine = engine
-        try:
-            self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
-            Base.metadata.create_all(bind=self.engine)
+        config = DatabaseConfig()
+        self.dedup_inputs = config.dedup_inputs if dedup_inputs is None else dedup_inputs
+        self.partition_days = config.partition_days
+        # UTC now; sets the partition day of new sessions and the retention cutoffs
+        self.clock = clock or datetime.datetime.utcnow
+        # session_id -> partition_day, registered in stored_sessions on a session's first write
+        self._partition_days = {}
+        # Sessions without deduplicated rows: with dedup off their writes replace no blob references
+        self._sessions_without_blobs = set()
+        if codec is None:
+            codec = get_codec(config.codec, config.codec_level)
+        elif isinstance(codec, str):
+            codec = get_codec(codec, config.codec_level)
+        # Used for new writes; reads decode each row with the codec it was written with
+        self.codec = codec
+        # No DDL here: the schema is created by src/database/migrations.py when the server starts
+        if slow_query_seconds is None:
+            slow_query_seconds = config.slow_query_seconds
+        instrument_engine(self.engine, slow_query_seconds)
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
 
-            logging.info("Tables created successfully")
-            logging.info(f"USING ENGINE: {self.engine.url}")
-            logging.info(Base.metadata.tables.keys())
+    def _is_partitioned(self) -> bool:
+        if self.engine.dialect.name != "postgresql":
+            return False
+        with self.engine.connect() as connection:
+            return partitions.is_partitioned(connection, ModelInputs.__tablename__)
 
-        except SQLAlchemyError as e:
-            logging.error(f"Error creating tables: {e}")
+    @timed_method
+    def ensure_partitions(self):
+        """Create the partitions of the current and coming DB_PARTITION_DAYS ranges; a no-op without partitioning."""
+        if self._is_partitioned():
+            partitions.ensure_partitions(self.engine, self.clock().date(), self.partition_days)
 
+    def _partition_day(self, session_id: UUID) -> datetime.date:
+        """
+        Partition key of a session's rows: the day of its first write, registered
+        once in stored_sessions (in its own transaction) and cached.
+        """
+        day = self._partition_days.get(session_id)
+        if day is None:
+            now = self.clock()
+            stmt = pg_insert(StoredSessions).values(session_id=session_id, partition_day=now.date(), started_at=now)
+            # Registered by an earlier run of the session: keep its day
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[StoredSessions.session_id],
+                set_={"partition_day": StoredSessions.partition_day},
+            ).returning(StoredSessions.partition_day)
+            with self.engine.begin() as connection:
+                day = connection.execute(stmt).scalar_one()
+            self._partition_days[session_id] = day
+        return day
 
+    @timed_method
     def get_latest_scores_record(self, session_id) -> Scores | None:
         """
         Retrieve the latest Scores record for a given session_id.
@@ -47,53 +113,62 @@ class Database:
                 logging.error(f"Error retrieving Scores record for session_id {session_id}: {e}")
                 return None
 
+    @timed_method
     def update_session_state(self, session_id, updates):
         with Session(self.engine) as session:
             try: 
                 stmt = update(Scores).where(
                     Scores.session_id == session_id
-                )
-                
-                values = {}
-                
-                if 'push_alphas' in updates:
-                    values['alphas'] = func.array_append(Scores.alphas, updates['push_alphas'])
-                if 'push_uncertainties' in updates:
-                    values['uncertainties'] = func.array_append(Scores.uncertainties, updates['push_uncertainties'])
-                if 'push_coverages' in updates:
-                    values['coverages'] = func.array_append(Scores.coverages, updates['push_coverages'].item())
-                if 'push_setsizes' in updates:
-                    values['setsizes'] = func.array_append(Scores.setsizes, updates['push_setsizes'])
-                if 'push_confidences' in updates:
-                    values['confidences'] = func.coalesce(Scores.confidences, b'').op('||')(updates['push_confidences'])
-
-                # Actualizaciones escalares
-                if 'accuracy' in updates:
-                    values['accuracy'] = updates['accuracy']
-                if 'correct_preds' in updates:
-                    values['correct_preds'] = updates['correct_preds']
-                if 'total_samples' in updates:
-                    values['total_samples'] = updates['total_samples']
-
-                # Variables del uq
-                if 'alpha' in updates:
-                    values['alpha'] = updates['alpha']
-                if 'q_hat' in updates:
-                    values['q_hat'] = updates['q_hat']
-                if 'scores' in updates:
-                    values['scores'] = updates['scores']
-    
-                                
-                values['batchs_counter'] = updates['batchs_counter']
-                values['stage'] = updates['stage']
-                
-                stmt = stmt.values(values)
+                ).values(self._session_state_values(updates))
                 session.execute(stmt)
                 session.commit()
             except SQLAlchemyError as e:
                 logging.error(f"Error updating session state for session_id {session_id}: {e}")
                 session.rollback()
 
+    def _session_state_values(self, updates) -> dict:
+        values = {}
+        
+        if 'push_alphas' in updates:
+            values['alphas'] = func.array_append(Scores.alphas, updates['push_alphas'])
+        if 'push_uncertainties' in updates:
+            values['uncertainties'] = func.array_append(Scores.uncertainties, updates['push_uncertainties'])
+        if 'push_coverages' in updates:
+            values['coverages'] = func.array_append(Scores.coverages, updates['push_coverages'].item())
+        if 'push_setsizes' in updates:
+            values['setsizes'] = func.array_append(Scores.setsizes, updates['push_setsizes'])
+        if 'push_confidences' in updates:
+            values['confidences'] = func.coalesce(Scores.confidences, b'').op('||')(updates['push_confidences'])
+        if 'push_processed_batches' in updates:
+            values['processed_batches'] = func.array_cat(
+                Scores.processed_batches, cast(updates['push_processed_batches'], ARRAY(Integer))
+            )
+
+        # Actualizaciones escalares
+        if 'accuracy' in updates:
+            values['accuracy'] = updates['accuracy']
+        if 'correct_preds' in updates:
+            values['correct_preds'] = updates['correct_preds']
+        if 'total_samples' in updates:
+            values['total_samples'] = updates['total_samples']
+
+        # Variables del uq
+        if 'alpha' in updates:
+            values['alpha'] = updates['alpha']
+        if 'q_hat' in updates:
+            values['q_hat'] = updates['q_hat']
+        if 'scores' in updates:
+            values['scores'] = updates['scores']
+        if 'class_scores' in updates:
+            values['class_scores'] = updates['class_scores']
+
+        values['batchs_counter'] = updates['batchs_counter']
+        if 'samples_counter' in updates:
+            values['samples_counter'] = updates['samples_counter']
+        values['stage'] = updates['stage']
+        return values
+
+    @timed_method
     def create_scores_record(self, session_id):
             with Session(self.engine) as session:
                 try:
@@ -104,6 +179,7 @@ class Database:
                         coverages=[],
                         setsizes=[],
                         confidences=b'',
+                        processed_batches=[],
                     )
                     
                     stmt = stmt.on_conflict_do_nothing(
@@ -118,103 +194,398 @@ class Database:
                     logging.error(f"Error creating scores record for {session_id}: {e}")
                     raise e
 
+    @timed_method
     def write_inputs(self, session_id: UUID, inputs: bytes, batch_index: int):
         """
         Write inputs to the database for a given session_id and batch_index.
-        If a record with the session_id and batch_index exists, update it; otherwise, insert a new record
+        A single INSERT ... ON CONFLICT DO UPDATE inserts the record or replaces its inputs;
+        with deduplication, inputs already stored by another session are not written again.
         """
+        self._write_inputs(session_id, [(batch_index, inputs)])
+
+    @timed_method
+    def write_outputs(self, session_id: UUID, outputs: bytes, batch_index: int):
+        """
+        Write outputs to the database for a given session_id and batch_index.
+        A single INSERT ... ON CONFLICT DO UPDATE inserts the record or replaces its outputs.
+        """
+        self._upsert_batches(ModelOutputs, "outputs", session_id, [(batch_index, outputs)])
+
+    @timed_method
+    def apply_checkpoint(
+        self,
+        session_id: UUID,
+        inputs: Iterable[Tuple[int, bytes]] = (),
+        outputs: Iterable[Tuple[int, bytes]] = (),
+        state_updates: Sequence[dict] = (),
+    ):
+        """
+        Apply a session's write-ahead log records in one transaction: inputs and outputs as
+        (batch_index, body) pairs, then update_session_state updates in order. Updates the
+        scores record already counted (by batchs_counter) are skipped and the upserts are
+        idempotent, so replaying a checkpoint changes nothing. Raises on error.
+        """
+        inputs, outputs = dict(inputs), dict(outputs)
         with Session(self.engine) as session:
             try:
-                stmt = select(ModelInputs).where(
-                    ModelInputs.session_id == session_id,
-                    ModelInputs.batch_index == batch_index
+                if inputs:
+                    self._write_inputs_in(session, session_id, inputs)
+                if outputs:
+                    self._execute_upserts(session, ModelOutputs, self._body_rows("outputs", session_id, outputs), ["outputs", "codec"])
+                if state_updates:
+                    applied = session.execute(
+                        select(Scores.batchs_counter).where(Scores.session_id == session_id).with_for_update()
+                    ).scalar() or 0
+                    for updates in state_updates:
+                        if updates["batchs_counter"] <= applied:
+                            continue
+                        session.execute(
+                            update(Scores).where(Scores.session_id == session_id).values(self._session_state_values(updates))
+                        )
+                session.commit()
+                logging.info(
+                    f"Applied checkpoint for session_id: {session_id}, inputs: {len(inputs)}, "
+                    f"outputs: {len(outputs)}, state updates: {len(state_updates)}"
                 )
-                result = session.execute(stmt).scalar_one_or_none()
+            except SQLAlchemyError as e:
+                logging.error(f"Error applying checkpoint for session_id {session_id}: {e}")
+                session.rollback()
+                raise
 
-                if result:
-                    result.inputs = inputs
-                    logging.info(f"Updating inputs for session_id: {session_id}, batch_index: {batch_index}")
-                else:
-                    new_input = ModelInputs(session_id=session_id, batch_index=batch_index, inputs=inputs)
-                    session.add(new_input)
-                    logging.info(f"Inserting new inputs for session_id: {session_id}, batch_index: {batch_index}")
+    @timed_method
+    def delete_inputs(self, session_id: UUID):
+        """
+        Delete the inputs of a session, releasing its references to shared input blobs;
+        blobs no other session references are deleted with them.
+        """
+        with Session(self.engine) as session:
+            try:
+                references = self._delete_inputs_in(session, session_id)
+                session.commit()
+                logging.info(f"Deleted inputs for session_id: {session_id}, blob references: {sum(references.values())}")
+            except SQLAlchemyError as e:
+                logging.error(f"Error deleting inputs for session_id {session_id}: {e}")
+                session.rollback()
+                raise
 
+    def _delete_inputs_in(self, session, session_id: UUID) -> Counter:
+        """Delete a session's inputs within `session`; returns the blob references released."""
+        references = Counter(session.execute(
+            select(ModelInputs.digest).where(ModelInputs.session_id == session_id, ModelInputs.digest.is_not(None))
+        ).scalars())
+        session.execute(delete(ModelInputs).where(ModelInputs.session_id == session_id))
+        self._release_blobs(session, references)
+        return references
+
+    @timed_method
+    def mark_session_finished(self, session_id: UUID, status: str):
+        """Record that a session ended (COMPLETED or TIMEOUT); its batches become eligible for the retention purge."""
+        with Session(self.engine) as session:
+            try:
+                now = self.clock()
+                stmt = pg_insert(StoredSessions).values(
+                    session_id=session_id, partition_day=now.date(), started_at=now, finished_at=now, status=status
+                )
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[StoredSessions.session_id],
+                    set_={"finished_at": stmt.excluded.finished_at, "status": stmt.excluded.status},
+                )
+                session.execute(stmt)
                 session.commit()
+                logging.info(f"Marked session_id: {session_id} as finished, status: {status}")
             except SQLAlchemyError as e:
-                logging.error(f"Error writing inputs for session_id {session_id}, batch_index {batch_index}: {e}")
+                logging.error(f"Error marking session_id {session_id} as finished: {e}")
                 session.rollback()
 
-    def write_outputs(self, session_id: UUID, outputs: bytes, batch_index: int):
+    @timed_method
+    def purge_expired(self, retention_days: float, abandoned_days: float = 0) -> int:
         """
-        Write outputs to the database for a given session_id and batch_index.
-        If a record with the session_id and batch_index exists, update it; otherwise, insert a new record
+        Remove the batches of sessions finished more than `retention_days` ago, and of
+        sessions never marked finished that started more than `abandoned_days` ago (0: kept).
+        Partitioned tables lose whole partitions, once every session in their range has
+        expired; otherwise rows are deleted session by session. Returns the partitions
+        (per table) or sessions removed. Raises on error; a later run retries.
         """
+        now = self.clock()
+        cutoff = now - datetime.timedelta(days=retention_days)
+        # Null-safe, so that NOT expired holds for sessions still running
+        expired = and_(StoredSessions.finished_at.is_not(None), StoredSessions.finished_at < cutoff)
+        if abandoned_days:
+            abandoned_day = (now - datetime.timedelta(days=abandoned_days)).date()
+            expired = or_(expired, and_(StoredSessions.finished_at.is_(None), StoredSessions.partition_day < abandoned_day))
+        if self._is_partitioned():
+            return self._drop_expired_partitions(cutoff.date(), expired)
+        return self._delete_expired_sessions(expired)
+
+    def _drop_expired_partitions(self, cutoff_day: datetime.date, expired) -> int:
+        dropped = 0
+        with self.engine.connect() as connection:
+            candidates = [
+                partition for partition in partitions.list_partitions(connection, ModelInputs.__tablename__)
+                if partition.upper is not None and partition.upper <= cutoff_day
+            ]
+        for partition in candidates:
+            in_range = StoredSessions.partition_day < partition.upper
+            if partition.lower is not None:
+                in_range = and_(in_range, StoredSessions.partition_day >= partition.lower)
+            with Session(self.engine) as session:
+                try:
+                    live = session.execute(
+                        select(func.count()).select_from(StoredSessions).where(in_range, ~expired)
+                    ).scalar()
+                    if live:
+                        continue
+                    # Blobs stay as long as another partition's rows reference them
+                    references = Counter(dict(session.execute(text(
+                        f"SELECT digest, count(*) FROM {partition.name} WHERE digest IS NOT NULL GROUP BY digest"
+                    )).all()))
+                    self._release_blobs(session, references)
+                    for model in (ModelInputs, ModelOutputs):
+                        partitions.drop_partition(
+                            session, model.__tablename__, partition.sibling(model.__tablename__, ModelInputs.__tablename__)
+                        )
+                    sessions = session.execute(delete(StoredSessions).where(in_range)).rowcount
+                    session.commit()
+                except SQLAlchemyError as e:
+                    logging.error(f"Error dropping partition {partition.name}: {e}")
+                    session.rollback()
+                    raise
+            dropped += 1
+            RETENTION_PURGED_TOTAL.inc(kind="partitions")
+            logging.info(
+                f"action: drop_partition | result: success | partition: {partition.name} | "
+                f"sessions: {sessions} | blob_references: {sum(references.values())}"
+            )
+        return dropped
+
+    def _delete_expired_sessions(self, expired) -> int:
+        purged = 0
+        while True:
+            with Session(self.engine) as session:
+                try:
+                    session_ids = session.execute(
+                        select(StoredSessions.session_id).where(expired).limit(RETENTION_PURGE_BATCH_SESSIONS)
+                    ).scalars().all()
+                    for session_id in session_ids:
+                        self._delete_inputs_in(session, session_id)
+                    session.execute(delete(ModelOutputs).where(ModelOutputs.session_id.in_(session_ids)))
+                    session.execute(delete(StoredSessions).where(StoredSessions.session_id.in_(session_ids)))
+                    session.commit()
+                except SQLAlchemyError as e:
+                    logging.error(f"Error purging expired sessions: {e}")
+                    session.rollback()
+                    raise
+            purged += len(session_ids)
+            RETENTION_PURGED_TOTAL.inc(len(session_ids), kind="sessions")
+            if len(session_ids) < RETENTION_PURGE_BATCH_SESSIONS:
+                return purged
+
+    def _write_inputs(self, session_id: UUID, batches: Iterable[Tuple[int, bytes]]):
+        # A batch may only appear once per statement; the last write wins, as with separate calls
+        batches = dict(batches)
+        if not batches:
+            return
         with Session(self.engine) as session:
             try:
-                stmt = select(ModelOutputs).where(
-                    ModelOutputs.session_id == session_id,
-                    ModelOutputs.batch_index == batch_index
+                stored = self._write_inputs_in(session, session_id, batches)
+                session.commit()
+                logging.info(f"Upserted inputs for session_id: {session_id}, batches: {len(batches)}, new blobs: {stored}")
+            except SQLAlchemyError as e:
+                logging.error(f"Error writing inputs for session_id {session_id}, batches {list(batches)}: {e}")
+                session.rollback()
+
+    def _write_inputs_in(self, session, session_id: UUID, batches: dict) -> int:
+        """Upsert inputs within `session`; returns the number of new input blobs written."""
+        day = self._partition_day(session_id)
+        if self.dedup_inputs:
+            digests = {batch_index: hashlib.sha256(body).hexdigest() for batch_index, body in batches.items()}
+            rows = [
+                {"session_id": session_id, "batch_index": batch_index, "partition_day": day, "inputs": None,
+                 "codec": "none", "digest": digest}
+                for batch_index, digest in digests.items()
+            ]
+        else:
+            digests = {}
+            rows = [
+                {"session_id": session_id, "batch_index": batch_index, "partition_day": day,
+                 "inputs": self.codec.compress(body), "codec": self.codec.name, "digest": None}
+                for batch_index, body in batches.items()
+            ]
+        # References held by the rows about to be replaced; released once the new ones are taken
+        if self._references_blobs(session, session_id):
+            replaced = Counter(session.execute(
+                select(ModelInputs.digest).where(
+                    ModelInputs.session_id == session_id,
+                    ModelInputs.batch_index.in_(list(batches)),
+                    ModelInputs.digest.is_not(None),
                 )
-                result = session.execute(stmt).scalar_one_or_none()
+            ).scalars())
+        else:
+            replaced = Counter()
+        stored = 0
+        if replaced:
+            # Acquiring and releasing would lock rows in two rounds; take them all up front, in order
+            self._lock_blobs(session, set(digests.values()) | set(replaced))
+        if digests:
+            bodies = {digests[batch_index]: body for batch_index, body in batches.items()}
+            stored = self._acquire_blobs(session, Counter(digests.values()), bodies)
+        self._execute_upserts(session, ModelInputs, rows, ["inputs", "codec", "digest"])
+        self._release_blobs(session, replaced)
+        return stored
 
-                if result:
-                    result.outputs = outputs
-                    logging.info(f"Updating outputs for session_id: {session_id}, batch_index: {batch_index}")
-                else:
-                    new_output = ModelOutputs(session_id=session_id, batch_index=batch_index, outputs=outputs)
-                    session.add(new_output)
-                    logging.info(f"Inserting new outputs for session_id: {session_id}, batch_index: {batch_index}")
+    def _references_blobs(self, session, session_id: UUID) -> bool:
+        """Whether the session's rows may point at input blobs; checked once per session with dedup off."""
+        if self.dedup_inputs:
+            return True
+        if session_id in self._sessions_without_blobs:
+            return False
+        # Rows written while dedup was on, e.g. before a restart with another setting
+        if session.execute(
+            select(ModelInputs.digest).where(ModelInputs.session_id == session_id, ModelInputs.digest.is_not(None)).limit(1)
+        ).first():
+            return True
+        self._sessions_without_blobs.add(session_id)
+        return False
+
+    def _acquire_blobs(self, session, digests: Counter, bodies: dict) -> int:
+        """Add references to input blobs, writing only the bodies not stored yet. Returns how many were written."""
+        # Row locks keep a concurrent release from deleting a blob before its refcount goes up
+        existing = self._lock_blobs(session, digests)
+        self._add_references(session, {digest: digests[digest] for digest in existing})
+        new = [
+            {"digest": digest, "body": self.codec.compress(bodies[digest]), "codec": self.codec.name, "refcount": digests[digest]}
+            for digest in sorted(digests) if digest not in existing
+        ]
+        if new:
+            stmt = pg_insert(InputBlobs).values(new)
+            # Another session stored the same body in the meantime: only add the references
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[InputBlobs.digest],
+                set_={"refcount": InputBlobs.refcount + stmt.excluded.refcount},
+            )
+            session.execute(stmt)
+        return len(new)
+
+    def _release_blobs(self, session, digests: Counter):
+        """Drop references to input blobs and delete the ones no longer referenced."""
+        if not digests:
+            return
+        self._lock_blobs(session, digests)
+        self._add_references(session, {digest: -count for digest, count in digests.items()})
+        session.execute(delete(InputBlobs).where(InputBlobs.digest.in_(sorted(digests)), InputBlobs.refcount <= 0))
+
+    def _lock_blobs(self, session, digests) -> set:
+        """Lock the stored input blobs among `digests`; returns their digests."""
+        # Every writer locks blobs in digest order, so sessions sharing bodies cannot deadlock on them
+        return set(session.execute(
+            select(InputBlobs.digest)
+            .where(InputBlobs.digest.in_(sorted(digests)))
+            .order_by(InputBlobs.digest)
+            .with_for_update()
+        ).scalars())
+
+    def _add_references(self, session, counts: dict):
+        # Callers hold the row locks (_lock_blobs). One UPDATE per distinct count; a batch write
+        # usually references each blob once
+        for count in sorted(set(counts.values())):
+            session.execute(
+                update(InputBlobs)
+                .where(InputBlobs.digest.in_(sorted(digest for digest, c in counts.items() if c == count)))
+                .values(refcount=InputBlobs.refcount + count)
+            )
+
+    def _execute_upserts(self, session, model, rows: list, set_columns: Sequence[str]):
+        for start in range(0, len(rows), BULK_WRITE_CHUNK_ROWS):
+            stmt = pg_insert(model).values(rows[start:start + BULK_WRITE_CHUNK_ROWS])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[model.session_id, model.batch_index, model.partition_day],
+                set_={column: getattr(stmt.excluded, column) for column in set_columns},
+            )
+            session.execute(stmt)
+
+    def _body_rows(self, column: str, session_id: UUID, batches: Iterable[Tuple[int, bytes]]) -> list:
+        # A batch may only appear once per statement; the last write wins, as with separate calls
+        day = self._partition_day(session_id)
+        return [
+            {"session_id": session_id, "batch_index": batch_index, "partition_day": day,
+             column: self.codec.compress(body), "codec": self.codec.name}
+            for batch_index, body in dict(batches).items()
+        ]
+
+    def _upsert_batches(self, model, column: str, session_id: UUID, batches: Iterable[Tuple[int, bytes]]):
+        batches = dict(batches)
+        if not batches:
+            return
+        with Session(self.engine) as session:
+            try:
+                self._execute_upserts(session, model, self._body_rows(column, session_id, batches), [column, "codec"])
                 session.commit()
+                logging.info(f"Upserted {column} for session_id: {session_id}, batches: {len(batches)}")
             except SQLAlchemyError as e:
-                logging.error(f"Error writing outputs for session_id {session_id}, batch_index {batch_index}: {e}")
+                logging.error(f"Error writing {column} for session_id {session_id}, batches {list(batches)}: {e}")
                 session.rollback()
     
-    def get_inputs_from_session(self, session_id: UUID) -> list[bytes] | None:
+    @timed_method
+    def iter_inputs_from_session(
+        self, session_id: UUID, columns: Sequence[str] = ("inputs",), yield_per: int = RESTORE_YIELD_PER_ROWS
+    ) -> Iterator:
         """
-        Read inputs from the database for a given session_id.
-        Returns a list of inputs as bytes if found, otherwise None.
+        Stream the inputs of a session ordered by batch_index, `yield_per` rows at a time
+        from a server-side cursor. Yields the value of the single requested column, or a row
+        with the requested columns (e.g. ("batch_index", "inputs")).
         """
-        with Session(self.engine) as session:
-            try:
-                stmt = select(ModelInputs).where(ModelInputs.session_id == session_id)
-                results = session.execute(stmt).scalars().all()
-
-                if results:
-                    logging.info(f"Inputs found for session_id: {session_id}")
-                    return [result.inputs for result in results]
-                else:
-                    logging.info(f"No inputs found for session_id: {session_id}")
-                    return []
-            except SQLAlchemyError as e:
-                logging.error(f"Error reading inputs for session_id {session_id}: {e}")
-                return None
-        
-            
+        yield from self._iter_session_rows(ModelInputs, "inputs", session_id, columns, yield_per)
 
-    def get_outputs_from_session(self, session_id: UUID) -> list[bytes] | None:
+    @timed_method
+    def iter_outputs_from_session(
+        self, session_id: UUID, columns: Sequence[str] = ("outputs",), yield_per: int = RESTORE_YIELD_PER_ROWS
+    ) -> Iterator:
         """
-        Read outputs from the database for a given session_id.
-        Returns a list of outputs as bytes if found, otherwise None.
+        Stream the outputs of a session ordered by batch_index, `yield_per` rows at a time
+        from a server-side cursor. Yields the value of the single requested column, or a row
+        with the requested columns.
         """
-        with Session(self.engine) as session:
-            try:
-                stmt = select(ModelOutputs).where(ModelOutputs.session_id == session_id)
-                results = session.execute(stmt).scalars().all()
+        yield from self._iter_session_rows(ModelOutputs, "outputs", session_id, columns, yield_per)
 
-                if results:
-                    logging.info(f"Outputs found for session_id: {session_id}")
-                    return [result.outputs for result in results]
-                else:
-                    logging.info(f"No outputs found for session_id: {session_id}")
-                    return []
-            except SQLAlchemyError as e:
-                logging.error(f"Error reading outputs for session_id {session_id}: {e}")
-                return None
-                
-            
-        
-
-      
+    def _stored_body(self, model, column: str):
+        """Expressions for a row's stored body and the codec to decode it with; deduplicated inputs live in input_blobs."""
+        if model is ModelInputs:
+            return (
+                func.coalesce(InputBlobs.body, ModelInputs.inputs).label(column),
+                func.coalesce(InputBlobs.codec, ModelInputs.codec).label("codec"),
+            )
+        return getattr(model, column), model.codec
 
+    def _join_blobs(self, stmt, model):
+        if model is ModelInputs:
+            return stmt.select_from(ModelInputs).outerjoin(InputBlobs, InputBlobs.digest == ModelInputs.digest)
+        return stmt
 
-  
\ No newline at end of file
+    def _iter_session_rows(self, model, body_column: str, session_id: UUID, columns: Sequence[str], yield_per: int):
+        # The body is decoded with its row's codec, selected after the requested columns
+        body_position = list(columns).index(body_column) if body_column in columns else None
+        body, codec = self._stored_body(model, body_column)
+        selected = [body if column == body_column else getattr(model, column) for column in columns]
+        if body_position is not None:
+            selected.append(codec)
+        row_type = namedtuple(f"{model.__name__}Row", columns) if len(columns) > 1 else None
+        stmt = (
+            self._join_blobs(select(*selected), model)
+            .where(model.session_id == session_id)
+            .order_by(model.batch_index)
+            .execution_options(yield_per=yield_per)
+        )
+        with Session(self.engine) as session:
+            try:
+                rows = 0
+                for row in session.execute(stmt):
+                    rows += 1
+                    values = list(row[:len(columns)])
+                    if body_position is not None:
+                        values[body_position] = decompress(row[-1], values[body_position])
+                    yield values[0] if row_type is None else row_type(*values)
+                logging.info(f"Streamed {rows} {model.__tablename__} rows for session_id: {session_id}")
+            except SQLAlchemyError as e:
+                # A partial restore would silently lose batches
+                logging.error(f"Error streaming {model.__tablename__} for session_id {session_id}: {e}")
+                raise
@@ -0,0 +1,121 @@
+import datetime
+import logging
+from typing import Callable, List, NamedTuple, Sequence
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, insert, select, text
+
+from src.database import partitions
+from src.lib.db_engine import Base
+# Every model must be imported for create_all to know its table
+from src.models.input_blobs import InputBlobs  # noqa: F401
+from src.models.inputs import ModelInputs
+from src.models.outputs import ModelOutputs
+from src.models.scores import Scores  # noqa: F401
+from src.models.stored_sessions import StoredSessions  # noqa: F401
+
+# Serializes migrations between server replicas starting at the same time
+MIGRATION_LOCK_ID = 0x6D696772
+
+# Kept out of Base.metadata: it records which migrations ran, including the one creating the schema
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(64), nullable=False),
+    Column("applied_at", DateTime, default=datetime.datetime.utcnow),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    # Called with a connection inside the migration's transaction, the date of today and DB_PARTITION_DAYS
+    apply: Callable
+
+
+def _create_tables(connection, today, partition_days):
+    # Tables that already exist (deployments from before migrations) are left to the next migrations
+    Base.metadata.create_all(bind=connection)
+
+
+def _add_codec_and_digest_columns(connection, today, partition_days):
+    if connection.dialect.name != "postgresql":
+        return
+    # Rows written before these columns existed are uncompressed and keep their inputs inline
+    for model in (ModelInputs, ModelOutputs):
+        connection.execute(text(
+            f"ALTER TABLE {model.__tablename__} "
+            "ADD COLUMN IF NOT EXISTS codec VARCHAR(16) NOT NULL DEFAULT 'none'"
+        ))
+    connection.execute(text("ALTER TABLE model_inputs ADD COLUMN IF NOT EXISTS digest VARCHAR(64)"))
+
+
+def _partition_batch_tables(connection, today, partition_days):
+    if connection.dialect.name != "postgresql":
+        return
+    for model in (ModelInputs, ModelOutputs):
+        if not partitions.is_partitioned(connection, model.__tablename__):
+            partitions.convert_to_partitioned(connection, model.__table__, today, partition_days)
+
+
+def _add_processed_batches_column(connection, today, partition_days):
+    if connection.dialect.name != "postgresql":
+        return
+    # NULL on existing sessions: which of their batches were processed is unknown
+    connection.execute(text("ALTER TABLE scores ADD COLUMN IF NOT EXISTS processed_batches INTEGER[]"))
+
+
+def _add_class_scores_column(connection, today, partition_days):
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text("ALTER TABLE scores ADD COLUMN IF NOT EXISTS class_scores BYTEA"))
+
+
+def _add_samples_counter_column(connection, today, partition_days):
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text("ALTER TABLE scores ADD COLUMN IF NOT EXISTS samples_counter INTEGER NOT NULL DEFAULT 0"))
+
+
+# Append new migrations with the next version; never edit one that has shipped
+MIGRATIONS = (
+    Migration(1, "create_tables", _create_tables),
+    Migration(2, "add_codec_and_digest_columns", _add_codec_and_digest_columns),
+    Migration(3, "partition_batch_tables", _partition_batch_tables),
+    Migration(4, "add_processed_batches_column", _add_processed_batches_column),
+    Migration(5, "add_class_scores_column", _add_class_scores_column),
+    Migration(6, "add_samples_counter_column", _add_samples_counter_column),
+)
+
+
+def migrate(engine, partition_days: int = 1, today: datetime.date = None, migrations: Sequence[Migration] = MIGRATIONS) -> List[int]:
+    """
+    Bring the schema up to date; run once when the server starts, before any
+    session. Each pending migration runs in its own transaction together with
+    its schema_migrations row, under an advisory lock on PostgreSQL so that
+    concurrent replicas apply it once. Then the partitions of the current and
+    coming days are created. Returns the versions applied. Raises on error.
+    """
+    today = today or datetime.datetime.utcnow().date()
+    postgresql = engine.dialect.name == "postgresql"
+    with engine.begin() as connection:
+        if postgresql:
+            connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        schema_migrations.create(connection, checkfirst=True)
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        with engine.begin() as connection:
+            if postgresql:
+                connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            done = connection.execute(
+                select(schema_migrations.c.version).where(schema_migrations.c.version == migration.version)
+            ).first()
+            if done:
+                continue
+            migration.apply(connection, today, partition_days)
+            connection.execute(insert(schema_migrations).values(version=migration.version, name=migration.name))
+        applied.append(migration.version)
+        logging.info(f"action: migrate | result: success | version: {migration.version} | name: {migration.name}")
+    if postgresql:
+        partitions.ensure_partitions(engine, today, partition_days)
+    return applied
@@ -0,0 +1,139 @@
+import datetime
+import logging
+import re
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import text
+
+# Tables partitioned by RANGE (partition_day); a range of one holds the same sessions as the other's
+PARTITIONED_TABLES = ("model_inputs", "model_outputs")
+EPOCH = datetime.date(1970, 1, 1)
+# Ranges created ahead of the current one, so sessions starting after midnight find their partition
+PARTITIONS_AHEAD = 2
+# Dropping a partition locks its parent; give up (and retry on the next run) rather than queue writes behind it
+DROP_LOCK_TIMEOUT = "5s"
+# Serializes partition DDL between the processes starting at the same time
+PARTITION_DDL_LOCK_ID = 0x70617274
+LEGACY_SUFFIX = "_legacy"
+
+_BOUNDS = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+class Partition(NamedTuple):
+    name: str
+    # None for MINVALUE/MAXVALUE
+    lower: Optional[datetime.date]
+    upper: Optional[datetime.date]
+
+    def sibling(self, table: str, partitioned_table: str) -> str:
+        """Name of the partition of `table` covering the same range."""
+        return table + self.name[len(partitioned_table):]
+
+
+def partition_range(day: datetime.date, width_days: int) -> tuple:
+    """[lower, upper) of the range holding `day`; ranges of `width_days` days are aligned on 1970-01-01."""
+    offset = (day - EPOCH).days // width_days * width_days
+    lower = EPOCH + datetime.timedelta(days=offset)
+    return lower, lower + datetime.timedelta(days=width_days)
+
+
+def partition_name(table: str, lower: datetime.date) -> str:
+    return f"{table}_p{lower:%Y%m%d}"
+
+
+def _bound_value(value: str) -> Optional[datetime.date]:
+    value = value.strip()
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.date.fromisoformat(value.strip("'"))
+
+
+def parse_bounds(bound_expression: str) -> Optional[tuple]:
+    """(lower, upper) of a pg_get_expr(relpartbound) expression; None for the DEFAULT partition."""
+    match = _BOUNDS.search(bound_expression)
+    if match is None:
+        return None
+    return _bound_value(match.group(1)), _bound_value(match.group(2))
+
+
+def is_partitioned(connection, table: str) -> bool:
+    return bool(connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"),
+        {"table": table},
+    ).scalar())
+
+
+def list_partitions(connection, table: str) -> List[Partition]:
+    """Range partitions of `table`, oldest first; the DEFAULT partition, if any, is left out."""
+    rows = connection.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table)"
+    ), {"table": table}).all()
+    partitions = []
+    for name, expression in rows:
+        bounds = parse_bounds(expression or "")
+        if bounds is not None:
+            partitions.append(Partition(name, *bounds))
+    return sorted(partitions, key=lambda p: (p.lower is not None, p.lower or EPOCH))
+
+
+def create_partitions(connection, today: datetime.date, width_days: int, ahead: int = PARTITIONS_AHEAD) -> List[str]:
+    """Create the partitions of the range holding `today` and of the `ahead` next ones, where missing."""
+    created = []
+    for table in PARTITIONED_TABLES:
+        existing = {partition.name for partition in list_partitions(connection, table)}
+        for step in range(ahead + 1):
+            lower, upper = partition_range(today + datetime.timedelta(days=step * width_days), width_days)
+            name = partition_name(table, lower)
+            if name in existing:
+                continue
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+            ))
+            created.append(name)
+    return created
+
+
+def ensure_partitions(engine, today: datetime.date, width_days: int) -> List[str]:
+    """create_partitions in its own transaction, serialized with the other processes doing the same."""
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_DDL_LOCK_ID})
+        created = create_partitions(connection, today, width_days)
+    if created:
+        logging.info(f"action: create_partitions | result: success | partitions: {created}")
+    return created
+
+
+def convert_to_partitioned(connection, table, today: datetime.date, width_days: int):
+    """
+    Turn an existing unpartitioned `table` (a SQLAlchemy Table) into the
+    partitioned one: the old table gets partition_day = 1970-01-01 and the
+    three-column primary key, and is attached as the `<table>_legacy`
+    partition of every day before the current range. Adding a column with a
+    constant default does not rewrite the table, rebuilding the primary key
+    and validating the attached range each read it once.
+    """
+    name = table.name
+    legacy = name + LEGACY_SUFFIX
+    lower, _ = partition_range(today, width_days)
+    logging.warning(f"action: partition_table | table: {name} | legacy_partition: {legacy} | before: {lower}")
+    for statement in (
+        f"ALTER TABLE {name} RENAME CONSTRAINT {name}_pkey TO {legacy}_pkey",
+        f"ALTER TABLE {name} RENAME TO {legacy}",
+        f"ALTER TABLE {legacy} ADD COLUMN IF NOT EXISTS partition_day DATE NOT NULL DEFAULT DATE '{EPOCH.isoformat()}'",
+        f"ALTER TABLE {legacy} DROP CONSTRAINT {legacy}_pkey, "
+        f"ADD CONSTRAINT {legacy}_pkey PRIMARY KEY (session_id, batch_index, partition_day)",
+    ):
+        connection.execute(text(statement))
+    table.create(connection)
+    connection.execute(text(
+        f"ALTER TABLE {name} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{lower.isoformat()}')"
+    ))
+
+
+def drop_partition(connection, table: str, partition: str):
+    """Detach a partition from its table and drop it; runs under DROP_LOCK_TIMEOUT."""
+    connection.execute(text(f"SET LOCAL lock_timeout = '{DROP_LOCK_TIMEOUT}'"))
+    connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {partition}"))
+    connection.execute(text(f"DROP TABLE {partition}"))
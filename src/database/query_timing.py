@@ -0,0 +1,139 @@
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from src.lib.metrics import DB_QUERY_SECONDS, DB_SLOW_QUERIES_TOTAL
+
+_current_method = contextvars.ContextVar("db_method", default="other")
+
+MAX_LOGGED_STATEMENT_CHARS = 500
+
+
+@contextmanager
+def db_method(name: str):
+    """Attribute the statements executed inside the block to `name`."""
+    token = _current_method.set(name)
+    try:
+        yield
+    finally:
+        _current_method.reset(token)
+
+
+def timed_method(func):
+    """Decorator for Database methods: their statements are grouped under the method's name."""
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            # Statements run while the generator is resumed, so the name is set around each step
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    with db_method(func.__name__):
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                    yield item
+            finally:
+                generator.close()
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with db_method(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _value_size(value) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_value_size(v) for v in value)
+    return 8
+
+
+def parameter_sizes(parameters, executemany: bool = False, names=None) -> dict:
+    """
+    Row count, total size and largest parameter of a statement, without the
+    values themselves. `names` labels positional parameters.
+    """
+    rows = parameters if executemany else [parameters]
+    total, largest, largest_name = 0, 0, None
+    for row in rows or []:
+        items = row.items() if isinstance(row, dict) else enumerate(row or [])
+        for name, value in items:
+            if names and isinstance(name, int) and name < len(names):
+                name = names[name]
+            size = _value_size(value)
+            total += size
+            if size > largest:
+                largest, largest_name = size, name
+    return {"rows": len(rows or []), "total_bytes": total, "largest": largest_name, "largest_bytes": largest}
+
+
+class QueryTimer:
+    """
+    Engine event hooks that time every statement. Timings go to the
+    calibration_db_query_seconds histogram, labelled with the Database method
+    that issued them; statements slower than `slow_query_seconds` are logged
+    with the sizes of their parameters.
+    """
+
+    def __init__(self, slow_query_seconds: float = 0.5, logger=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.logger = logger or logging.getLogger("slow-queries")
+
+    def install(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._record(conn, statement, parameters, executemany, context, failed=False)
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start_time"):
+            context = exception_context.execution_context
+            self._record(
+                conn, exception_context.statement, exception_context.parameters,
+                context.executemany if context else False, context, failed=True,
+            )
+
+    def _record(self, conn, statement, parameters, executemany, context, failed):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        method = _current_method.get()
+        DB_QUERY_SECONDS.observe(elapsed, method=method)
+        if elapsed < self.slow_query_seconds:
+            return
+        DB_SLOW_QUERIES_TOTAL.inc(method=method)
+        compiled = getattr(context, "compiled", None)
+        sizes = parameter_sizes(parameters, executemany, names=getattr(compiled, "positiontup", None))
+        self.logger.warning(
+            f"action: slow_query | method: {method} | duration_ms: {elapsed * 1000:.1f} | "
+            f"failed: {failed} | rows: {sizes['rows']} | params_bytes: {sizes['total_bytes']} | "
+            f"largest_param: {sizes['largest']} ({sizes['largest_bytes']} bytes) | "
+            f"statement: {' '.join((statement or '').split())[:MAX_LOGGED_STATEMENT_CHARS]}"
+        )
+
+
+def instrument_engine(engine, slow_query_seconds: float) -> QueryTimer:
+    """Install a QueryTimer on the engine, once; later calls only update the threshold."""
+    timer = getattr(engine, "_query_timer", None)
+    if timer is None:
+        timer = QueryTimer(slow_query_seconds)
+        timer.install(engine)
+        engine._query_timer = timer
+    timer.slow_query_seconds = slow_query_seconds
+    return timer
@@ -0,0 +1,51 @@
+import logging
+import threading
+import time
+
+
+class RetentionJob:
+    """
+    Runs in the server process: every `interval_seconds` it creates the
+    partitions of the coming days and removes the batches of sessions
+    finished more than `retention_days` ago (Database.purge_expired). A
+    failed run is logged and retried on the next one.
+    """
+
+    def __init__(self, database, retention_days: float, abandoned_days: float = 0, interval_seconds: float = 3600, logger=None):
+        self.database = database
+        self.retention_days = retention_days
+        self.abandoned_days = abandoned_days
+        self.interval_seconds = interval_seconds
+        self.logger = logger or logging.getLogger("retention")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                self.logger.error(f"action: retention_purge | result: fail | error: {e}")
+            if self._stop.wait(self.interval_seconds):
+                return
+
+    def run_once(self) -> int:
+        """Create the coming partitions and purge expired sessions; returns how many sessions or partitions went."""
+        self.database.ensure_partitions()
+        if not self.retention_days:
+            return 0
+        start = time.perf_counter()
+        purged = self.database.purge_expired(self.retention_days, self.abandoned_days)
+        self.logger.info(
+            f"action: retention_purge | result: success | purged: {purged} | "
+            f"duration_ms: {(time.perf_counter() - start) * 1000:.1f}"
+        )
+        return purged
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
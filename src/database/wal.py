@@ -0,0 +1,278 @@
+import json
+import logging
+import os
+import pickle
+import shutil
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, NamedTuple, Tuple
+
+from src.lib.metrics import WAL_CHECKPOINT_SECONDS, WAL_FSYNC_SECONDS
+
+# Record kinds
+INPUTS = "inputs"
+OUTPUTS = "outputs"
+STATE = "state"
+
+# Payload length and crc32 of the payload
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".wal"
+CHECKPOINT_FILE = "checkpoint.json"
+# Records applied to the database per checkpoint transaction
+CHECKPOINT_MAX_RECORDS = 1000
+
+
+class WalPosition(NamedTuple):
+    segment: int
+    offset: int
+
+
+def _fsync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """
+    Append-only log of one session's database writes, in segment files of
+    about `segment_bytes`. Appends are buffered; `sync` makes everything
+    appended so far durable with a single fsync, so a group of messages costs
+    one fsync. The checkpoint file records the position up to which records
+    have been applied to the database; segments before it are deleted.
+
+    On open, a torn record at the end of the last segment (a crash in the
+    middle of a write) is truncated away.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, logger=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.logger = logger or logging.getLogger("wal")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoint_position = self._read_checkpoint()
+
+        segments = self._segments()
+        segment = segments[-1] if segments else self.checkpoint_position.segment
+        path = self._segment_path(segment)
+        end = self._valid_end(path) if segments else 0
+        self._file = open(path, "ab")
+        if self._file.tell() != end:
+            self.logger.warning(f"action: wal_recover | segment: {segment} | truncated_bytes: {self._file.tell() - end}")
+            self._file.truncate(end)
+            self._file.seek(end)
+        os.fsync(self._file.fileno())
+        _fsync_directory(directory)
+        self._position = WalPosition(segment, end)
+        self.synced_position = self._position
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _segments(self) -> list:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def _read_checkpoint(self) -> WalPosition:
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as checkpoint:
+                data = json.load(checkpoint)
+            return WalPosition(data["segment"], data["offset"])
+        except FileNotFoundError:
+            return WalPosition(0, 0)
+
+    def _valid_end(self, path: str) -> int:
+        """Offset after the last complete record of a segment."""
+        end = 0
+        for end, _ in self._read_segment(path, 0):
+            pass
+        return end
+
+    def _read_segment(self, path: str, offset: int) -> Iterator[Tuple[int, bytes]]:
+        """(offset after the record, payload) of the complete records of a segment, from `offset`."""
+        with open(path, "rb") as segment:
+            segment.seek(offset)
+            while True:
+                header = segment.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = segment.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                offset += RECORD_HEADER.size + length
+                yield offset, payload
+
+    def append(self, kind: str, batch_index: int, data) -> WalPosition:
+        """Buffer a record; it is durable once `sync` returns."""
+        payload = pickle.dumps((kind, batch_index, data), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._position.offset >= self.segment_bytes:
+                self._roll()
+            self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            self._position = WalPosition(self._position.segment, self._position.offset + RECORD_HEADER.size + len(payload))
+            return self._position
+
+    def _roll(self):
+        self._sync_locked()
+        self._file.close()
+        segment = self._position.segment + 1
+        self._file = open(self._segment_path(segment), "ab")
+        _fsync_directory(self.directory)
+        self._position = self.synced_position = WalPosition(segment, 0)
+
+    def sync(self):
+        """Make every appended record durable."""
+        with self._lock:
+            self._sync_locked()
+
+    def _sync_locked(self):
+        if self.synced_position == self._position:
+            return
+        with WAL_FSYNC_SECONDS.time():
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.synced_position = self._position
+
+    def records(self, start: WalPosition, end: WalPosition, limit: int = None) -> Iterator[Tuple[WalPosition, str, int, object]]:
+        """(position after the record, kind, batch_index, data) of the records between two positions."""
+        count = 0
+        for segment in self._segments():
+            if segment < start.segment or segment > end.segment:
+                continue
+            offset = start.offset if segment == start.segment else 0
+            for offset, payload in self._read_segment(self._segment_path(segment), offset):
+                if segment == end.segment and offset > end.offset:
+                    return
+                kind, batch_index, data = pickle.loads(payload)
+                yield WalPosition(segment, offset), kind, batch_index, data
+                count += 1
+                if limit and count >= limit:
+                    return
+
+    def save_checkpoint(self, position: WalPosition):
+        """Record that everything up to `position` is in the database and drop the segments before it."""
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w") as checkpoint:
+            json.dump({"segment": position.segment, "offset": position.offset}, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(path + ".tmp", path)
+        _fsync_directory(self.directory)
+        self.checkpoint_position = position
+        for segment in self._segments():
+            if segment < position.segment:
+                os.remove(self._segment_path(segment))
+
+    @property
+    def pending(self) -> bool:
+        """Whether durable records are waiting to be checkpointed."""
+        return self.checkpoint_position != self.synced_position
+
+    def close(self):
+        with self._lock:
+            self._sync_locked()
+            self._file.close()
+
+    def remove(self):
+        """Close the log and delete its directory; only once everything is checkpointed."""
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class WalCheckpointer:
+    """
+    Applies a session's durable WAL records to the database in the
+    background, every `interval_seconds`, one transaction of at most
+    CHECKPOINT_MAX_RECORDS records at a time. A failed checkpoint is retried
+    on the next run; the records stay in the log until they are applied.
+    """
+
+    def __init__(self, wal: WriteAheadLog, database, session_id, interval_seconds: float = 1.0, logger=None):
+        self.wal = wal
+        self.database = database
+        self.session_id = session_id
+        self.interval_seconds = interval_seconds
+        self.logger = logger or logging.getLogger("wal")
+        self._apply_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="wal-checkpointer", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                self.logger.error(f"action: wal_checkpoint | result: fail | session_id: {self.session_id} | error: {e}")
+
+    def checkpoint(self) -> int:
+        """Apply every durable record not checkpointed yet; returns how many were applied."""
+        applied = 0
+        with self._apply_lock:
+            while self.wal.pending:
+                start = time.perf_counter()
+                inputs, outputs, state_updates = {}, {}, []
+                position = self.wal.checkpoint_position
+                records = 0
+                for position, kind, batch_index, data in self.wal.records(
+                    self.wal.checkpoint_position, self.wal.synced_position, limit=CHECKPOINT_MAX_RECORDS
+                ):
+                    records += 1
+                    if kind == INPUTS:
+                        inputs[batch_index] = data
+                    elif kind == OUTPUTS:
+                        outputs[batch_index] = data
+                    else:
+                        state_updates.append(data)
+                if records:
+                    self.database.apply_checkpoint(
+                        self.session_id, inputs.items(), outputs.items(), state_updates
+                    )
+                    WAL_CHECKPOINT_SECONDS.observe(time.perf_counter() - start)
+                else:
+                    # Only an empty tail of a rolled segment is left
+                    position = self.wal.synced_position
+                self.wal.save_checkpoint(position)
+                applied += records
+        if applied:
+            self.logger.info(f"action: wal_checkpoint | result: success | session_id: {self.session_id} | records: {applied}")
+        return applied
+
+    def stop(self):
+        """Stop the background runs and checkpoint what is left."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.checkpoint()
+
+
+class WalDatabase:
+    """
+    Database of a session whose writes go to its write-ahead log; the
+    checkpointer applies them to the wrapped Database later. Reads and every
+    other method reach the wrapped Database directly.
+    """
+
+    def __init__(self, database, wal: WriteAheadLog):
+        self._database = database
+        self._wal = wal
+
+    def write_inputs(self, session_id, inputs: bytes, batch_index: int):
+        self._wal.append(INPUTS, batch_index, inputs)
+
+    def write_outputs(self, session_id, outputs: bytes, batch_index: int):
+        self._wal.append(OUTPUTS, batch_index, outputs)
+
+    def update_session_state(self, session_id, updates):
+        self._wal.append(STATE, updates["batchs_counter"], updates)
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
@@ -9,6 +9,14 @@ class ClientManagerHandler:
         self.ch = ch
         self.delivery_tag = delivery_tag
 
+    @property
+    def session_id(self):
+        return self.process_handler.session_id
+
+    def request_profile(self, duration_seconds=None, output_format=None) -> bool:
+        """Ask the client manager to profile its session for a bounded window."""
+        return self.process_handler.request_profile(duration_seconds, output_format)
+
     def send_nack(self):
         """Send a negative acknowledgment for the client's message."""
         self.ch.basic_nack(delivery_tag=self.delivery_tag, requeue=True)
@@ -16,26 +16,153 @@ REPORTS_DIR = "reports/"
 CALIBRATION_LIMIT = 10
 UNCERTAINTY_LIMIT = 20
 
+
+def stage_sample_limits(calibration_samples: int, uncertainty_samples: int):
+    """
+    With calibration_samples set, the stages end after that many samples (calibration) and
+    uncertainty_samples samples in total (uncertainty estimation, twice the calibration by default)
+    instead of after the processed entries counted by the limits above, so they do not depend on the
+    clients' batch size or on coalescing. Setting only uncertainty_samples is rejected: the stage
+    would start after an unknown number of calibration samples and could end before its first entry.
+    """
+    if uncertainty_samples and not calibration_samples:
+        raise ValueError("UNCERTAINTY_SAMPLES requires CALIBRATION_SAMPLES to be set")
+    uncertainty_samples = uncertainty_samples or 2 * calibration_samples
+    if calibration_samples and uncertainty_samples <= calibration_samples:
+        raise ValueError("UNCERTAINTY_SAMPLES counts calibration samples too and must be greater than CALIBRATION_SAMPLES")
+    return calibration_samples, uncertainty_samples
+
+
+CALIBRATION_SAMPLES, UNCERTAINTY_SAMPLES = stage_sample_limits(
+    int(os.getenv("CALIBRATION_SAMPLES", "0")), int(os.getenv("UNCERTAINTY_SAMPLES", "0"))
+)
+CONTROL_EXCHANGE = "calibration_control_exchange"
+CONTROL_QUEUE_NAME = "calibration_control_queue"
+
 class ServerConfig:
     def __init__(self):
         self.pod_name = os.getenv("POD_NAME", "calibration-service") # or container name, but for k8s pods are better
         self.upper_bound_clients = int(os.getenv("UPPER_BOUND_CLIENTS", "100"))
         self.replica_id = int(os.getenv("REPLICA_ID", "1"))
         self.client_timeout_seconds = int(os.getenv("CLIENT_TIMEOUT_SECONDS", "60")) 
+        # "thread" runs a ClientManager thread per session, "process" a ClientManager process per session,
+        # "asyncio" drives every session from one event loop. Only threads and asyncio share broker connections
+        self.session_engine = os.getenv("SESSION_ENGINE", "thread")
+        # 0 lets the executor pick its default size
+        self.session_executor_workers = int(os.getenv("SESSION_EXECUTOR_WORKERS", "0"))
+        # Prometheus endpoint (GET /metrics) of the server process; 0 disables it
+        self.metrics_port = int(os.getenv("METRICS_PORT", "9100"))
+        # How often ClientManager processes push their metrics to the server process
+        self.metrics_push_interval_seconds = float(os.getenv("METRICS_PUSH_INTERVAL_SECONDS", "5"))
+        # On-demand session profiles (control message or SIGUSR1 to a ClientManager process)
+        self.profile_dir = os.getenv("PROFILE_DIR", "profiles")
+        self.profile_default_seconds = float(os.getenv("PROFILE_DEFAULT_SECONDS", "30"))
+        self.profile_max_seconds = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+        self.profile_interval_seconds = float(os.getenv("PROFILE_INTERVAL_SECONDS", "0.005"))
+        # "collapsed" (flame graphs) or "pstats"
+        self.profile_format = os.getenv("PROFILE_FORMAT", "collapsed")
+        # Decoded arrays a session holds beyond SESSION_MEMORY_BUDGET_BYTES are moved to memory-mapped
+        # files under SPILL_DIR; either left unset disables spilling
+        self.spill_dir = os.getenv("SPILL_DIR", "")
+        self.session_memory_budget_bytes = int(os.getenv("SESSION_MEMORY_BUDGET_BYTES", "0"))
+        # Joined batches are run through the calibration stages in micro-batches of at least
+        # COALESCE_TARGET_SAMPLES samples, or after COALESCE_MAX_DELAY_SECONDS; 0 processes each batch alone
+        self.coalesce_target_samples = int(os.getenv("COALESCE_TARGET_SAMPLES", "0"))
+        self.coalesce_max_delay_seconds = float(os.getenv("COALESCE_MAX_DELAY_SECONDS", "1.0"))
 
 
 class MiddlewareConfig:
     def __init__(self):
+        # "rabbitmq", or "memory" for the in-process broker (single node, load testing)
+        self.transport = os.getenv("MIDDLEWARE_TRANSPORT", "rabbitmq")
         self.host = os.getenv("RABBITMQ_HOST", "rabbitmq")
         self.port = int(os.getenv("RABBITMQ_PORT", "5672"))
         self.username = os.getenv("RABBITMQ_USER", "guest")
         self.password = os.getenv("RABBITMQ_PASSWORD", "guest")
         self.max_retries = int(os.getenv("MAX_RETRIES", "3"))
+        # Sessions of a process multiplex their channels over a small pool of connections
+        self.max_shared_connections = int(os.getenv("RABBITMQ_MAX_CONNECTIONS", "4"))
+        self.sessions_per_connection = int(os.getenv("RABBITMQ_SESSIONS_PER_CONNECTION", "64"))
+        self.inputs_prefetch_count = int(os.getenv("INPUTS_PREFETCH_COUNT", "4"))
+        self.outputs_prefetch_count = int(os.getenv("OUTPUTS_PREFETCH_COUNT", "16"))
+        self.ack_batch_size = int(os.getenv("ACK_BATCH_SIZE", "8"))
+        self.ack_flush_interval_seconds = float(os.getenv("ACK_FLUSH_INTERVAL_SECONDS", "0.5"))
+        # 0 disables the byte limit
+        self.inputs_max_unacked_bytes = int(os.getenv("INPUTS_MAX_UNACKED_BYTES", str(64 * 1024 * 1024)))
+        self.outputs_max_unacked_bytes = int(os.getenv("OUTPUTS_MAX_UNACKED_BYTES", "0"))
+        # 0 disables lag sampling
+        self.lag_report_interval_seconds = float(os.getenv("LAG_REPORT_INTERVAL_SECONDS", "30"))
+
+class ConnectionsServiceConfig:
+    def __init__(self):
+        self.url = os.getenv("CONNECTIONS_SERVICE_URL", "http://connections-service:8000")
+        self.connect_timeout_seconds = float(os.getenv("CONNECTIONS_SERVICE_CONNECT_TIMEOUT_SECONDS", "2"))
+        self.read_timeout_seconds = float(os.getenv("CONNECTIONS_SERVICE_READ_TIMEOUT_SECONDS", "5"))
+        self.max_retries = int(os.getenv("CONNECTIONS_SERVICE_MAX_RETRIES", "3"))
+        self.backoff_factor = float(os.getenv("CONNECTIONS_SERVICE_BACKOFF_FACTOR", "0.5"))
+        self.pool_size = int(os.getenv("CONNECTIONS_SERVICE_POOL_SIZE", "4"))
+
+class DatabaseConfig:
+    def __init__(self):
+        # Statements slower than this are logged with their parameter sizes
+        self.slow_query_seconds = float(os.getenv("DB_SLOW_QUERY_SECONDS", "0.5"))
+        # Compression of stored inputs/outputs: "none", "zlib", "lz4" or "zstd" (the last two
+        # fall back to zlib when their package is not installed). Rows keep the codec they were written with.
+        self.codec = os.getenv("DB_CODEC", "none")
+        level = os.getenv("DB_CODEC_LEVEL", "")
+        self.codec_level = int(level) if level else None
+        # Store identical input batches once (input_blobs) and point session rows at them
+        self.dedup_inputs = os.getenv("DB_DEDUP_INPUTS", "false").lower() == "true"
+        # "full" stores each inputs message; "lean" stores it without images once the batch joined its
+        # predictions, and leaves it unacked until then
+        # (so they were forwarded to MLflow) and keeps labels, batch index and EOF flag, which is all a restore needs
+        self.inputs_persistence = os.getenv("DB_INPUTS_PERSISTENCE", "full")
+        # Local write-ahead log per session (empty disables it): writes are acked once fsynced
+        # there and checkpointed into the database in the background
+        self.wal_dir = os.getenv("WAL_DIR", "")
+        self.wal_segment_bytes = int(os.getenv("WAL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+        self.wal_checkpoint_interval_seconds = float(os.getenv("WAL_CHECKPOINT_INTERVAL_SECONDS", "1"))
+        # On PostgreSQL, model_inputs/model_outputs are partitioned by session start day, DB_PARTITION_DAYS per partition
+        self.partition_days = int(os.getenv("DB_PARTITION_DAYS", "1"))
+        # The server drops the batches of sessions finished (COMPLETED or TIMEOUT) more than DB_RETENTION_DAYS ago,
+        # checking every DB_RETENTION_INTERVAL_SECONDS; 0 keeps them forever. Sessions never marked finished
+        # count as finished DB_RETENTION_ABANDONED_DAYS after they started (0: never)
+        self.retention_days = float(os.getenv("DB_RETENTION_DAYS", "30"))
+        self.retention_abandoned_days = float(os.getenv("DB_RETENTION_ABANDONED_DAYS", "7"))
+        self.retention_interval_seconds = float(os.getenv("DB_RETENTION_INTERVAL_SECONDS", "3600"))
+        # Connection pool of each process (the server's, and each ClientManager process'); sessions and
+        # threads of a process share it. "queue" keeps up to DB_POOL_SIZE connections open (plus
+        # DB_POOL_MAX_OVERFLOW in bursts); "external" opens one per checkout, for PgBouncer in front
+        self.pool_mode = os.getenv("DB_POOL_MODE", "queue")
+        self.pool_size = int(os.getenv("DB_POOL_SIZE", "2"))
+        self.pool_max_overflow = int(os.getenv("DB_POOL_MAX_OVERFLOW", "3"))
+        self.pool_timeout_seconds = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+        # Connections older than this are replaced on checkout; -1 keeps them
+        self.pool_recycle_seconds = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+        self.pool_pre_ping = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+        # PostgreSQL max_connections (or the pooler's limit) to plan against; 0 skips the startup check
+        self.max_connections = int(os.getenv("DB_MAX_CONNECTIONS", "0"))
+
+class TracingConfig:
+    def __init__(self):
+        # "none", "file" (JSON lines at TRACING_FILE_PATH) or "otlp" (OTLP/JSON over HTTP)
+        self.exporter = os.getenv("TRACING_EXPORTER", "none")
+        # Fraction of batches traced, decided per (session_id, batch_index)
+        self.sample_rate = float(os.getenv("TRACING_SAMPLE_RATE", "0.01"))
+        self.file_path = os.getenv("TRACING_FILE_PATH", "traces/spans.jsonl")
+        self.otlp_endpoint = os.getenv("TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+        self.service_name = os.getenv("TRACING_SERVICE_NAME", "calibration-service")
+        # Spans beyond this many waiting for export are dropped
+        self.max_queue_size = int(os.getenv("TRACING_MAX_QUEUE_SIZE", "2048"))
+        self.export_interval_seconds = float(os.getenv("TRACING_EXPORT_INTERVAL_SECONDS", "2"))
 
 class GlobalConfig:
     def __init__(self):
         self.server_config = ServerConfig()
         self.middleware_config = MiddlewareConfig()
+        self.connections_service_config = ConnectionsServiceConfig()
+        self.tracing_config = TracingConfig()
+        self.database_config = DatabaseConfig()
         # self.mlflow_config = MlflowConfig()
         self.log_level = os.getenv("LOGGING_LEVEL", "INFO")
         self.email_sender = os.getenv("EMAIL_SENDER", "default_sender@example.com")
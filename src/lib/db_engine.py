@@ -1,9 +1,98 @@
+import logging
+import os
+import threading
+import time
 from typing import Optional
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import NullPool, QueuePool
+from src.lib.config import DatabaseConfig
+from src.lib.metrics import DB_POOL_CHECKED_OUT, DB_POOL_TIMEOUTS_TOTAL, DB_POOL_WAIT_SECONDS
 
 
 Base = declarative_base()
 
-def get_engine(database_url) -> Optional[create_engine]:
-    return create_engine(database_url, echo=False)
\ No newline at end of file
+# (database_url, pid) -> engine; a forked process builds its own instead of sharing its parent's sockets
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+class _TimedCheckout:
+    """Pool mixin timing how long a checkout waits for a connection (including opening one)."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            DB_POOL_TIMEOUTS_TOTAL.inc()
+            raise
+        finally:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedNullPool(_TimedCheckout, NullPool):
+    pass
+
+
+def _count_checkouts(engine: Engine):
+    event.listen(engine, "checkout", lambda dbapi_connection, record, proxy: DB_POOL_CHECKED_OUT.inc())
+    event.listen(engine, "checkin", lambda dbapi_connection, record: DB_POOL_CHECKED_OUT.dec())
+
+
+def _create_engine(database_url, config: DatabaseConfig) -> Engine:
+    if make_url(database_url).get_backend_name() == "sqlite":
+        return create_engine(database_url, echo=False)
+    if config.pool_mode == "external":
+        # An external pooler (PgBouncer) owns the connections: none is kept open between checkouts
+        engine = create_engine(database_url, echo=False, poolclass=TimedNullPool, pool_pre_ping=config.pool_pre_ping)
+    else:
+        engine = create_engine(
+            database_url,
+            echo=False,
+            poolclass=TimedQueuePool,
+            pool_size=config.pool_size,
+            max_overflow=config.pool_max_overflow,
+            pool_timeout=config.pool_timeout_seconds,
+            pool_recycle=config.pool_recycle_seconds,
+            pool_pre_ping=config.pool_pre_ping,
+        )
+    _count_checkouts(engine)
+    logging.info(
+        f"action: create_engine | pool_mode: {config.pool_mode} | pool_size: {config.pool_size} | "
+        f"max_overflow: {config.pool_max_overflow} | pre_ping: {config.pool_pre_ping}"
+    )
+    return engine
+
+
+def get_engine(database_url, database_config: DatabaseConfig = None) -> Optional[Engine]:
+    """
+    Engine for `database_url`, created once per process: every session and
+    thread of the process shares its connection pool (DB_POOL_* settings).
+    """
+    key = (database_url, os.getpid())
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = _create_engine(database_url, database_config or DatabaseConfig())
+    return engine
+
+
+def planned_connections(config) -> int:
+    """
+    Most PostgreSQL connections the server can open: one pool in the server
+    process, plus one per ClientManager process with SESSION_ENGINE=process.
+    With DB_POOL_MODE=external that is the pooler's limit, not the database's.
+    """
+    database_config = config.database_config
+    per_pool = database_config.pool_size + database_config.pool_max_overflow
+    processes = 1
+    if config.server_config.session_engine == "process":
+        processes += config.server_config.upper_bound_clients
+    return processes * per_pool
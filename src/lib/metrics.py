@@ -0,0 +1,386 @@
+import bisect
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metric:
+    """
+    Definition of a metric. Values live in the registry of the current
+    process, so definitions can be module-level and still be safe to use
+    from forked ClientManager processes.
+    """
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def describe(self) -> dict:
+        return {"type": self.type, "help": self.documentation, "labelnames": self.labelnames}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        get_registry().add(self, self._key(labels), amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        get_registry().add(self, self._key(labels), amount)
+
+    def dec(self, amount: float = 1, **labels):
+        get_registry().add(self, self._key(labels), -amount)
+
+    def set(self, value: float, **labels):
+        get_registry().set(self, self._key(labels), value)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        get_registry().observe(self, self._key(labels), value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def describe(self) -> dict:
+        return {**super().describe(), "buckets": self.buckets}
+
+
+class MetricsRegistry:
+    """Values of every metric recorded by one process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, dict] = {}
+
+    def _samples(self, metric: _Metric) -> dict:
+        entry = self._metrics.get(metric.name)
+        if entry is None:
+            entry = self._metrics[metric.name] = {**metric.describe(), "samples": {}}
+        return entry["samples"]
+
+    def add(self, metric: _Metric, key, amount: float):
+        with self._lock:
+            samples = self._samples(metric)
+            samples[key] = samples.get(key, 0) + amount
+
+    def set(self, metric: _Metric, key, value: float):
+        with self._lock:
+            self._samples(metric)[key] = value
+
+    def observe(self, metric: Histogram, key, value: float):
+        with self._lock:
+            samples = self._samples(metric)
+            sample = samples.get(key)
+            if sample is None:
+                sample = samples[key] = {"buckets": [0] * len(metric.buckets), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(metric.buckets, value)
+            if index < len(metric.buckets):
+                sample["buckets"][index] += 1
+            sample["sum"] += value
+            sample["count"] += 1
+
+    def snapshot(self) -> dict:
+        """Picklable copy of every value, to be merged or sent to another process."""
+        with self._lock:
+            return {
+                name: {
+                    **{k: v for k, v in entry.items() if k != "samples"},
+                    "samples": {
+                        key: dict(value, buckets=list(value["buckets"])) if isinstance(value, dict) else value
+                        for key, value in entry["samples"].items()
+                    },
+                }
+                for name, entry in self._metrics.items()
+            }
+
+
+def merge_snapshots(*snapshots, include_gauges: bool = True) -> dict:
+    """Sum counters, gauges and histogram buckets of several snapshots."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, entry in snapshot.items():
+            if entry["type"] == "gauge" and not include_gauges:
+                continue
+            target = merged.setdefault(name, {**{k: v for k, v in entry.items() if k != "samples"}, "samples": {}})
+            for key, value in entry["samples"].items():
+                if isinstance(value, dict):
+                    current = target["samples"].setdefault(
+                        key, {"buckets": [0] * len(value["buckets"]), "sum": 0.0, "count": 0}
+                    )
+                    current["buckets"] = [a + b for a, b in zip(current["buckets"], value["buckets"])]
+                    current["sum"] += value["sum"]
+                    current["count"] += value["count"]
+                else:
+                    target["samples"][key] = target["samples"].get(key, 0) + value
+    return merged
+
+
+def _format_labels(labelnames, key, extra=()) -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, key)] + [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def render(snapshot: dict) -> str:
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name in sorted(snapshot):
+        entry = snapshot[name]
+        labelnames = entry["labelnames"]
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['type']}")
+        for key in sorted(entry["samples"]):
+            value = entry["samples"][key]
+            if entry["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(labelnames, key)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(entry["buckets"], value["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labelnames, key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labelnames, key, [('le', '+Inf')])} {value['count']}")
+            lines.append(f"{name}_sum{_format_labels(labelnames, key)} {_format_value(value['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labelnames, key)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+_registry: Optional[MetricsRegistry] = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> MetricsRegistry:
+    """Return the registry of the current process; a forked process starts with an empty one."""
+    global _registry, _registry_pid
+    if _registry is not None and _registry_pid == os.getpid():
+        return _registry
+    with _registry_lock:
+        if _registry is None or _registry_pid != os.getpid():
+            _registry = MetricsRegistry()
+            _registry_pid = os.getpid()
+        return _registry
+
+
+class MetricsPusher:
+    """
+    Periodically sends the snapshot of a ClientManager process to the Server
+    process through a multiprocessing queue. The last push is marked final so
+    the collector can fold the process' totals and drop its gauges.
+    """
+
+    def __init__(self, metrics_queue, interval_seconds: float = 5.0, logger=None):
+        self.metrics_queue = metrics_queue
+        self.interval_seconds = interval_seconds
+        self.logger = logger or logging.getLogger("metrics-pusher")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-pusher", daemon=True)
+
+    def _push(self, final=False):
+        try:
+            self.metrics_queue.put((os.getpid(), get_registry().snapshot(), final))
+        except Exception as e:
+            self.logger.warning(f"action: push_metrics | result: fail | error: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            self._push()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._push(final=True)
+
+
+class MetricsCollector:
+    """
+    Aggregates the metrics of the Server process with the snapshots pushed by
+    ClientManager processes. Live processes contribute their latest snapshot;
+    finished ones are folded into a retired total (without their gauges).
+    A process that has not pushed for `stale_after_seconds` (it crashed or was
+    killed before its final push) keeps its counters but no longer its gauges,
+    until it pushes again.
+    """
+
+    def __init__(self, metrics_queue, logger=None, stale_after_seconds: float = 15.0):
+        self.metrics_queue = metrics_queue
+        self.logger = logger or logging.getLogger("metrics-collector")
+        self.stale_after_seconds = stale_after_seconds
+        self._lock = threading.Lock()
+        self._live: Dict[int, Tuple[float, dict]] = {}
+        self._retired: dict = {}
+        self._thread = threading.Thread(target=self._run, name="metrics-collector", daemon=True)
+
+    def receive(self, pid: int, snapshot: dict, final: bool = False):
+        with self._lock:
+            if final:
+                self._live.pop(pid, None)
+                self._retired = merge_snapshots(self._retired, snapshot, include_gauges=False)
+            else:
+                self._live[pid] = (time.monotonic(), snapshot)
+
+    def _run(self):
+        while True:
+            message = self.metrics_queue.get()
+            if message is None:
+                break
+            try:
+                self.receive(*message)
+            except Exception as e:
+                self.logger.error(f"action: collect_metrics | result: fail | error: {e}")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.metrics_queue.put(None)
+        self._thread.join()
+
+    def snapshot(self) -> dict:
+        oldest = time.monotonic() - self.stale_after_seconds
+        with self._lock:
+            live = [snapshot for received_at, snapshot in self._live.values() if received_at >= oldest]
+            stale = [snapshot for received_at, snapshot in self._live.values() if received_at < oldest]
+            retired = self._retired
+        return merge_snapshots(
+            get_registry().snapshot(), retired, *live, merge_snapshots(*stale, include_gauges=False)
+        )
+
+    def render(self) -> str:
+        return render(self.snapshot())
+
+
+class MetricsServer:
+    """Serves the collector's metrics on GET /metrics."""
+
+    def __init__(self, collector: MetricsCollector, host: str = "0.0.0.0", port: int = 9100, logger=None):
+        self.collector = collector
+        self.logger = logger or logging.getLogger("metrics-server")
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler_class(self):
+        collector = self.collector
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = collector.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+        self.logger.info(f"Serving metrics on port {self.port}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+# Pipeline metrics
+
+MESSAGES_TOTAL = Counter("calibration_messages_total", "Messages received by sessions", ("kind",))
+MESSAGE_BYTES_TOTAL = Counter("calibration_message_bytes_total", "Bytes of messages received by sessions", ("kind",))
+MESSAGE_DECODE_SECONDS = Histogram(
+    "calibration_message_decode_seconds", "Time to parse and decode a message", ("kind",)
+)
+BATCH_JOIN_WAIT_SECONDS = Histogram(
+    "calibration_batch_join_wait_seconds", "Time between the first and the second half of a batch arriving"
+)
+PROCESS_ENTRY_SECONDS = Histogram(
+    "calibration_process_entry_seconds", "UtraceCalculator.process_entry time by calibration stage", ("stage",)
+)
+DB_WRITE_SECONDS = Histogram("calibration_db_write_seconds", "Database write latency", ("operation",))
+DB_QUERY_SECONDS = Histogram("calibration_db_query_seconds", "SQL statement latency by Database method", ("method",))
+DB_SLOW_QUERIES_TOTAL = Counter(
+    "calibration_db_slow_queries_total", "SQL statements slower than DB_SLOW_QUERY_SECONDS", ("method",)
+)
+WAL_FSYNC_SECONDS = Histogram("calibration_wal_fsync_seconds", "Write-ahead log group fsync latency")
+WAL_CHECKPOINT_SECONDS = Histogram(
+    "calibration_wal_checkpoint_seconds", "Time to apply a group of write-ahead log records to the database"
+)
+DB_POOL_CHECKED_OUT = Gauge("calibration_db_pool_checked_out", "Database connections checked out of the pools")
+DB_POOL_WAIT_SECONDS = Histogram(
+    "calibration_db_pool_wait_seconds", "Time to get a connection from the pool, including opening one"
+)
+DB_POOL_TIMEOUTS_TOTAL = Counter(
+    "calibration_db_pool_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT_SECONDS"
+)
+RETENTION_PURGED_TOTAL = Counter(
+    "calibration_retention_purged_total", "Sessions (or partitions) of batch rows removed by the retention purge", ("kind",)
+)
+MLFLOW_PUBLISH_SECONDS = Histogram("calibration_mlflow_publish_seconds", "Time to build and publish an MLflow message")
+REPORT_BUILD_SECONDS = Histogram(
+    "calibration_report_build_seconds", "Time to build and send a session report",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+STREAM_LAG_MESSAGES = Gauge(
+    "calibration_stream_lag_messages", "Messages waiting in the broker queues of the sessions, sampled per stream", ("stream",)
+)
+STREAM_UNACKED_MESSAGES = Gauge(
+    "calibration_stream_unacked_messages", "Messages delivered to the sessions and not yet acknowledged", ("stream",)
+)
+STREAM_UNACKED_BYTES = Gauge(
+    "calibration_stream_unacked_bytes", "Bytes of messages delivered to the sessions and not yet acknowledged", ("stream",)
+)
+ACTIVE_SESSIONS = Gauge("calibration_active_sessions", "Sessions currently handled by the server")
+BATCHES_BYTES = Gauge("calibration_batches_bytes", "Bytes of inputs, labels and probabilities held in memory by sessions")
+SPILLED_BYTES = Gauge("calibration_spilled_bytes", "Bytes of session arrays moved to memory-mapped spill files")
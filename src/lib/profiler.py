@@ -0,0 +1,164 @@
+import json
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+PROFILE_FORMATS = ("collapsed", "pstats")
+
+
+def _frame_key(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for one thread. A daemon thread reads the target
+    thread's stack every `interval_seconds` for at most `duration_seconds`,
+    then writes the samples as collapsed stacks (flamegraph.pl, speedscope)
+    or as a pstats file (`python -m pstats`, snakeviz). Nothing runs while no
+    profile is in progress.
+    """
+
+    def __init__(
+        self,
+        thread_id: int,
+        output_path: str,
+        duration_seconds: float,
+        interval_seconds: float = 0.005,
+        output_format: str = "collapsed",
+        on_done=None,
+        logger=None,
+    ):
+        if output_format not in PROFILE_FORMATS:
+            raise ValueError(f"Unknown profile format {output_format!r}, expected one of {PROFILE_FORMATS}")
+        self.thread_id = thread_id
+        self.output_path = output_path
+        self.duration_seconds = duration_seconds
+        self.interval_seconds = interval_seconds
+        self.output_format = output_format
+        self.on_done = on_done
+        self.logger = logger or logging.getLogger("profiler")
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """End the profile early; the output is still written."""
+        self._stop.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return False
+        stack = []
+        while frame is not None:
+            stack.append(_frame_key(frame.f_code))
+            frame = frame.f_back
+        self.samples[tuple(reversed(stack))] += 1
+        return True
+
+    def _run(self):
+        deadline = time.monotonic() + self.duration_seconds
+        try:
+            while time.monotonic() < deadline and not self._stop.is_set():
+                if not self._sample():
+                    break  # the profiled thread is gone
+                self._stop.wait(self.interval_seconds)
+            self.write()
+            self.logger.info(
+                f"action: profile | result: success | samples: {sum(self.samples.values())} | output: {self.output_path}"
+            )
+        except Exception as e:
+            self.logger.error(f"action: profile | result: fail | error: {e}")
+        finally:
+            if self.on_done:
+                self.on_done(self)
+
+    def write(self):
+        directory = os.path.dirname(self.output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.output_format == "collapsed":
+            with open(self.output_path, "w") as output:
+                output.write(self.collapsed())
+        else:
+            with open(self.output_path, "wb") as output:
+                marshal.dump(self.pstats(), output)
+
+    def collapsed(self) -> str:
+        lines = []
+        for stack, count in self.samples.most_common():
+            frames = ";".join(f"{name} ({os.path.basename(filename)}:{line})" for filename, line, name in stack)
+            lines.append(f"{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def pstats(self) -> dict:
+        """
+        Samples converted to the stats dict pstats.Stats loads. Each sample
+        counts `interval_seconds` of own time for the innermost frame and of
+        cumulative time for every distinct frame of its stack.
+        """
+        stats = {}
+        for stack, count in self.samples.items():
+            elapsed = count * self.interval_seconds
+            for depth, key in enumerate(stack):
+                cc, nc, tt, ct, callers = stats.get(key, (0, 0, 0.0, 0.0, {}))
+                innermost = depth == len(stack) - 1
+                first_in_stack = key not in stack[:depth]
+                if first_in_stack:
+                    cc, nc, ct = cc + count, nc + count, ct + elapsed
+                if innermost:
+                    tt += elapsed
+                if depth > 0:
+                    caller = stack[depth - 1]
+                    c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c_cc + count, c_nc + count, c_tt + (elapsed if innermost else 0.0), c_ct + elapsed)
+                stats[key] = (cc, nc, tt, ct, callers)
+        return stats
+
+
+def profile_path(profile_dir: str, session_id: str, output_format: str) -> str:
+    timestamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    extension = "collapsed" if output_format == "collapsed" else "prof"
+    return os.path.join(profile_dir, f"{session_id}-{timestamp}.{extension}")
+
+
+def request_path(profile_dir: str, pid: int) -> str:
+    return os.path.join(profile_dir, ".requests", f"{pid}.json")
+
+
+def write_profile_request(profile_dir: str, pid: int, duration_seconds=None, output_format=None):
+    """Leave the parameters of a profile for the process `pid`, which reads them when it gets SIGUSR1."""
+    path = request_path(profile_dir, pid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as output:
+        json.dump({"duration_seconds": duration_seconds, "format": output_format}, output)
+
+
+def pop_profile_request(profile_dir: str, pid: int) -> dict:
+    """Parameters left by write_profile_request, or an empty dict (SIGUSR1 sent by hand)."""
+    path = request_path(profile_dir, pid)
+    try:
+        with open(path) as request:
+            return json.load(request)
+    except (OSError, ValueError):
+        return {}
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,48 @@
+import logging
+import os
+import shutil
+
+import numpy as np
+
+
+class SpillStore:
+    """
+    Files backing the arrays a session moved out of memory. Each array is
+    written once as an .npy file and mapped back read-only with np.memmap, so
+    reading it needs no copy and its pages can be dropped by the kernel under
+    memory pressure.
+    """
+
+    def __init__(self, directory: str, logger=None):
+        self.directory = directory
+        self.logger = logger or logging.getLogger("spill-store")
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def spill(self, key: str, array: np.ndarray) -> np.memmap:
+        """Write `array` to its file and return the read-only mapping that replaces it."""
+        path = self._path(key)
+        target = np.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+        target[...] = array
+        target.flush()
+        del target
+        return np.load(path, mmap_mode="r")
+
+    def discard(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        """Delete every spilled array; mappings still referenced stay readable until released."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def build_spill_store(server_config, session_id, logger=None):
+    """The session's SpillStore under SPILL_DIR, or None when spilling is disabled."""
+    if not server_config.spill_dir or server_config.session_memory_budget_bytes <= 0:
+        return None
+    return SpillStore(os.path.join(server_config.spill_dir, str(session_id)), logger=logger)
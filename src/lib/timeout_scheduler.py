@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+from time import monotonic
+from typing import Callable, Optional
+
+
+class InactivityTimer:
+    """
+    Deadline that moves forward every time `touch` is called.
+
+    `touch` is a single attribute store, so message callbacks can call it
+    without taking a lock. The scheduler only reads it when the previously
+    known deadline expires.
+    """
+
+    def __init__(self, timeout_seconds: float, on_timeout: Callable[[], None], name: str = ""):
+        self.timeout_seconds = timeout_seconds
+        self.on_timeout = on_timeout
+        self.name = name
+        self.cancelled = False
+        self.last_touch = monotonic()
+
+    def touch(self):
+        self.last_touch = monotonic()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def deadline(self) -> float:
+        return self.last_touch + self.timeout_seconds
+
+
+class TimeoutScheduler:
+    """
+    Heap of inactivity timers served by a single thread per process.
+
+    Touching a timer does not reorder the heap: when an entry expires the
+    scheduler re-reads the timer's deadline and pushes it back if it was
+    touched in the meantime, so heap work happens at most once per timeout
+    period instead of once per message.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("timeout-scheduler")
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pid = None
+        self._thread = None
+        self._stopped = False
+
+    def schedule(self, timer: InactivityTimer):
+        """Start watching `timer`; its callback runs on the scheduler thread once it expires."""
+        with self._lock:
+            self._ensure_started()
+            heapq.heappush(self._heap, (timer.deadline(), next(self._counter), timer))
+            self._changed.notify()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        # Timers registered before a fork belong to the parent process
+        self._heap = []
+        self._pid = os.getpid()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="timeout-scheduler", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def _next_expired(self) -> Optional[InactivityTimer]:
+        """Block until a timer is due and pop it, or return None once stopped."""
+        with self._lock:
+            while not self._stopped:
+                if not self._heap:
+                    self._changed.wait()
+                    continue
+                deadline, _, timer = self._heap[0]
+                remaining = deadline - monotonic()
+                if remaining > 0:
+                    self._changed.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+                if timer.cancelled:
+                    continue
+                new_deadline = timer.deadline()
+                if new_deadline > deadline:
+                    heapq.heappush(self._heap, (new_deadline, next(self._counter), timer))
+                    continue
+                timer.cancelled = True
+                return timer
+            return None
+
+    def _run(self):
+        while True:
+            timer = self._next_expired()
+            if timer is None:
+                return
+            try:
+                timer.on_timeout()
+            except Exception as e:
+                self.logger.error(f"Error in timeout callback for {timer.name}: {e}")
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._changed.notify()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join()
+
+
+_scheduler: Optional[TimeoutScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_timeout_scheduler() -> TimeoutScheduler:
+    """Return the process-wide timeout scheduler, creating it on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = TimeoutScheduler()
+        return _scheduler
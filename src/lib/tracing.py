@@ -0,0 +1,312 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import List, Optional
+
+import requests
+
+from src.lib.config import TracingConfig
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class _NoopSpan:
+    """Returned when a batch is not sampled; every operation is a no-op."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_child(self, name, start_time_ns, end_time_ns, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """A timed operation of a sampled trace. Used as a context manager, it becomes the parent of nested spans."""
+
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "attributes", "start_time_ns", "end_time_ns", "error", "_token")
+
+    def __init__(self, tracer, name: str, trace_id: str, parent_id: Optional[str], attributes: dict, start_time_ns: int = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time_ns = start_time_ns or time.time_ns()
+        self.end_time_ns = None
+        self.error = None
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        self.end(error=exc)
+        return False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_child(self, name, start_time_ns, end_time_ns, **attributes):
+        """Record a child span that already finished (e.g. work done before the batch was known)."""
+        child = Span(self.tracer, name, self.trace_id, self.span_id, {**_inherited(self.attributes), **attributes}, start_time_ns)
+        child.end(end_time_ns=end_time_ns)
+
+    def end(self, error=None, end_time_ns=None):
+        self.end_time_ns = end_time_ns or time.time_ns()
+        self.error = error
+        self.tracer._export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_time_ns,
+            "end_time_unix_nano": self.end_time_ns,
+            "attributes": self.attributes,
+            "status": "error" if self.error else "ok",
+            "error": str(self.error) if self.error else None,
+        }
+
+
+class FileSpanExporter:
+    """Appends finished spans to a file, one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, spans: List[dict]):
+        with open(self.path, "a") as output:
+            for span in spans:
+                output.write(json.dumps(span, default=str) + "\n")
+
+    def shutdown(self):
+        pass
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[dict], service_name: str) -> dict:
+    """OTLP/JSON ExportTraceServiceRequest for the given spans."""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{
+                "scope": {"name": service_name},
+                "spans": [
+                    {
+                        "traceId": span["trace_id"],
+                        "spanId": span["span_id"],
+                        **({"parentSpanId": span["parent_span_id"]} if span["parent_span_id"] else {}),
+                        "name": span["name"],
+                        "kind": 1,
+                        "startTimeUnixNano": str(span["start_time_unix_nano"]),
+                        "endTimeUnixNano": str(span["end_time_unix_nano"]),
+                        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span["attributes"].items()],
+                        "status": {"code": 2, "message": span["error"]} if span["status"] == "error" else {"code": 1},
+                    }
+                    for span in spans
+                ],
+            }],
+        }]
+    }
+
+
+class OtlpHttpSpanExporter:
+    """Posts spans as OTLP/JSON to a collector's /v1/traces endpoint."""
+
+    def __init__(self, endpoint: str, service_name: str, timeout_seconds: float = 5.0, logger=None):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout_seconds = timeout_seconds
+        self.logger = logger or logging.getLogger("tracing")
+        self._session = requests.Session()
+
+    def export(self, spans: List[dict]):
+        response = self._session.post(
+            self.endpoint, json=to_otlp(spans, self.service_name), timeout=self.timeout_seconds
+        )
+        if response.status_code >= 300:
+            self.logger.warning(f"action: export_spans | result: fail | status: {response.status_code}")
+
+    def shutdown(self):
+        self._session.close()
+
+
+class Tracer:
+    """
+    Per-batch tracing. A batch's trace id is derived from its session id and
+    batch index, so the spans of its inputs and predictions messages land in
+    the same trace and are sampled (or dropped) together. Finished spans are
+    queued and exported in the background; when the queue is full they are
+    dropped instead of slowing the pipeline down.
+    """
+
+    def __init__(
+        self,
+        exporter=None,
+        sample_rate: float = 0.0,
+        max_queue_size: int = 2048,
+        max_export_batch_size: int = 256,
+        export_interval_seconds: float = 2.0,
+        logger=None,
+    ):
+        self.exporter = exporter
+        self.sample_rate = sample_rate if exporter is not None else 0.0
+        self.max_queue_size = max_queue_size
+        self.max_export_batch_size = max_export_batch_size
+        self.export_interval_seconds = export_interval_seconds
+        self.logger = logger or logging.getLogger("tracing")
+        self.dropped_spans = 0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker = None
+        self._pid = None
+
+    @staticmethod
+    def trace_id_for(session_id, batch_index) -> str:
+        return hashlib.sha256(f"{session_id}:{batch_index}".encode()).hexdigest()[:32]
+
+    def is_sampled(self, trace_id: str) -> bool:
+        return int(trace_id[:8], 16) < self.sample_rate * 0x100000000
+
+    def batch_span(self, name: str, session_id, batch_index: int, start_time_ns: int = None, **attributes):
+        """Root span of a batch message, or a no-op span when the batch is not sampled."""
+        if self.sample_rate <= 0:
+            return NOOP_SPAN
+        trace_id = self.trace_id_for(session_id, batch_index)
+        if not self.is_sampled(trace_id):
+            return NOOP_SPAN
+        attributes = {"session_id": str(session_id), "batch_index": int(batch_index), **attributes}
+        return Span(self, name, trace_id, None, attributes, start_time_ns)
+
+    def span(self, name: str, **attributes):
+        """Child of the current span, or a no-op span outside of a sampled batch."""
+        parent = _current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(self, name, parent.trace_id, parent.span_id, {**_inherited(parent.attributes), **attributes})
+
+    def _ensure_started(self):
+        """(Re)create the export queue and worker, also after a fork."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue_size)
+            self._worker = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self._worker.start()
+            self._pid = os.getpid()
+
+    def _export(self, span: Span):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(span.to_dict())
+        except queue.Full:
+            self.dropped_spans += 1
+
+    def _drain(self) -> List[dict]:
+        spans = []
+        while len(spans) < self.max_export_batch_size:
+            try:
+                spans.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return spans
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.export_interval_seconds)
+            except queue.Empty:
+                continue
+            spans = [first] + self._drain()
+            self._send(spans)
+            for _ in spans:
+                self._queue.task_done()
+
+    def _send(self, spans: List[dict]):
+        try:
+            self.exporter.export(spans)
+        except Exception as e:
+            self.logger.warning(f"action: export_spans | result: fail | spans: {len(spans)} | error: {e}")
+
+    def flush(self, timeout: float = 5.0):
+        """Wait until queued spans are exported, at most `timeout` seconds."""
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+def _inherited(attributes: dict) -> dict:
+    return {key: attributes[key] for key in ("session_id", "batch_index") if key in attributes}
+
+
+def build_tracer(config: TracingConfig) -> Tracer:
+    exporter = None
+    if config.exporter == "file":
+        exporter = FileSpanExporter(config.file_path)
+    elif config.exporter == "otlp":
+        exporter = OtlpHttpSpanExporter(config.otlp_endpoint, config.service_name)
+    elif config.exporter != "none":
+        logging.warning(f"Unknown TRACING_EXPORTER {config.exporter!r}, tracing disabled")
+    return Tracer(
+        exporter=exporter,
+        sample_rate=config.sample_rate,
+        max_queue_size=config.max_queue_size,
+        export_interval_seconds=config.export_interval_seconds,
+    )
+
+
+_shared_tracer: Optional[Tracer] = None
+_shared_tracer_lock = threading.Lock()
+
+
+def get_tracer(config: TracingConfig = None) -> Tracer:
+    """Return the process-wide tracer, creating it on first use."""
+    global _shared_tracer
+    if _shared_tracer is not None:
+        return _shared_tracer
+    with _shared_tracer_lock:
+        if _shared_tracer is None:
+            _shared_tracer = build_tracer(config or TracingConfig())
+        return _shared_tracer
+
+
+def set_tracer(tracer: Optional[Tracer]):
+    """Replace the process-wide tracer (None rebuilds it from the environment on next use)."""
+    global _shared_tracer
+    with _shared_tracer_lock:
+        _shared_tracer = tracer
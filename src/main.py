@@ -7,17 +7,38 @@ from server.main import Server
 from lib.logger import initialize_logging
 from lib.config import initialize_config
 from src.database.db import Database
-from src.lib.db_engine import get_engine
+from src.database.migrations import migrate
+from src.database.retention import RetentionJob
+from src.lib.db_engine import get_engine, planned_connections
 from src.middleware.middleware import Middleware
+from src.middleware.connection_manager import SessionMiddleware
+from src.middleware.memory_broker import InMemoryBroker, InMemoryMiddleware, in_memory_connection_manager
+from src.server.async_client_manager import AsyncSessionEngine
 
 
 def main():
     config = initialize_config()
     initialize_logging(config.log_level.upper())
 
-    middleware = Middleware(config.middleware_config)
+    if config.middleware_config.transport == "memory":
+        # The broker lives in this process, so sessions must too
+        if config.server_config.session_engine != "thread":
+            logging.warning("In-memory transport requires SESSION_ENGINE=thread, switching to it")
+            config.server_config.session_engine = "thread"
+        broker = InMemoryBroker()
+        middleware = InMemoryMiddleware(config.middleware_config, broker)
+        connection_manager = in_memory_connection_manager(config.middleware_config, broker)
+    else:
+        middleware = Middleware(config.middleware_config)
+        connection_manager = None
+        if config.server_config.session_engine == "process":
+            logging.info(
+                "action: rabbitmq_connections | session_engine: process | "
+                "detail: one connection per session; SESSION_ENGINE=thread or asyncio shares them"
+            )
+
     def middleware_factory(config):
-        return Middleware(config=config)
+        return SessionMiddleware(config=config, connection_manager=connection_manager)
     
     def report_builder_factory(user_id: str):
         from src.server.report_builder import ReportBuilder
@@ -27,9 +48,43 @@ def main():
         from src.server.utrace_calculator import UtraceCalculator
         return UtraceCalculator(database=database, session_id=session_id)
     
-    db = Database(get_engine(config.database_url))
-    server = Server(config, middleware_cls=middleware, cm_middleware_factory=middleware_factory, report_builder_factory=report_builder_factory, utrace_calculator_factory=utrace_calculator_factory, database=db)
-    server.run()
+    session_engine = None
+    if config.server_config.session_engine == "asyncio":
+        if config.database_config.wal_dir:
+            # Acks of the asyncio engine happen on the event loop, they cannot wait for a per-session fsync
+            raise ValueError("WAL_DIR is not supported with SESSION_ENGINE=asyncio")
+        session_engine = AsyncSessionEngine(
+            config.middleware_config, max_workers=config.server_config.session_executor_workers or None
+        )
+        session_engine.start()
+
+    database_config = config.database_config
+    connections = planned_connections(config)
+    logging.info(f"action: db_capacity | planned_connections: {connections} | max_connections: {database_config.max_connections}")
+    if database_config.max_connections and connections > database_config.max_connections:
+        logging.warning(
+            f"Up to {connections} database connections can be opened, more than DB_MAX_CONNECTIONS="
+            f"{database_config.max_connections}: lower DB_POOL_SIZE/DB_POOL_MAX_OVERFLOW or UPPER_BOUND_CLIENTS, "
+            f"or put PgBouncer in front with DB_POOL_MODE=external"
+        )
+    engine = get_engine(config.database_url, database_config)
+    # The only place the schema changes; ClientManagers assume it is up to date
+    migrate(engine, partition_days=database_config.partition_days)
+    db = Database(engine)
+    retention_job = RetentionJob(
+        db,
+        retention_days=database_config.retention_days,
+        abandoned_days=database_config.retention_abandoned_days,
+        interval_seconds=database_config.retention_interval_seconds,
+    )
+    retention_job.start()
+    server = Server(config, middleware_cls=middleware, cm_middleware_factory=middleware_factory, report_builder_factory=report_builder_factory, utrace_calculator_factory=utrace_calculator_factory, database=db, session_engine=session_engine)
+    try:
+        server.run()
+    finally:
+        retention_job.stop()
+        if session_engine is not None:
+            session_engine.stop()
     
 
 if __name__ == "__main__":
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+
+import pika.exceptions
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from src.middleware.consumer import Consumer
+from src.middleware.middleware import connection_parameters
+
+
+class AsyncMiddleware:
+    """
+    asyncio counterpart of Middleware, built on pika's AsyncioConnection.
+
+    Operations that need a broker round-trip (connect, channel creation,
+    declarations, passive queue inspection, start_consuming) are coroutines;
+    publish, ack, consume, qos and cancel are fire-and-forget exactly as in
+    pika's asynchronous API. One instance, and so one connection, is shared by
+    every session driven by the event loop, which is why consuming is started
+    and stopped per channel.
+    """
+
+    def __init__(self, config, connection_factory=None):
+        self.config = config
+        self.logger = logging.getLogger("async-middleware")
+        self.conn = None
+        self.consumer_tag = None
+        self._is_running = False
+        self._shutdown_received = False
+        self._connection_error = None
+        self._connection_factory = connection_factory or self._open_connection
+        self._consumers = {}
+        self._consuming = {}
+        self._pending_rpcs = {}
+        self._management_channel = None
+        self._management_lock = asyncio.Lock()
+        self._loop = None
+
+    async def connect(self):
+        """Establish a connection to RabbitMQ with retries."""
+        self._loop = asyncio.get_running_loop()
+        delay = 5
+        max_delay = 60  # maximum delay of 1 minute
+        while not self._shutdown_received:
+            try:
+                self.conn = await self._connection_factory()
+                self._connection_error = None
+                self.logger.info(
+                    f"Connected to RabbitMQ at {self.config.host}:{self.config.port} as {self.config.username}"
+                )
+                return
+            except Exception as e:
+                self.logger.error(f"Failed to connect to RabbitMQ: {e}. Retrying in {delay} seconds...")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    async def _open_connection(self):
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+
+        def on_open(connection):
+            if not opened.done():
+                opened.set_result(connection)
+
+        def on_open_error(connection, error):
+            if not opened.done():
+                opened.set_exception(pika.exceptions.AMQPConnectionError(str(error)))
+
+        AsyncioConnection(
+            parameters=connection_parameters(self.config),
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=loop,
+        )
+        return await opened
+
+    def _on_connection_closed(self, connection, reason):
+        self.logger.error(f"RabbitMQ connection closed: {reason}")
+        self._connection_error = reason
+        for done in self._consuming.values():
+            done.set()
+
+    def _on_channel_closed(self, channel, reason):
+        self.logger.info(f"Channel {channel.channel_number} closed: {reason}")
+        self._consumers.pop(channel, None)
+        for future in self._pending_rpcs.pop(channel, set()):
+            if not future.done():
+                future.set_exception(pika.exceptions.ChannelClosed(0, str(reason)))
+        done = self._consuming.get(channel)
+        if done:
+            done.set()
+
+    async def _rpc(self, channel, method, **kwargs):
+        """Call a pika channel method that reports completion through `callback` and wait for it."""
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending_rpcs.setdefault(channel, set())
+        pending.add(future)
+
+        def on_done(frame):
+            pending.discard(future)
+            if not future.done():
+                future.set_result(frame)
+
+        method(callback=on_done, **kwargs)
+        return await future
+
+    def is_running(self):
+        return self._is_running
+
+    async def create_channel(self, prefetch_count=1):
+        """Open a new channel on the shared connection."""
+        if self.conn is None or self.conn.is_closed:
+            self.logger.warning("Connection is closed, reconnecting before creating channel...")
+            await self.connect()
+
+        opened = asyncio.get_running_loop().create_future()
+        self.conn.channel(on_open_callback=lambda channel: opened.done() or opened.set_result(channel))
+        channel = await opened
+        channel.add_on_close_callback(self._on_channel_closed)
+        await self._rpc(channel, channel.basic_qos, prefetch_count=prefetch_count)
+        return channel
+
+    def set_prefetch(self, channel, prefetch_count: int, global_qos: bool = False):
+        channel.basic_qos(prefetch_count=prefetch_count, global_qos=global_qos)
+
+    async def declare_queue(self, channel, queue_name: str, durable: bool = False):
+        try:
+            await self._rpc(channel, channel.queue_declare, queue=queue_name, durable=durable)
+            self.logger.info(f"Queue '{queue_name}' declared successfully")
+        except Exception as e:
+            self.logger.error(f"Failed to declare queue '{queue_name}': {e}")
+            raise e
+
+    async def declare_exchange(self, channel, exchange_name: str, exchange_type: str = "direct", durable: bool = False):
+        try:
+            await self._rpc(
+                channel, channel.exchange_declare, exchange=exchange_name, exchange_type=exchange_type, durable=durable
+            )
+            self.logger.info(f"Exchange '{exchange_name}' declared successfully")
+        except Exception as e:
+            self.logger.error(f"Failed to declare exchange '{exchange_name}': {e}")
+            raise e
+
+    async def bind_queue(self, channel, queue_name: str, exchange_name: str, routing_key: str):
+        try:
+            await self._rpc(channel, channel.queue_bind, queue=queue_name, exchange=exchange_name, routing_key=routing_key)
+            self.logger.info(
+                f"Queue '{queue_name}' bound to exchange '{exchange_name}' with routing key '{routing_key}'"
+            )
+        except Exception as e:
+            self.logger.error(
+                f"Failed to bind queue '{queue_name}' to exchange '{exchange_name}' "
+                f"with routing key '{routing_key}': {e}"
+            )
+            raise e
+
+    async def get_message_count(self, queue_name: str) -> int:
+        """
+        Return the number of messages ready for delivery in an existing queue.
+
+        As in Middleware, the passive declare runs on a management channel so a
+        missing queue never closes a consuming channel.
+        """
+        async with self._management_lock:
+            if self._management_channel is None or not self._management_channel.is_open:
+                self._management_channel = await self.create_channel()
+        channel = self._management_channel
+        frame = await self._rpc(channel, channel.queue_declare, queue=queue_name, passive=True)
+        return frame.method.message_count
+
+    def basic_consume(self, channel, queue_name: str, callback_function, consumer_tag=None) -> str:
+        self.logger.info(f"Setting up consumer for queue: {queue_name}")
+        self.consumer_tag = channel.basic_consume(
+            queue=queue_name,
+            on_message_callback=self.callback_wrapper(callback_function),
+            auto_ack=False,
+            consumer_tag=consumer_tag,
+        )
+        self._consumers.setdefault(channel, []).append(self.consumer_tag)
+        return self.consumer_tag
+
+    def basic_send(self, channel, exchange_name: str, routing_key: str, body: bytes, properties=None):
+        try:
+            channel.basic_publish(exchange=exchange_name, routing_key=routing_key, body=body, properties=properties)
+        except Exception as e:
+            self.logger.error(
+                f"Failed to send message to exchange '{exchange_name}' with routing key '{routing_key}': {e}"
+            )
+            raise e
+
+    def callback_wrapper(self, callback_function):
+        """Run the callback on the loop; coroutine results are awaited in a task. Failures nack the message."""
+
+        def nack(ch, method, error):
+            self.logger.error(f"action: rabbitmq_callback | result: fail | error: {error}")
+            if ch.is_open:
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+
+        async def await_result(result, ch, method):
+            try:
+                await result
+            except Exception as e:
+                nack(ch, method, e)
+
+        def wrapper(ch, method, properties, body):
+            if ch not in self._consumers:
+                return
+            try:
+                result = callback_function(ch, method, properties, body)
+                if asyncio.iscoroutine(result):
+                    asyncio.get_running_loop().create_task(await_result(result, ch, method))
+            except Exception as e:
+                nack(ch, method, e)
+
+        return wrapper
+
+    def add_callback_threadsafe(self, func):
+        """Run func on the event loop; safe to call from executor threads."""
+        self._loop.call_soon_threadsafe(func)
+
+    def call_later(self, delay: float, func):
+        return asyncio.get_running_loop().call_later(delay, func)
+
+    async def start_consuming(self, channel):
+        """Wait until every consumer of the channel has been cancelled (or the channel/connection closed)."""
+        self._is_running = True
+        done = self._consuming.setdefault(channel, asyncio.Event())
+        self.logger.info("Starting to consume messages")
+        await done.wait()
+        self._consuming.pop(channel, None)
+        if self._connection_error is not None:
+            raise pika.exceptions.AMQPConnectionError(str(self._connection_error))
+
+    def stop_consuming(self, channel):
+        for tag in self._consumers.pop(channel, []):
+            if channel.is_open:
+                channel.basic_cancel(tag)
+        done = self._consuming.get(channel)
+        if done:
+            done.set()
+        self.logger.info("Stopped consuming messages")
+
+    def close_channel(self, channel):
+        try:
+            self._consumers.pop(channel, None)
+            if channel and channel.is_open:
+                channel.close()
+        except Exception as e:
+            self.logger.error(f"action: rabbitmq_channel_close | result: fail | error: {e}")
+
+    def close_connection(self):
+        try:
+            if self.conn is not None and not self.conn.is_closed:
+                self.conn.close()
+            self.logger.info("RabbitMQ connection closed")
+        except Exception as e:
+            self.logger.error(f"Failed to close RabbitMQ connection: {e}")
+            raise e
+
+    def handle_sigterm(self):
+        self._shutdown_received = True
+
+
+class AsyncConsumer(Consumer):
+    """
+    Consumer for AsyncMiddleware. Streams, grouped acks, byte limits and lag
+    reporting behave as in Consumer; channels are opened and consumed from
+    the event loop, and the shared connection is left open on finish.
+    """
+
+    def _open_channels(self):
+        pass  # opened in start(), which runs on the event loop
+
+    async def start(self):
+        try:
+            for stream in self.streams:
+                stream.channel = await self.middleware.create_channel(prefetch_count=stream.prefetch_count)
+            await self.middleware.declare_queue(self.inputs_stream.channel, self.inputs_queue_name, durable=True)
+            for stream in self.streams:
+                self.middleware.basic_consume(stream.channel, stream.queue_name, stream.callback)
+
+            if not self._shutdown_initiated:
+                if self.lag_report_interval_seconds > 0:
+                    self.middleware.call_later(self.lag_report_interval_seconds, self._report_lag)
+                await self.middleware.start_consuming(self.inputs_stream.channel)
+        except pika.exceptions.AMQPConnectionError as e:
+            self.logger.error(f"AMQP Connection error in Consumer for client {self.user_id}: {e}")
+            raise e
+        except Exception as e:
+            self.logger.error(f"Error in Consumer for client {self.user_id}: {e}")
+        finally:
+            self.finish()
+
+    def _report_lag(self):
+        if not self._shutdown_initiated:
+            asyncio.get_running_loop().create_task(self._report_lag_async())
+
+    async def _report_lag_async(self):
+        for stream in self.streams:
+            try:
+                stream.lag = await self.middleware.get_message_count(stream.queue_name)
+            except Exception as e:
+                self.logger.warning(f"Could not read lag of {stream.queue_name}: {e}")
+                continue
+            self._record_lag(stream)
+        if not self._shutdown_initiated:
+            self.middleware.call_later(self.lag_report_interval_seconds, self._report_lag)
+
+    def handle_sigterm(self):
+        self._shutdown_initiated = True
+        for stream in self.streams:
+            if stream.channel is not None:
+                self.middleware.stop_consuming(stream.channel)
+
+    def finish(self):
+        try:
+            self.flush_acks()
+        except Exception as e:
+            self.logger.error(f"Error flushing acks for client {self.user_id}: {e}")
+        for stream in self.streams:
+            stream.clear_metrics()
+            if stream.channel is not None:
+                self.middleware.close_channel(stream.channel)
+        self.logger.info(f"Consumer shutdown complete for client {self.user_id}")
@@ -0,0 +1,418 @@
+import heapq
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional
+
+import pika
+import pika.exceptions
+
+from src.middleware.middleware import Middleware, connection_parameters
+
+
+class PooledConnection:
+    """
+    A broker connection shared by several sessions and driven by its own I/O
+    thread. pika connections are not thread-safe, so other threads never call
+    into it directly: `submit` hands the work to the I/O thread and waits for
+    the result.
+    """
+
+    def __init__(self, config, connection_factory, logger=None):
+        self.config = config
+        self.logger = logger or logging.getLogger("pooled-connection")
+        self.broken = False
+        self._connection_factory = connection_factory
+        self._conn = None
+        self._closing = False
+        self._sessions = set()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="amqp-io", daemon=True)
+
+    @property
+    def session_count(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def add_session(self, session):
+        with self._lock:
+            self._sessions.add(session)
+
+    def remove_session(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def start(self):
+        self._thread.start()
+        self.wait_ready()
+
+    def wait_ready(self):
+        """Block until the connection is open; raises if opening it failed."""
+        self._ready.wait()
+        if self._error:
+            raise self._error
+
+    def _connect(self):
+        delay = 1
+        max_delay = 60
+        for attempt in range(self.config.max_retries + 1):
+            try:
+                return self._connection_factory()
+            except Exception as e:
+                if attempt == self.config.max_retries:
+                    raise pika.exceptions.AMQPConnectionError(f"Failed to connect to RabbitMQ: {e}")
+                self.logger.error(f"Failed to connect to RabbitMQ: {e}. Retrying in {delay} seconds...")
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    def _run(self):
+        try:
+            self._conn = self._connect()
+        except Exception as e:
+            self.broken = True
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        error = None
+        while not self._closing:
+            try:
+                self._conn.process_data_events(time_limit=1)
+            except Exception as e:
+                error = e
+                break
+        self._shutdown(error)
+
+    def _shutdown(self, error=None):
+        """Runs on the I/O thread: fail pending calls and tell every session the connection is gone."""
+        with self._lock:
+            self.broken = True
+            pending = list(self._pending)
+            self._pending.clear()
+            sessions = list(self._sessions)
+
+        lost = pika.exceptions.AMQPConnectionError(f"Shared connection lost: {error}" if error else "Shared connection closed")
+        for future in pending:
+            if not future.done():
+                future.set_exception(lost)
+
+        if error is not None:
+            self.logger.error(f"Shared RabbitMQ connection lost, affecting {len(sessions)} sessions: {error}")
+            for session in sessions:
+                session._on_connection_lost(lost)
+
+        try:
+            if self._conn is not None and not self._conn.is_closed:
+                self._conn.close()
+        except Exception as e:
+            self.logger.error(f"Failed to close RabbitMQ connection: {e}")
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn on the I/O thread and return its result (or raise its exception)."""
+        if threading.current_thread() is self._thread:
+            return fn(*args, **kwargs)
+
+        future = Future()
+
+        def task():
+            with self._lock:
+                self._pending.discard(future)
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        with self._lock:
+            if self.broken:
+                raise pika.exceptions.AMQPConnectionError("Shared connection is closed")
+            self._pending.add(future)
+        try:
+            self._conn.add_callback_threadsafe(task)
+        except Exception as e:
+            with self._lock:
+                self._pending.discard(future)
+            raise pika.exceptions.AMQPConnectionError(f"Shared connection is closed: {e}")
+        return future.result()
+
+    def channel(self):
+        return self.submit(self._conn.channel)
+
+    def close(self):
+        self._closing = True
+        if self._thread.is_alive():
+            try:
+                self._conn.add_callback_threadsafe(lambda: None)  # wake up the I/O loop
+            except Exception:
+                pass
+            self._thread.join()
+
+
+class SharedChannel:
+    """Channel on a pooled connection; every method call is executed on the connection's I/O thread."""
+
+    def __init__(self, connection: PooledConnection, channel):
+        self._connection = connection
+        self._channel = channel
+
+    @property
+    def is_open(self) -> bool:
+        return not self._connection.broken and self._channel.is_open
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    @property
+    def channel_number(self) -> int:
+        return self._channel.channel_number
+
+    def __getattr__(self, name):
+        attr = getattr(self._channel, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._connection.submit(attr, *args, **kwargs)
+
+        return call
+
+
+class ConnectionManager:
+    """
+    Pool of broker connections shared by every session of a process.
+
+    Sessions are placed on the least loaded connection; a new connection is
+    opened only when all existing ones hold `sessions_per_connection`
+    sessions, up to `max_connections`. A broken connection only affects the
+    sessions on it and is replaced on the next acquire. Connections are
+    opened outside the manager's lock, so a slow or unreachable broker only
+    holds up the sessions placed on the connection being opened.
+
+    The manager is per process: sessions share connections with
+    SESSION_ENGINE=thread (the default) or asyncio, while with
+    SESSION_ENGINE=process each ClientManager process holds one session,
+    hence one connection.
+    """
+
+    def __init__(self, config, max_connections=4, sessions_per_connection=64, connection_factory=None, logger=None):
+        self.config = config
+        self.max_connections = max(1, max_connections)
+        self.sessions_per_connection = max(1, sessions_per_connection)
+        self.logger = logger or logging.getLogger("connection-manager")
+        self._connection_factory = connection_factory or (
+            lambda: pika.BlockingConnection(connection_parameters(self.config))
+        )
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def acquire(self, session) -> PooledConnection:
+        opening = False
+        with self._lock:
+            self._connections = [c for c in self._connections if not c.broken]
+            available = [c for c in self._connections if c.session_count < self.sessions_per_connection]
+            if available:
+                connection = min(available, key=lambda c: c.session_count)
+            elif len(self._connections) < self.max_connections:
+                # Reserve the slot now; the connection is opened below, without the lock
+                connection = PooledConnection(self.config, self._connection_factory, logger=self.logger)
+                self._connections.append(connection)
+                opening = True
+            else:
+                connection = min(self._connections, key=lambda c: c.session_count)
+            connection.add_session(session)
+
+        try:
+            if opening:
+                connection.start()
+                self.logger.info(f"Opened shared RabbitMQ connection {len(self.stats())}/{self.max_connections}")
+            else:
+                # May still be being opened by another session's acquire
+                connection.wait_ready()
+        except Exception:
+            connection.remove_session(session)
+            raise
+        return connection
+
+    def release(self, session, connection: PooledConnection):
+        connection.remove_session(session)
+
+    def stats(self) -> list:
+        """Number of sessions on each open connection."""
+        with self._lock:
+            return [c.session_count for c in self._connections if not c.broken]
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+
+
+_manager: Optional[ConnectionManager] = None
+_manager_pid = None
+_manager_lock = threading.Lock()
+
+
+def get_connection_manager(config) -> ConnectionManager:
+    """Return the connection manager of the current process, creating it on first use."""
+    global _manager, _manager_pid
+    with _manager_lock:
+        if _manager is None or _manager_pid != os.getpid():
+            _manager = ConnectionManager(
+                config,
+                max_connections=config.max_shared_connections,
+                sessions_per_connection=config.sessions_per_connection,
+            )
+            _manager_pid = os.getpid()
+        return _manager
+
+
+class SessionMiddleware(Middleware):
+    """
+    Middleware for one session whose channels are multiplexed over the
+    process' pooled connections instead of a dedicated BlockingConnection.
+
+    Deliveries are handed from the I/O thread to the thread that called
+    `start_consuming`, so a slow session never blocks the others on the same
+    connection. Nothing is opened until the first channel is requested, which
+    lets the Listener build it and the ClientManager process use it.
+    """
+
+    def __init__(self, config, connection_manager: Optional[ConnectionManager] = None):
+        self.config = config
+        self.logger = logging.getLogger("session-middleware")
+        self.consumer_tag = None
+        self.conn = None
+        self._is_running = False
+        self._shutdown_received = False
+        self._connection_manager = connection_manager
+        self._connection: Optional[PooledConnection] = None
+        self._management_channel = None
+        self._consumers = {}
+        self._events = queue.Queue()
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._timers_lock = threading.Lock()
+
+    def _shared_connection(self) -> PooledConnection:
+        if self._connection is None or self._connection.broken:
+            manager = self._connection_manager or get_connection_manager(self.config)
+            self._connection = manager.acquire(self)
+        return self._connection
+
+    def connect(self):
+        self._shared_connection()
+
+    def create_channel(self, prefetch_count=1):
+        """Open a channel for this session on a shared connection."""
+        connection = self._shared_connection()
+        channel = SharedChannel(connection, connection.channel())
+        channel.basic_qos(prefetch_count=prefetch_count)
+        return channel
+
+    def basic_consume(self, channel, queue_name: str, callback_function, consumer_tag=None) -> str:
+        self.logger.info(f"Setting up consumer for queue: {queue_name}")
+        wrapped = self.callback_wrapper(callback_function)
+
+        def on_message(ch, method, properties, body):
+            # Runs on the I/O thread: hand the delivery over to the session thread
+            self._events.put((wrapped, (channel, method, properties, body)))
+
+        self.consumer_tag = channel.basic_consume(
+            queue=queue_name,
+            on_message_callback=on_message,
+            auto_ack=False,
+            consumer_tag=consumer_tag
+        )
+        self._consumers.setdefault(channel, []).append(self.consumer_tag)
+        return self.consumer_tag
+
+    def add_callback_threadsafe(self, func):
+        self._events.put((func, ()))
+
+    def call_later(self, delay: float, func):
+        with self._timers_lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_ids), func))
+        self._events.put((None, ()))  # recompute the wait
+
+    def _run_due_timers(self) -> Optional[float]:
+        """Run expired timers; return seconds until the next one, if any."""
+        while True:
+            with self._timers_lock:
+                if not self._timers:
+                    return None
+                deadline, _, func = self._timers[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                heapq.heappop(self._timers)
+            func()
+
+    def start_consuming(self, channel):
+        """Dispatch this session's deliveries and timers until all its consumers are cancelled."""
+        self._is_running = True
+        self.logger.info("Starting to consume messages")
+        try:
+            while self._consumers:
+                if self._connection is not None and self._connection.broken:
+                    self._consumers.clear()
+                    raise pika.exceptions.AMQPConnectionError("Shared RabbitMQ connection lost")
+                for consuming_channel in list(self._consumers):
+                    if not consuming_channel.is_open:
+                        self._consumers.pop(consuming_channel, None)
+                        raise pika.exceptions.ChannelWrongStateError(
+                            f"Channel {consuming_channel.channel_number} closed while consuming"
+                        )
+                next_timer = self._run_due_timers()
+                timeout = 0.5 if next_timer is None else min(next_timer, 0.5)
+                try:
+                    func, args = self._events.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+                if func is not None:
+                    func(*args)
+        except KeyboardInterrupt:
+            self.logger.error("Received interrupt signal, stopping consumption")
+
+    def _on_connection_lost(self, error):
+        """Called from the I/O thread when the shared connection of this session dies."""
+        self._events.put((None, ()))  # wake up start_consuming, which raises
+
+    def stop_consuming(self, channel=None):
+        self._is_running = False
+        channels = [channel] if channel is not None else list(self._consumers)
+        for ch in channels:
+            tags = self._consumers.pop(ch, [])
+            if ch is not None and ch.is_open:
+                for tag in tags:
+                    try:
+                        ch.basic_cancel(tag)
+                    except Exception as e:
+                        self.logger.error(f"Failed to cancel consumer {tag}: {e}")
+        self._events.put((None, ()))
+        self.logger.info("Stopped consuming messages")
+
+    def close_channel(self, channel):
+        self._consumers.pop(channel, None)
+        super().close_channel(channel)
+
+    def close_connection(self):
+        """Release this session's slot; the shared connection stays open for other sessions."""
+        if self._management_channel is not None:
+            self.close_channel(self._management_channel)
+            self._management_channel = None
+        if self._connection is not None:
+            manager = self._connection_manager or get_connection_manager(self.config)
+            manager.release(self, self._connection)
+            self._connection = None
+        self.logger.info("Session released its shared RabbitMQ connection")
@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+from http import HTTPStatus
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.lib.config import ConnectionsServiceConfig
+from src.lib.session_status import SessionStatus
+
+
+class ConnectionsServiceClient:
+    """
+    HTTP client for the connections service.
+
+    A single pooled `requests.Session` (keep-alive, timeouts and bounded
+    retries) is shared by every caller in the process. Status updates are
+    queued and sent by a background worker; if several transitions for the
+    same session are pending, only the latest one is sent.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        connect_timeout_seconds: float = 2.0,
+        read_timeout_seconds: float = 5.0,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        pool_size: int = 4,
+        logger=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout_seconds, read_timeout_seconds)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.logger = logger or logging.getLogger("connections-client")
+
+        self._lock = threading.Lock()
+        self._pending_changed = threading.Condition(self._lock)
+        self._pending: Dict[str, Tuple[str, SessionStatus]] = {}
+        self._in_flight = 0
+        self._closed = False
+        self._worker = None
+        self._pid = None
+        self._session = None
+
+    def _ensure_started(self):
+        """(Re)create the HTTP session and worker, also after a fork."""
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # Updates queued before the fork belong to the parent process
+            self._pending.clear()
+            self._in_flight = 0
+        self._pid = os.getpid()
+        self._session = self._build_session()
+        self._worker = threading.Thread(target=self._run, name="connections-client", daemon=True)
+        self._worker.start()
+
+    def _build_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=[HTTPStatus.BAD_GATEWAY, HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT],
+            allowed_methods=["PUT"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.headers.update({"Content-Type": "application/json"})
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def update_session_status(self, session_id: str, user_id: str, session_status: SessionStatus):
+        """Queue a status update; returns immediately."""
+        with self._lock:
+            if self._closed:
+                self.logger.warning(f"Client closed, dropping status {session_status.name()} for session {session_id}")
+                return
+            self._ensure_started()
+            self._pending[session_id] = (user_id, session_status)
+            self._pending_changed.notify_all()
+
+    def send_session_status(self, session_id: str, user_id: str, session_status: SessionStatus) -> bool:
+        """Send a status update synchronously. Returns True if the service accepted it."""
+        with self._lock:
+            self._ensure_started()
+        status = session_status.name().lower()
+        url = f"{self.base_url}/sessions/{session_id}/status/{status}"
+        try:
+            response = self._session.put(url, json={"user_id": user_id}, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.logger.error(f"Error updating session {session_id} status: {e}")
+            return False
+
+        if response.status_code == HTTPStatus.OK:
+            self.logger.info(f"Session {session_id} status updated to {session_status.name()}.")
+            return True
+        self.logger.error(
+            f"Failed to update session {session_id} status. Response code: {response.status_code}, "
+            f"Response body: {response.text}. Status: {session_status.name()}"
+        )
+        return False
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._pending_changed.wait()
+                if not self._pending and self._closed:
+                    return
+                session_id = next(iter(self._pending))
+                user_id, session_status = self._pending.pop(session_id)
+                self._in_flight += 1
+            try:
+                self.send_session_status(session_id, user_id, session_status)
+            except Exception as e:
+                self.logger.error(f"Unexpected error updating session {session_id} status: {e}")
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._pending_changed.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued update has been sent. Returns False on timeout."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return not self._pending
+            return self._pending_changed.wait_for(
+                lambda: not self._pending and self._in_flight == 0, timeout=timeout
+            )
+
+    def close(self, timeout: Optional[float] = None):
+        """Send any pending updates, then stop the worker and release pooled connections."""
+        flushed = self.flush(timeout=timeout)
+        if not flushed:
+            self.logger.warning("Timed out flushing pending session status updates")
+        with self._lock:
+            self._closed = True
+            self._pending_changed.notify_all()
+            worker, session = self._worker, self._session
+        if worker is not None and worker.is_alive() and self._pid == os.getpid():
+            worker.join(timeout=timeout)
+        if session is not None:
+            session.close()
+
+
+_shared_client: Optional[ConnectionsServiceClient] = None
+_shared_client_lock = threading.Lock()
+
+
+def get_connections_client(config=None) -> ConnectionsServiceClient:
+    """Return the process-wide connections service client, creating it on first use."""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None or _shared_client._closed:
+            config = config or ConnectionsServiceConfig()
+            _shared_client = ConnectionsServiceClient(
+                base_url=config.url,
+                connect_timeout_seconds=config.connect_timeout_seconds,
+                read_timeout_seconds=config.read_timeout_seconds,
+                max_retries=config.max_retries,
+                backoff_factor=config.backoff_factor,
+                pool_size=config.pool_size,
+            )
+        return _shared_client
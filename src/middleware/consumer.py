@@ -1,13 +1,104 @@
 import logging
 from src.lib.config import INPUTS_QUEUE_NAME, OUTPUTS_QUEUE_NAME
+from src.lib.metrics import STREAM_LAG_MESSAGES, STREAM_UNACKED_BYTES, STREAM_UNACKED_MESSAGES
 import pika.exceptions
 
+# Weight of the newest message in the running average of message sizes
+MESSAGE_SIZE_EWMA_WEIGHT = 0.2
+
+
+class ConsumerStream:
+    """
+    State of one consumed queue: its own channel, prefetch window, byte limit
+    and the group of processed messages waiting to be acknowledged.
+    """
+
+    def __init__(self, name, queue_name, channel, callback, prefetch_count, max_unacked_bytes, ack_batch_size):
+        self.name = name
+        self.queue_name = queue_name
+        self.channel = channel
+        self.callback = callback
+        self.prefetch_count = prefetch_count
+        self.effective_prefetch_count = prefetch_count
+        self.max_unacked_bytes = max_unacked_bytes
+        # A group larger than the window could only be flushed by the timer
+        self.ack_batch_size = max(1, min(ack_batch_size, prefetch_count))
+
+        self.unacked_count = 0
+        self.unacked_bytes = 0
+        # Processed messages waiting for the group ack, and deliveries not processed yet; a callback
+        # may hold a delivery past later ones (lean inputs wait for their batch to join)
+        self.processed_tags = []
+        self.in_flight_tags = set()
+        self.ack_flush_scheduled = False
+
+        self.delivered = 0
+        self.avg_message_bytes = 0.0
+        self.lag = None
+        # Values this stream last added to the stream gauges, which sum every session of the process
+        self._reported = {}
+
+    def record_delivery(self, size: int, delivery_tag=None):
+        self.delivered += 1
+        if delivery_tag is not None:
+            self.in_flight_tags.add(delivery_tag)
+        self.unacked_bytes += size
+        if self.avg_message_bytes == 0:
+            self.avg_message_bytes = float(size)
+        else:
+            self.avg_message_bytes += MESSAGE_SIZE_EWMA_WEIGHT * (size - self.avg_message_bytes)
+
+    def window_for_byte_limit(self) -> int:
+        """Prefetch count that keeps the expected unacked bytes under max_unacked_bytes."""
+        if not self.max_unacked_bytes or self.avg_message_bytes <= 0:
+            return self.prefetch_count
+        return max(1, min(self.prefetch_count, int(self.max_unacked_bytes // self.avg_message_bytes)))
+
+    def report_metrics(self):
+        """Move the stream gauges by the change of this stream's values since the last report."""
+        values = {
+            STREAM_LAG_MESSAGES: self.lag or 0,
+            STREAM_UNACKED_MESSAGES: self.unacked_count,
+            STREAM_UNACKED_BYTES: self.unacked_bytes,
+        }
+        for gauge, value in values.items():
+            gauge.inc(value - self._reported.get(gauge, 0), stream=self.name)
+            self._reported[gauge] = value
+
+    def clear_metrics(self):
+        """Take this stream's values back out of the stream gauges."""
+        for gauge, value in self._reported.items():
+            gauge.dec(value, stream=self.name)
+        self._reported = {}
+
+    def stats(self) -> dict:
+        return {
+            "queue": self.queue_name,
+            "lag": self.lag,
+            "delivered": self.delivered,
+            "unacked": self.unacked_count,
+            "unacked_bytes": self.unacked_bytes,
+            "prefetch": self.effective_prefetch_count,
+        }
 
 
 class Consumer:
     """
-    Consumer handles consuming from multiple queues using a shared connection
-    but with its own dedicated channel.
+    Consumer handles consuming from the inputs and outputs queues using a
+    shared connection, with a dedicated channel per queue so large input
+    batches never queue up in front of small prediction messages.
+
+    Each stream has its own prefetch window and an optional byte limit: once
+    the average message size is known, the channel-wide prefetch is lowered so
+    that the bytes in flight stay under `max_unacked_bytes`. Messages are
+    acknowledged in groups: callbacks call `ack` once a message has been
+    persisted, and the consumer sends a single `basic_ack(multiple=True)` for
+    the latest delivery tag of the stream after `ack_batch_size` messages,
+    `max_unacked_bytes` bytes or `ack_flush_interval_seconds`, whichever comes
+    first. A message may be acked after later ones (BatchHandler holds lean
+    inputs until their batch joins); while one is pending, the group ack stops
+    below it and later tags are acked one by one. On a crash only the unacked
+    messages are redelivered, and BatchHandler ignores duplicates.
     """
 
     def __init__(
@@ -17,60 +108,196 @@ class Consumer:
         inputs_callback=None,
         predictions_callback=None,
         logger=None,
+        inputs_prefetch_count=1,
+        outputs_prefetch_count=1,
+        ack_batch_size=1,
+        ack_flush_interval_seconds=0.5,
+        inputs_max_unacked_bytes=0,
+        outputs_max_unacked_bytes=0,
+        lag_report_interval_seconds=0,
+        before_ack=None,
     ):
         self.middleware = middleware
-        self.channel = self.middleware.create_channel(prefetch_count=1)  # new channel
         self.user_id = user_id
         self.logger = logger or logging.getLogger(f"consumer-{user_id}")
         self.inputs_queue_name = f"{user_id}_{INPUTS_QUEUE_NAME}"
         self.outputs_queue_name = f"{user_id}_{OUTPUTS_QUEUE_NAME}"
         self.inputs_callback = inputs_callback  # Callback for inputs queue
         self.predictions_callback = predictions_callback  # Callback for replies queue
+        self.ack_flush_interval_seconds = ack_flush_interval_seconds
+        self.lag_report_interval_seconds = lag_report_interval_seconds
+        # Called before a group is acked, e.g. to make the group's writes durable
+        self.before_ack = before_ack
         self._shutdown_initiated = False
 
+        self.inputs_stream = ConsumerStream(
+            name="inputs",
+            queue_name=self.inputs_queue_name,
+            channel=None,
+            callback=self._inputs_callback,
+            prefetch_count=inputs_prefetch_count,
+            max_unacked_bytes=inputs_max_unacked_bytes,
+            ack_batch_size=ack_batch_size,
+        )
+        self.outputs_stream = ConsumerStream(
+            name="outputs",
+            queue_name=self.outputs_queue_name,
+            channel=None,
+            callback=self._predictions_callback,
+            prefetch_count=outputs_prefetch_count,
+            max_unacked_bytes=outputs_max_unacked_bytes,
+            ack_batch_size=ack_batch_size,
+        )
+        self.streams = [self.inputs_stream, self.outputs_stream]
+        self._open_channels()
+
+    def _open_channels(self):
+        for stream in self.streams:
+            stream.channel = self.middleware.create_channel(prefetch_count=stream.prefetch_count)
+
     def start(self):
         """Declare/bind queues, start consuming, and ACK the original message."""
         try:
             self._setup_queues()
             if not self._shutdown_initiated:
-                self.middleware.start_consuming(self.channel)
+                if self.lag_report_interval_seconds > 0:
+                    self.middleware.call_later(self.lag_report_interval_seconds, self._report_lag)
+                # Events of every channel on the connection are dispatched from this loop
+                self.middleware.start_consuming(self.inputs_stream.channel)
         except pika.exceptions.AMQPConnectionError as e:
             self.logger.error(f"AMQP Connection error in Consumer for client {self.user_id}: {e}")
-            raise e 
+            raise e
         except Exception as e:
             self.logger.error(f"Error in Consumer for client {self.user_id}: {e}")
         finally:
             self.finish()
 
+    def _stream_for(self, ch) -> ConsumerStream:
+        return self.outputs_stream if ch is self.outputs_stream.channel else self.inputs_stream
+
+    def _on_delivery(self, stream: ConsumerStream, method, body):
+        stream.record_delivery(len(body), method.delivery_tag)
+        window = stream.window_for_byte_limit()
+        if window != stream.effective_prefetch_count:
+            # Channel-wide limit on top of the per-consumer one, so it applies to the running consumer
+            self.middleware.set_prefetch(stream.channel, window, global_qos=True)
+            stream.effective_prefetch_count = window
+
     def _inputs_callback(self, ch, method, properties, body):
         """Wrapper callback for inputs queue messages."""
+        self._on_delivery(self.inputs_stream, method, body)
         if self.inputs_callback:
-            self.inputs_callback(ch, method, properties, body)
+            return self._run_callback(self.inputs_stream, self.inputs_callback, ch, method, properties, body)
 
     def _predictions_callback(self, ch, method, properties, body):
         """Wrapper callback for predictions queue messages."""
+        self._on_delivery(self.outputs_stream, method, body)
         if self.predictions_callback:
-            self.predictions_callback(ch, method, properties, body)
+            return self._run_callback(self.outputs_stream, self.predictions_callback, ch, method, properties, body)
+
+    @staticmethod
+    def _run_callback(stream: ConsumerStream, callback, ch, method, properties, body):
+        try:
+            return callback(ch, method, properties, body)
+        except Exception:
+            # The middleware nacks the message, it no longer holds back the group acks
+            stream.in_flight_tags.discard(method.delivery_tag)
+            raise
+
+    def ack(self, ch, delivery_tag):
+        """Mark a message as processed; the ack is sent with the rest of its group."""
+        stream = self._stream_for(ch)
+        stream.in_flight_tags.discard(delivery_tag)
+        stream.processed_tags.append(delivery_tag)
+        stream.unacked_count += 1
+        if stream.unacked_count >= stream.ack_batch_size or (
+            stream.max_unacked_bytes and stream.unacked_bytes >= stream.max_unacked_bytes
+        ):
+            self._flush_stream_acks(stream)
+        elif not stream.ack_flush_scheduled:
+            stream.ack_flush_scheduled = True
+            self.middleware.call_later(self.ack_flush_interval_seconds, lambda: self._on_ack_flush_timer(stream))
+
+    def nack(self, ch, delivery_tag):
+        """Requeue a message that could not be processed."""
+        self._stream_for(ch).in_flight_tags.discard(delivery_tag)
+        if ch.is_open:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+    def _on_ack_flush_timer(self, stream: ConsumerStream):
+        stream.ack_flush_scheduled = False
+        self._flush_stream_acks(stream)
+
+    def _flush_stream_acks(self, stream: ConsumerStream):
+        if stream.unacked_count == 0:
+            return
+        if self.before_ack:
+            self.before_ack()
+        # multiple=True must not cover a delivery still in flight: tags past the oldest one are acked one by one
+        oldest = min(stream.in_flight_tags, default=None)
+        covered = [tag for tag in stream.processed_tags if oldest is None or tag < oldest]
+        if stream.channel and stream.channel.is_open:
+            if covered:
+                stream.channel.basic_ack(delivery_tag=max(covered), multiple=True)
+            for tag in sorted(tag for tag in stream.processed_tags if oldest is not None and tag > oldest):
+                stream.channel.basic_ack(delivery_tag=tag, multiple=False)
+        stream.unacked_count = 0
+        stream.unacked_bytes = 0
+        stream.processed_tags = []
+
+    def flush_acks(self):
+        """Acknowledge every processed message up to the latest delivery tag of each stream."""
+        for stream in self.streams:
+            self._flush_stream_acks(stream)
+
+    def _report_lag(self):
+        """Sample the broker backlog of each stream and schedule the next sample."""
+        if self._shutdown_initiated:
+            return
+        for stream in self.streams:
+            try:
+                stream.lag = self.middleware.get_message_count(stream.queue_name)
+            except Exception as e:
+                self.logger.warning(f"Could not read lag of {stream.queue_name}: {e}")
+                continue
+            self._record_lag(stream)
+        self.middleware.call_later(self.lag_report_interval_seconds, self._report_lag)
+
+    def _record_lag(self, stream: ConsumerStream):
+        stream.report_metrics()
+        self.logger.info(
+            f"action: stream_lag | user_id: {self.user_id} | stream: {stream.name} | "
+            f"lag: {stream.lag} | unacked: {stream.unacked_count} | "
+            f"unacked_bytes: {stream.unacked_bytes} | prefetch: {stream.effective_prefetch_count}"
+        )
+
+    def stream_stats(self) -> dict:
+        """Current lag and flow-control state of each stream, keyed by stream name."""
+        return {stream.name: stream.stats() for stream in self.streams}
 
     def handle_sigterm(self):
         self._shutdown_initiated = True
-        self.middleware.stop_consuming(self.channel)
+        self.middleware.stop_consuming(self.outputs_stream.channel)
+        self.middleware.stop_consuming(self.inputs_stream.channel)
 
     def finish(self):
         """Gracefully shutdown the consumer."""
-        self.middleware.close_channel(self.channel)
+        try:
+            self.flush_acks()
+        except Exception as e:
+            self.logger.error(f"Error flushing acks for client {self.user_id}: {e}")
+        for stream in self.streams:
+            stream.clear_metrics()
+            self.middleware.close_channel(stream.channel)
         self.middleware.close_connection()
         self.logger.info(f"Consumer shutdown complete for client {self.user_id}")
 
     def _setup_queues(self):
         self.middleware.declare_queue(
-            self.channel, self.inputs_queue_name, durable=True
-        )
-
-        self.middleware.basic_consume(
-            self.channel, self.inputs_queue_name, self._inputs_callback
+            self.inputs_stream.channel, self.inputs_queue_name, durable=True
         )
 
-        self.middleware.basic_consume(
-            self.channel, self.outputs_queue_name, self._predictions_callback
-        )
+        for stream in self.streams:
+            self.middleware.basic_consume(
+                stream.channel, stream.queue_name, stream.callback
+            )
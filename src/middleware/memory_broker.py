@@ -0,0 +1,459 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+import pika
+import pika.exceptions
+import pika.frame
+import pika.spec
+
+from src.middleware.connection_manager import ConnectionManager
+from src.middleware.middleware import Middleware
+
+
+def _topic_matches(pattern: str, routing_key: str) -> bool:
+    """AMQP topic matching: `*` matches one word, `#` zero or more."""
+
+    def match(p, k):
+        if not p:
+            return not k
+        if p[0] == "#":
+            return any(match(p[1:], k[i:]) for i in range(len(k) + 1))
+        if not k:
+            return False
+        return (p[0] == "*" or p[0] == k[0]) and match(p[1:], k[1:])
+
+    return match(pattern.split("."), routing_key.split(".") if routing_key else [])
+
+
+class _Message:
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties or pika.BasicProperties()
+        self.redelivered = False
+
+
+class _Consumer:
+    def __init__(self, tag, channel, queue_name, callback, prefetch_count):
+        self.tag = tag
+        self.channel = channel
+        self.queue_name = queue_name
+        self.callback = callback
+        self.prefetch_count = prefetch_count
+        self.in_flight = 0
+        self.active = True
+
+    def has_room(self) -> bool:
+        return self.active and (self.prefetch_count == 0 or self.in_flight < self.prefetch_count)
+
+
+class _Queue:
+    def __init__(self, name, durable):
+        self.name = name
+        self.durable = durable
+        self.messages = deque()
+        self.consumers = []
+        self._next_consumer = 0
+
+    def next_consumer(self):
+        """Round-robin over the consumers that can take one more message."""
+        for _ in range(len(self.consumers)):
+            consumer = self.consumers[self._next_consumer % len(self.consumers)]
+            self._next_consumer += 1
+            if consumer.has_room() and consumer.channel.has_room():
+                return consumer
+        return None
+
+
+class _Exchange:
+    def __init__(self, name, exchange_type):
+        self.name = name
+        self.exchange_type = exchange_type
+        self.bindings = []  # (queue name, routing key)
+
+    def route(self, routing_key):
+        if self.exchange_type == "fanout":
+            return [queue_name for queue_name, _ in self.bindings]
+        if self.exchange_type == "topic":
+            return [queue_name for queue_name, key in self.bindings if _topic_matches(key, routing_key)]
+        return [queue_name for queue_name, key in self.bindings if key == routing_key]
+
+
+class InMemoryBroker:
+    """
+    In-process stand-in for RabbitMQ with exchanges (direct, fanout, topic and
+    the default exchange), queues, per-consumer and channel-wide prefetch,
+    manual acks/nacks and redelivery of unacked messages when a channel is
+    closed. Clients talk to it through `connect()`, which returns an object
+    with the BlockingConnection surface the middleware uses.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("memory-broker")
+        self._lock = threading.RLock()
+        self._queues = {}
+        self._exchanges = {"": _Exchange("", "direct")}
+        self._consumer_tags = itertools.count(1)
+        self._channel_numbers = itertools.count(1)
+
+    def connect(self) -> "InMemoryConnection":
+        return InMemoryConnection(self)
+
+    # Topology
+
+    def declare_exchange(self, name, exchange_type="direct"):
+        with self._lock:
+            self._exchanges.setdefault(name, _Exchange(name, exchange_type))
+
+    def declare_queue(self, name, durable=False, passive=False) -> int:
+        with self._lock:
+            if name not in self._queues:
+                if passive:
+                    raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{name}'")
+                self._queues[name] = _Queue(name, durable)
+            return len(self._queues[name].messages)
+
+    def bind_queue(self, queue_name, exchange_name, routing_key):
+        with self._lock:
+            exchange = self._exchange(exchange_name)
+            self._queue(queue_name)
+            if (queue_name, routing_key) not in exchange.bindings:
+                exchange.bindings.append((queue_name, routing_key))
+
+    def delete_queue(self, name):
+        with self._lock:
+            q = self._queues.pop(name, None)
+            if q is None:
+                return
+            for consumer in q.consumers:
+                consumer.active = False
+            for exchange in self._exchanges.values():
+                exchange.bindings = [b for b in exchange.bindings if b[0] != name]
+
+    def _queue(self, name) -> _Queue:
+        if name not in self._queues:
+            raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{name}'")
+        return self._queues[name]
+
+    def _exchange(self, name) -> _Exchange:
+        if name not in self._exchanges:
+            raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no exchange '{name}'")
+        return self._exchanges[name]
+
+    # Messages
+
+    def publish(self, exchange_name, routing_key, body, properties=None):
+        with self._lock:
+            exchange = self._exchange(exchange_name)
+            if exchange_name == "":
+                targets = [routing_key] if routing_key in self._queues else []
+            else:
+                targets = exchange.route(routing_key)
+            for queue_name in dict.fromkeys(targets):
+                q = self._queues.get(queue_name)
+                if q is not None:
+                    q.messages.append(_Message(exchange_name, routing_key, body, properties))
+                    self._dispatch(q)
+
+    def add_consumer(self, channel, queue_name, callback, consumer_tag=None) -> str:
+        with self._lock:
+            q = self._queue(queue_name)
+            tag = consumer_tag or f"ctag-{next(self._consumer_tags)}"
+            consumer = _Consumer(tag, channel, queue_name, callback, channel.prefetch_count)
+            q.consumers.append(consumer)
+            channel.consumers[tag] = consumer
+            self._dispatch(q)
+            return tag
+
+    def cancel_consumer(self, consumer: _Consumer):
+        with self._lock:
+            consumer.active = False
+            q = self._queues.get(consumer.queue_name)
+            if q is not None and consumer in q.consumers:
+                q.consumers.remove(consumer)
+
+    def settle(self, channel, delivery_tag, multiple, requeue=None):
+        """Ack (requeue is None) or nack the given delivery of a channel."""
+        with self._lock:
+            if multiple:
+                tags = [tag for tag in channel.unacked if tag <= delivery_tag]
+            elif delivery_tag in channel.unacked:
+                tags = [delivery_tag]
+            else:
+                tags = []
+            if not tags and delivery_tag != 0:
+                raise pika.exceptions.ChannelClosedByBroker(406, f"PRECONDITION_FAILED - unknown delivery tag {delivery_tag}")
+            self._release(channel, tags, requeue=bool(requeue))
+
+    def _release(self, channel, tags, requeue):
+        touched = set()
+        for tag in sorted(tags, reverse=True):
+            consumer, message = channel.unacked.pop(tag)
+            consumer.in_flight -= 1
+            q = self._queues.get(consumer.queue_name)
+            if q is None:
+                continue
+            if requeue:
+                message.redelivered = True
+                q.messages.appendleft(message)
+            touched.add(q.name)
+        # Freed prefetch room may unblock any queue consumed on this channel
+        touched.update(consumer.queue_name for consumer in channel.consumers.values())
+        for name in touched:
+            if name in self._queues:
+                self._dispatch(self._queues[name])
+
+    def close_channel(self, channel):
+        with self._lock:
+            for consumer in list(channel.consumers.values()):
+                self.cancel_consumer(consumer)
+            self._release(channel, list(channel.unacked), requeue=True)
+            channel.consumers.clear()
+
+    def _dispatch(self, q: _Queue):
+        while q.messages:
+            consumer = q.next_consumer()
+            if consumer is None:
+                return
+            message = q.messages.popleft()
+            channel = consumer.channel
+            tag = channel.next_delivery_tag()
+            channel.unacked[tag] = (consumer, message)
+            consumer.in_flight += 1
+            channel.connection._post(channel._deliver, consumer, tag, message)
+
+    def next_channel_number(self) -> int:
+        return next(self._channel_numbers)
+
+    def queue_stats(self) -> dict:
+        """Ready messages, unacked messages and consumers of each queue."""
+        with self._lock:
+            unacked = {}
+            for q in self._queues.values():
+                for consumer in q.consumers:
+                    unacked[q.name] = unacked.get(q.name, 0) + consumer.in_flight
+            return {
+                name: {"ready": len(q.messages), "unacked": unacked.get(name, 0), "consumers": len(q.consumers)}
+                for name, q in self._queues.items()
+            }
+
+
+class InMemoryChannel:
+    """Channel of an InMemoryConnection, mirroring the BlockingChannel methods the middleware calls."""
+
+    def __init__(self, connection: "InMemoryConnection"):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = self.broker.next_channel_number()
+        self.is_open = True
+        self.prefetch_count = 0
+        self.global_prefetch_count = 0
+        self.consumers = {}
+        self.unacked = {}
+        self._delivery_tags = itertools.count(1)
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    def _check_open(self):
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+
+    def next_delivery_tag(self) -> int:
+        return next(self._delivery_tags)
+
+    def has_room(self) -> bool:
+        return self.is_open and (self.global_prefetch_count == 0 or len(self.unacked) < self.global_prefetch_count)
+
+    def _deliver(self, consumer: _Consumer, tag, message: _Message):
+        if not consumer.active or not self.is_open:
+            return  # stays unacked until the channel is closed, then it is requeued
+        method = pika.spec.Basic.Deliver(
+            consumer_tag=consumer.tag,
+            delivery_tag=tag,
+            redelivered=message.redelivered,
+            exchange=message.exchange,
+            routing_key=message.routing_key,
+        )
+        consumer.callback(self, method, message.properties, message.body)
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        self._check_open()
+        if global_qos:
+            self.global_prefetch_count = prefetch_count
+            with self.broker._lock:
+                for name in {c.queue_name for c in self.consumers.values()}:
+                    if name in self.broker._queues:
+                        self.broker._dispatch(self.broker._queues[name])
+        else:
+            self.prefetch_count = prefetch_count
+
+    def exchange_declare(self, exchange, exchange_type="direct", durable=False):
+        self._check_open()
+        self.broker.declare_exchange(exchange, exchange_type)
+
+    def queue_declare(self, queue, durable=False, passive=False, exclusive=False):
+        # exclusive is accepted for compatibility; every user of the broker shares its process
+        self._check_open()
+        try:
+            message_count = self.broker.declare_queue(queue, durable=durable, passive=passive)
+        except pika.exceptions.ChannelClosedByBroker:
+            self.close()  # as RabbitMQ does with a 404 on a passive declare
+            raise
+        return pika.frame.Method(self.channel_number, pika.spec.Queue.DeclareOk(queue, message_count, 0))
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        self._check_open()
+        self.broker.bind_queue(queue, exchange, routing_key if routing_key is not None else queue)
+
+    def queue_delete(self, queue):
+        self._check_open()
+        self.broker.delete_queue(queue)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, consumer_tag=None):
+        self._check_open()
+        if auto_ack:
+            raise ValueError("auto_ack is not supported by the in-memory broker")
+        return self.broker.add_consumer(self, queue, on_message_callback, consumer_tag)
+
+    def basic_cancel(self, consumer_tag):
+        consumer = self.consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            self.broker.cancel_consumer(consumer)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self._check_open()
+        self.broker.publish(exchange, routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._check_open()
+        self.broker.settle(self, delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._check_open()
+        self.broker.settle(self, delivery_tag, multiple, requeue=requeue)
+
+    def start_consuming(self):
+        """Dispatch events on the calling thread until every consumer of this channel is cancelled."""
+        while self.consumers and self.is_open and not self.connection.is_closed:
+            self.connection.process_data_events(time_limit=0.5)
+
+    def stop_consuming(self, consumer_tag=None):
+        for tag in [consumer_tag] if consumer_tag else list(self.consumers):
+            self.basic_cancel(tag)
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        self.broker.close_channel(self)
+
+
+class InMemoryConnection:
+    """
+    Connection to an InMemoryBroker with the BlockingConnection surface.
+
+    Deliveries, threadsafe callbacks and timers are queued on the connection
+    and run by whichever thread calls `process_data_events` (or a channel's
+    `start_consuming`), as with pika's blocking adapter.
+    """
+
+    def __init__(self, broker: InMemoryBroker):
+        self.broker = broker
+        self.is_closed = False
+        self._events = queue.Queue()
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._timers_lock = threading.Lock()
+        self._channels = []
+
+    @property
+    def is_open(self) -> bool:
+        return not self.is_closed
+
+    def _post(self, func, *args):
+        self._events.put((func, args))
+
+    def channel(self) -> InMemoryChannel:
+        if self.is_closed:
+            raise pika.exceptions.ConnectionWrongStateError("Connection is closed")
+        channel = InMemoryChannel(self)
+        self._channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        if self.is_closed:
+            raise pika.exceptions.ConnectionWrongStateError("Connection is closed")
+        self._post(callback)
+
+    def call_later(self, delay, callback):
+        timer_id = next(self._timer_ids)
+        with self._timers_lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, timer_id, callback))
+        self._post(None)  # recompute the wait
+        return timer_id
+
+    def _run_due_timers(self):
+        while True:
+            with self._timers_lock:
+                if not self._timers:
+                    return None
+                deadline, _, callback = self._timers[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                heapq.heappop(self._timers)
+            callback()
+
+    def process_data_events(self, time_limit=0):
+        next_timer = self._run_due_timers()
+        timeout = time_limit if next_timer is None else min(next_timer, time_limit)
+        try:
+            func, args = self._events.get(timeout=timeout) if timeout > 0 else self._events.get_nowait()
+        except queue.Empty:
+            self._run_due_timers()
+            return
+        while True:
+            if func is not None:
+                func(*args)
+            try:
+                func, args = self._events.get_nowait()
+            except queue.Empty:
+                break
+        self._run_due_timers()
+
+    def close(self):
+        if self.is_closed:
+            return
+        for channel in self._channels:
+            channel.close()
+        self.is_closed = True
+
+
+class InMemoryMiddleware(Middleware):
+    """Middleware whose connection is an InMemoryBroker connection instead of a RabbitMQ one."""
+
+    def __init__(self, config, broker: InMemoryBroker):
+        self.broker = broker
+        super().__init__(config)
+
+    def connect(self):
+        self.conn = self.broker.connect()
+        self.logger.info("Connected to in-memory broker")
+
+
+def in_memory_connection_manager(config, broker: InMemoryBroker) -> ConnectionManager:
+    """Connection pool for SessionMiddleware whose connections are opened on the in-memory broker."""
+    return ConnectionManager(
+        config,
+        max_connections=config.max_shared_connections,
+        sessions_per_connection=config.sessions_per_connection,
+        connection_factory=broker.connect,
+    )
@@ -3,7 +3,19 @@ import time
 import pika
 import pika.exceptions
 
-from src.lib.config import CONNECTION_EXCHANGE, CONNECTION_QUEUE_NAME
+from src.lib.config import CONNECTION_EXCHANGE, CONNECTION_QUEUE_NAME, CONTROL_EXCHANGE
+
+
+def connection_parameters(config) -> pika.ConnectionParameters:
+    """Build the pika connection parameters for the given middleware config."""
+    credentials = pika.PlainCredentials(config.username, config.password)
+    return pika.ConnectionParameters(
+        host=config.host,
+        port=config.port,
+        credentials=credentials,
+        heartbeat=5000
+    )
+
 
 class Middleware:
     def __init__(self, config):
@@ -14,6 +26,7 @@ class Middleware:
         self._is_running = False
         self._on_callback = True
         self._shutdown_received = False
+        self._management_channel = None
         
         self.connect()
 
@@ -23,15 +36,7 @@ class Middleware:
         max_delay = 60 # maximum delay of 1 minute
         while not self._shutdown_received:
             try:
-                credentials = pika.PlainCredentials(self.config.username, self.config.password)
-                self.conn = pika.BlockingConnection(
-                    pika.ConnectionParameters(
-                        host=self.config.host, 
-                        port=self.config.port, 
-                        credentials=credentials, 
-                        heartbeat=5000
-                    )
-                )
+                self.conn = pika.BlockingConnection(connection_parameters(self.config))
                 self.logger.info(
                     f"Connected to RabbitMQ at {self.config.host}:{self.config.port} as {self.config.username}"
                 )
@@ -62,6 +67,12 @@ class Middleware:
             f"Queue '{queue_name}' created and bound to exchange '{connection_exchange}'"
         )
 
+    def setup_control_queue(self, channel, queue_name: str):
+        """Exclusive queue of this replica on the control fanout exchange; removed with the connection."""
+        self.declare_exchange(channel, CONTROL_EXCHANGE, exchange_type="fanout")
+        channel.queue_declare(queue=queue_name, exclusive=True)
+        self.bind_queue(channel, queue_name, CONTROL_EXCHANGE, routing_key="")
+
     def create_channel(self, prefetch_count=1):
         """Create and return a new channel from the shared connection."""
         # Ensure the connection is alive
@@ -80,6 +91,17 @@ class Middleware:
             channel.basic_qos(prefetch_count=prefetch_count)
             return channel
 
+    def set_prefetch(self, channel, prefetch_count: int, global_qos: bool = False):
+        """
+        Set the prefetch window. Per-consumer windows (the default) apply to consumers
+        registered on the channel from now on; global_qos limits the whole channel immediately.
+        """
+        try:
+            channel.basic_qos(prefetch_count=prefetch_count, global_qos=global_qos)
+        except Exception as e:
+            self.logger.error(f"Failed to set prefetch count {prefetch_count}: {e}")
+            raise e
+
     def declare_queue(self, channel, queue_name: str, durable: bool = False):
         try:
             channel.queue_declare(queue=queue_name, durable=durable)
@@ -88,6 +110,20 @@ class Middleware:
             self.logger.error(f"Failed to declare queue '{queue_name}': {e}")
             raise e
 
+    def get_message_count(self, queue_name: str) -> int:
+        """
+        Return the number of messages ready for delivery in an existing queue.
+
+        The passive declare runs on a management channel of its own: the broker
+        closes the channel when the queue is missing, and a consuming channel
+        would go down with it. A closed management channel is reopened on the
+        next call.
+        """
+        if self._management_channel is None or not self._management_channel.is_open:
+            self._management_channel = self.create_channel()
+        result = self._management_channel.queue_declare(queue=queue_name, passive=True)
+        return result.method.message_count
+
     def declare_exchange(
         self,
         channel,
@@ -173,6 +209,12 @@ class Middleware:
         else:
             self.logger.error("Cannot add callback, connection is closed.")
 
+    def call_later(self, delay: float, func):
+        """Run func on the connection's thread after delay seconds."""
+        if self.conn is not None and not self.conn.is_closed:
+            return self.conn.call_later(delay, func)
+        self.logger.error("Cannot schedule callback, connection is closed.")
+
     def start_consuming(self, channel):
         try:
             self._is_running = True
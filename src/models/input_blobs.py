@@ -0,0 +1,20 @@
+import datetime
+from src.lib.db_engine import Base
+from sqlalchemy import Column, DateTime, Integer, LargeBinary, String
+
+
+class InputBlobs(Base):
+    """Input batches stored once by content; model_inputs rows point at them by digest."""
+
+    __tablename__ = "input_blobs"
+
+    # sha256 of the uncompressed body
+    digest = Column(String(64), primary_key=True)
+    body = Column(LargeBinary, nullable=False)
+    codec = Column(String(16), nullable=False, server_default="none")
+    # Number of model_inputs rows pointing at the blob; it is deleted when this reaches 0
+    refcount = Column(Integer, nullable=False, default=0)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self) -> str:
+        return f"InputBlobs(digest={self.digest}, refcount={self.refcount}, codec={self.codec})"
@@ -2,17 +2,25 @@
 
 import datetime
 from src.lib.db_engine import Base
-from sqlalchemy import Column, DateTime, Integer, LargeBinary
+from sqlalchemy import Column, Date, DateTime, Integer, LargeBinary, String
 from sqlalchemy.dialects.postgresql import UUID
 
 
 class ModelInputs(Base):
     __tablename__ = "model_inputs"
+    # On PostgreSQL, one partition per DB_PARTITION_DAYS range of session start days (src/database/partitions.py)
+    __table_args__ = {"postgresql_partition_by": "RANGE (partition_day)"}
 
     session_id = Column(UUID(as_uuid=True), nullable=False, primary_key=True)
     batch_index = Column(Integer, nullable=False, primary_key=True)
+    # Day the session started (stored_sessions), the same for all its rows; part of the key because it is the partition key
+    partition_day = Column(Date, nullable=False, primary_key=True)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    # Inline body, for rows written without deduplication; otherwise NULL and stored in input_blobs
     inputs = Column(LargeBinary)
+    digest = Column(String(64), nullable=True)
+    # Codec the stored body was compressed with (src/database/codecs.py)
+    codec = Column(String(16), nullable=False, server_default="none")
 
     def __repr__(self) -> str:
         return f"ModelInputs(session_id={self.session_id}, batch_index={self.batch_index}, inputs={self.inputs}, labels={self.labels})"
\ No newline at end of file
@@ -2,17 +2,23 @@
 
 from datetime import datetime
 from src.lib.db_engine import Base
-from sqlalchemy import Column, DateTime, Integer, LargeBinary, String
+from sqlalchemy import Column, Date, DateTime, Integer, LargeBinary, String
 from sqlalchemy.dialects.postgresql import UUID
 
 
 class ModelOutputs(Base):
     __tablename__ = "model_outputs"
+    # On PostgreSQL, one partition per DB_PARTITION_DAYS range of session start days (src/database/partitions.py)
+    __table_args__ = {"postgresql_partition_by": "RANGE (partition_day)"}
 
     session_id = Column(UUID(as_uuid=True), nullable=False, primary_key=True)
     batch_index = Column(Integer, nullable=False, primary_key=True)
+    # Day the session started (stored_sessions), the same for all its rows; part of the key because it is the partition key
+    partition_day = Column(Date, nullable=False, primary_key=True)
     timestamp = Column(DateTime, default=datetime.utcnow)
     outputs = Column(LargeBinary)
+    # Codec the stored body was compressed with (src/database/codecs.py)
+    codec = Column(String(16), nullable=False, server_default="none")
 
     def __repr__(self) -> str:
         return f"ModelOutputs(user_id={self.user_id}, status={self.status}, outputs={self.outputs})"
\ No newline at end of file
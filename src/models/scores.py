@@ -10,17 +10,22 @@ class Scores(Base):
 
     session_id = Column(UUID(as_uuid=True), primary_key=True)
     batchs_counter = Column(Integer, default=0, nullable=False)
+    samples_counter = Column(Integer, default=0, nullable=False)
     stage = Column(SqEnum(CalibrationStage), nullable=False, default=CalibrationStage.INITIAL_CALIBRATION)
     
     # Variables del UQ
     alpha = Column(Float, nullable=True)
     scores = Column(LargeBinary, nullable=True)
+    # Sorted scores of each class: int64 offsets (one per class, plus the end) then the float64 scores
+    class_scores = Column(LargeBinary, nullable=True)
 
     confidences = Column(LargeBinary, nullable=True)   
     alphas = Column(ARRAY(Float), default=[], nullable=True)         
     uncertainties = Column(ARRAY(Float), default=[], nullable=True)  
     coverages = Column(ARRAY(Float), default=[], nullable=True)      
     setsizes = Column(ARRAY(Integer), default=[], nullable=True) 
+    # Batches already counted in this state; NULL for sessions started before it was recorded
+    processed_batches = Column(ARRAY(Integer), default=[], nullable=True)
     accuracy = Column(Float, default=0.0)
     correct_preds = Column(Integer, default=0)
     total_samples = Column(Integer, default=0)
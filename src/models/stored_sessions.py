@@ -0,0 +1,21 @@
+import datetime
+from src.lib.db_engine import Base
+from sqlalchemy import Column, Date, DateTime, String
+from sqlalchemy.dialects.postgresql import UUID
+
+
+class StoredSessions(Base):
+    """Sessions with rows in model_inputs/model_outputs, and when they finished; drives the retention purge."""
+
+    __tablename__ = "stored_sessions"
+
+    session_id = Column(UUID(as_uuid=True), primary_key=True)
+    # Partition key of the session's batch rows: the (UTC) day of its first write
+    partition_day = Column(Date, nullable=False, index=True)
+    started_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Set when the session ends as COMPLETED or TIMEOUT; NULL while it may still be resumed
+    finished_at = Column(DateTime, nullable=True)
+    status = Column(String(16), nullable=True)
+
+    def __repr__(self) -> str:
+        return f"StoredSessions(session_id={self.session_id}, partition_day={self.partition_day}, status={self.status})"
@@ -0,0 +1,256 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from server.batch_handler import BatchHandler
+import pika.exceptions
+
+from src.database.db import Database
+from src.lib.db_engine import get_engine
+from src.lib.spill_store import build_spill_store
+from src.middleware.async_middleware import AsyncConsumer, AsyncMiddleware
+from src.server.session_lifecycle import STATUS_FLUSH_TIMEOUT_SECONDS, SessionLifecycle
+
+
+class AsyncSessionEngine:
+    """
+    Event loop shared by every session of the process. It runs on its own
+    thread and owns one AsyncMiddleware (one broker connection) and the
+    executor where the blocking work of the sessions (database, UQ) runs.
+    """
+
+    def __init__(self, config, max_workers=None, middleware=None, logger=None):
+        self.config = config
+        self.logger = logger or logging.getLogger("async-session-engine")
+        self.loop = asyncio.new_event_loop()
+        self.middleware = middleware or AsyncMiddleware(config)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="session-worker")
+        self._thread = threading.Thread(target=self._run_loop, name="session-loop", daemon=True)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+        self.submit(self.middleware.connect()).result()
+        self.logger.info("Async session engine started")
+
+    def submit(self, coro):
+        """Schedule a coroutine on the engine's loop; returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, func, *args):
+        self.loop.call_soon_threadsafe(func, *args)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Run a blocking call in the executor and await its result."""
+        return await self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.call_soon(self.middleware.close_connection)
+            self.call_soon(self.loop.stop)
+            self._thread.join()
+        self.executor.shutdown(wait=True)
+        self.logger.info("Async session engine stopped")
+
+
+class LoopPublisher:
+    """
+    Middleware handed to BatchHandler by AsyncClientManager. BatchHandler runs
+    in executor threads, so publishing is forwarded to the event loop on a
+    channel that was opened there beforehand.
+    """
+
+    def __init__(self, middleware, channel):
+        self._middleware = middleware
+        self._channel = channel
+
+    def create_channel(self, prefetch_count=1):
+        return self._channel
+
+    def basic_send(self, channel, exchange_name: str, routing_key: str, body: bytes, properties=None):
+        self._middleware.add_callback_threadsafe(
+            lambda: self._middleware.basic_send(channel, exchange_name, routing_key, body, properties)
+        )
+
+
+class AsyncClientManager(SessionLifecycle):
+    """
+    Session driven by an AsyncSessionEngine instead of a dedicated process.
+
+    Consumption, acks and publishing happen on the shared event loop; message
+    handling and the other blocking calls go to the engine's executor. The
+    messages of a session are handled one at a time, in delivery order, so
+    BatchHandler needs no locking and grouped acks stay correct. It exposes
+    the start/terminate/join/is_alive interface the Listener uses for
+    ClientManager processes.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncSessionEngine,
+        user_id: str,
+        session_id: str,
+        clients_to_remove_queue,
+        config,
+        report_builder,
+        utrace_calculator_factory,
+        inputs_format=None,
+        recipient_email=None,
+        connections_client=None,
+        timeout_scheduler=None,
+    ):
+        self._init_session(
+            user_id,
+            session_id,
+            clients_to_remove_queue,
+            config,
+            report_builder,
+            utrace_calculator_factory,
+            inputs_format=inputs_format,
+            recipient_email=recipient_email,
+            connections_client=connections_client,
+            timeout_scheduler=timeout_scheduler,
+        )
+        self.engine = engine
+        self.middleware = engine.middleware
+        self._eof_received = False
+        self._deliveries = None
+        self._future = None
+
+    # Listener interface
+
+    def start(self):
+        self._future = self.engine.submit(self.run())
+
+    def is_alive(self) -> bool:
+        return self._future is not None and not self._future.done()
+
+    def terminate(self):
+        self.engine.call_soon(self._initiate_shutdown)
+
+    def request_profile(self, duration_seconds=None, output_format=None):
+        """Sessions share the loop and executor threads, so one session cannot be profiled on its own."""
+        self.logger.warning(
+            f"action: profile | result: unsupported | session_id: {self.session_id} | engine: asyncio"
+        )
+        return False
+
+    def join(self, timeout=None):
+        if self._future is not None:
+            try:
+                self._future.result(timeout=timeout)
+            except Exception as e:
+                self.logger.error(f"ClientManager for client {self.user_id} failed: {e}")
+
+    # Session lifecycle (runs on the event loop)
+
+    async def run(self):
+        self._start_inactivity_timer()
+        self._deliveries = asyncio.Queue()
+        worker = None
+        publish_channel = None
+        spill_store = build_spill_store(self.config.server_config, self.session_id, logger=self.logger)
+
+        try:
+            self.logger.info(f"ClientManager started for client {self.user_id}")
+            self.database = await self.engine.run_blocking(
+                lambda: Database(get_engine(self.config.database_url, self.config.database_config))
+            )
+            self.utrace_calculator = await self.engine.run_blocking(
+                self.utrace_calculator_factory, database=self.database, session_id=self.session_id
+            )
+            publish_channel = await self.middleware.create_channel()
+            self.batch_handler = BatchHandler(
+                middleware=LoopPublisher(self.middleware, publish_channel),
+                database=self.database,
+                spill_store=spill_store,
+                call_later=self._call_later,
+                **self._batch_handler_settings(),
+            )
+            self.consumer = AsyncConsumer(middleware=self.middleware, **self._consumer_settings())
+            await self.engine.run_blocking(self.batch_handler._build_state)
+            if self._eof_received:
+                self._finish_session()
+
+            worker = asyncio.get_running_loop().create_task(self._process_deliveries())
+            if not self.shutdown_initiated:
+                await self.consumer.start()
+
+            if not self.shutdown_initiated and self.clients_to_remove_queue:
+                self.clients_to_remove_queue.put(self.user_id)
+
+        except pika.exceptions.AMQPConnectionError as e:
+            self.logger.error(f"AMQP Connection error in ClientManager for client {self.user_id}: {e}")
+        except Exception as e:
+            self.logger.error(f"Error setting up client {self.user_id}: {e}")
+        finally:
+            self.inactivity_timer.cancel()
+            if worker is not None:
+                self._deliveries.put_nowait(None)
+                await worker
+            if publish_channel is not None:
+                self.middleware.close_channel(publish_channel)
+            if spill_store:
+                spill_store.close()
+            await self.engine.run_blocking(self._record_session_end)
+            if self.connections_client:
+                await self.engine.run_blocking(self.connections_client.flush, timeout=STATUS_FLUSH_TIMEOUT_SECONDS)
+            self.logger.info(f"ClientManager for client {self.user_id} terminating")
+
+    def _handle_predictions_message(self, ch, method, properties, body):
+        self.logger.info(f"Received predictions message for client {self.user_id}")
+        self.inactivity_timer.touch()
+        self._deliveries.put_nowait((self.batch_handler._handle_predictions_message, ch, method, body))
+
+    def _handle_inputs_message(self, ch, method, properties, body):
+        self.logger.info(f"Received inputs message for client {self.user_id}")
+        self.inactivity_timer.touch()
+        self._deliveries.put_nowait((self.batch_handler._handle_inputs_message, ch, method, body))
+
+    def _call_later(self, delay: float, func):
+        """Run func in the executor after delay seconds, in order with the session's messages."""
+        self.engine.loop.call_soon_threadsafe(
+            self.engine.loop.call_later, delay, self._deliveries.put_nowait, (func, None, None, None)
+        )
+
+    async def _process_deliveries(self):
+        """Handle the session's messages in order in the executor; BatchHandler acks each one once it is persisted."""
+        while True:
+            delivery = await self._deliveries.get()
+            if delivery is None:
+                return
+            handler, ch, method, body = delivery
+            if ch is None:
+                # A BatchHandler timer (_call_later)
+                if not self._eof_received:
+                    await self.engine.run_blocking(handler)
+                continue
+            if self._eof_received or not ch.is_open:
+                continue  # not acked: redelivered if the session is resumed
+            try:
+                # The ack runs on the loop, before the next message is taken
+                await self.engine.run_blocking(
+                    handler, ch, body, ack=functools.partial(self.engine.call_soon, self.consumer.ack, ch, method.delivery_tag)
+                )
+            except Exception as e:
+                self.logger.error(f"action: handle_message | result: fail | user_id: {self.user_id} | error: {e}")
+                self.consumer.nack(ch, method.delivery_tag)
+            if self._eof_received:
+                self._finish_session()
+
+    def _finish_session(self):
+        """Stop consuming after the EOF message has been handled and acked."""
+        self.consumer.handle_sigterm()
+        self.batch_handler.handle_sigterm()
+
+    def _stop_after_eof(self):
+        """Runs in an executor thread: _process_deliveries stops consuming once the EOF message is acked."""
+        self._eof_received = True
+
+    def _schedule_shutdown(self):
+        """Called by the timeout scheduler thread; the shutdown itself runs on the event loop."""
+        self.engine.call_soon(self._initiate_shutdown)
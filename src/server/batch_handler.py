@@ -1,10 +1,24 @@
 import logging
-from typing import Dict, List, Union
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import numpy as np
 from proto import calibration_pb2, mlflow_probs_pb2, dataset_service_pb2
 from src.lib.calibration_stages import CalibrationStage
 from src.lib.data_types import DataType
 from src.lib.config import MLFLOW_EXCHANGE, MLFLOW_ROUTING_KEY
+from src.lib.metrics import (
+    BATCH_JOIN_WAIT_SECONDS,
+    BATCHES_BYTES,
+    DB_WRITE_SECONDS,
+    MESSAGE_BYTES_TOTAL,
+    MESSAGE_DECODE_SECONDS,
+    MESSAGES_TOTAL,
+    MLFLOW_PUBLISH_SECONDS,
+    PROCESS_ENTRY_SECONDS,
+    SPILLED_BYTES,
+)
+from src.lib.tracing import get_tracer
+from src.server.micro_batch import MicroBatchCoalescer
 from src.server.utrace_calculator import UtraceCalculator
 
 
@@ -18,11 +32,24 @@ class BatchHandler:
         utrace_calculator,
         database=None,
         inputs_format=None,
+        tracer=None,
+        inputs_persistence: str = "full",
+        spill_store=None,
+        memory_budget_bytes: int = 0,
+        coalesce_target_samples: int = 0,
+        coalesce_max_delay_seconds: float = 1.0,
+        call_later=None,
     ):
         self.user_id = user_id
         self._inputs_eof = False
         self._outputs_eof = False
         self._batches: Dict[int, Dict] = {}
+        self._first_seen: Dict[int, float] = {}
+        self._held_bytes = 0
+        # Arrays beyond the budget are moved to memory-mapped files of the spill store
+        self._spill_store = spill_store
+        self._memory_budget_bytes = memory_budget_bytes
+        self._spilled_bytes = 0
         self._on_eof = on_eof
         self._db = database
         self._middleware = middleware
@@ -30,16 +57,40 @@ class BatchHandler:
         self._session_id = session_id
         self._inputs_format = inputs_format
         self.uq = utrace_calculator
+        self._tracer = tracer or get_tracer()
+        # "lean" stores inputs without their images (only labels, batch index and EOF flag), once
+        # their batch joined and was forwarded to MLflow. Until then the delivery stays unacked, so a
+        # restart gets the images back from the broker instead of the database
+        self._lean_inputs = inputs_persistence == "lean"
+        # batch_index -> (lean body, ack) of inputs waiting for their predictions
+        self._held_inputs: Dict[int, Tuple[bytes, Optional[Callable[[], None]]]] = {}
+        self._coalescer = MicroBatchCoalescer(
+            self._process_micro_batch,
+            target_samples=coalesce_target_samples,
+            max_delay_seconds=coalesce_max_delay_seconds,
+            call_later=call_later,
+        )
 
     def _build_state(self):
-        inputs = self._db.get_inputs_from_session(self._session_id)
-        for input in inputs:
+        # Stream the stored batches so only one body is decoded at a time
+        for input in self._db.iter_inputs_from_session(self._session_id):
             self._restore_inputs_data(input)
-            
-        outputs = self._db.get_outputs_from_session(self._session_id)
-        for output in outputs:
+
+        for output in self._db.iter_outputs_from_session(self._session_id):
             self._restore_outputs_data(output)
 
+        # Joined batches still waiting in a micro-batch when the previous run stopped
+        unprocessed = sorted(
+            index for index, batch in self._batches.items()
+            if all(batch[kind] is not None for kind in (DataType.PROBS, DataType.LABELS)) and not self.uq.is_processed(index)
+        )
+        if unprocessed:
+            logging.info(
+                f"action: restore_micro_batch | session_id: {self._session_id} | batches: {unprocessed}"
+            )
+            for index in unprocessed:
+                self._coalescer.add(index, self._batches[index])
+
         if self._inputs_eof and self._outputs_eof:
             self._handle_eof()
          
@@ -64,7 +115,10 @@ class BatchHandler:
 
     def handle_sigterm(self):
         """Stop processing and clean up resources."""
-        pass
+        BATCHES_BYTES.dec(self._held_bytes)
+        self._held_bytes = 0
+        SPILLED_BYTES.dec(self._spilled_bytes)
+        self._spilled_bytes = 0
 
     def get_calibration_results(self):
         metrics = self.uq.get_calibration_results()
@@ -84,34 +138,46 @@ class BatchHandler:
 
 
 
-    def _handle_predictions_message(self, ch, body):
-        """Handle probability messages from the calibration queue."""
+    def _handle_predictions_message(self, ch, body, ack=None):
+        """Handle probability messages from the calibration queue; `ack` is called once the message is persisted."""
 
         try:
+            self._coalescer.flush_if_due()
+            MESSAGES_TOTAL.inc(kind="predictions")
+            MESSAGE_BYTES_TOTAL.inc(len(body), kind="predictions")
+            decode_start = time.perf_counter()
+            parse_start = time.time_ns()
             message = calibration_pb2.Predictions()
             message.ParseFromString(body)
+            parse_end = time.time_ns()
 
-            logging.info(
-                f"action: receive_predictions | result: success | eof {message.eof}"
-            )
+            with self._batch_span("batch.predictions", message.batch_index, parse_start) as span:
+                span.record_child("parse", parse_start, parse_end)
+                probs = np.array([list(pred_list.values) for pred_list in message.pred], dtype=np.float32)
+                MESSAGE_DECODE_SECONDS.observe(time.perf_counter() - decode_start, kind="predictions")
 
-            probs = np.array([list(pred_list.values) for pred_list in message.pred], dtype=np.float32)
-
-            if message.batch_index in self._batches and self._batches[message.batch_index][DataType.PROBS] is not None:
-                # Duplicate batch index received
-                logging.warning(
-                    f"Duplicate probabilities for batch {message.batch_index} from client {self.user_id}"
+                logging.info(
+                    f"action: receive_predictions | result: success | eof {message.eof}"
                 )
-                return
 
-            self.store_outputs(batch_index=message.batch_index, probs=probs, original_body=body, persist=True)
-            # scores = run_calibration_algorithm(probs) 
+                if message.batch_index in self._batches and self._batches[message.batch_index][DataType.PROBS] is not None:
+                    # Duplicate batch index received
+                    logging.warning(
+                        f"Duplicate probabilities for batch {message.batch_index} from client {self.user_id}"
+                    )
+                    span.set_attribute("duplicate", True)
+                    self._ack(ack)
+                    return
+
+                self.store_outputs(batch_index=message.batch_index, probs=probs, original_body=body, persist=True)
+                self._ack(ack)
+                # scores = run_calibration_algorithm(probs) 
 
-            if message.eof:
-                self._outputs_eof = True
+                if message.eof:
+                    self._outputs_eof = True
 
-            if self._inputs_eof and self._outputs_eof:
-                self._handle_eof()
+                if self._inputs_eof and self._outputs_eof:
+                    self._handle_eof()
 
         except Exception as e:
             logging.error(
@@ -119,38 +185,72 @@ class BatchHandler:
             )
             raise e
         
-    def _handle_inputs_message(self, ch, body):
-        """Handle inputs messages from the inputs queue."""
+    def _handle_inputs_message(self, ch, body, ack=None):
+        """
+        Handle inputs messages from the inputs queue. `ack` is called once the
+        message is persisted; in lean mode that is when its batch joins.
+        """
         try:
+            self._coalescer.flush_if_due()
+            MESSAGES_TOTAL.inc(kind="inputs")
+            MESSAGE_BYTES_TOTAL.inc(len(body), kind="inputs")
+            decode_start = time.perf_counter()
+            parse_start = time.time_ns()
             message = dataset_service_pb2.DataBatchLabeled()
             message.ParseFromString(body)
-            images = self._process_input_data(message.data)
-            logging.info(
-                f"action: receive_inputs | result: success | batch_index: {message.batch_index} | is_last_batch: {message.is_last_batch}"
-            )
-            
-            if message.batch_index in self._batches and self._batches[message.batch_index][DataType.INPUTS] is not None:
-                # Duplicate batch index received
-                logging.warning(
-                    f"Duplicate inputs for batch {message.batch_index} from client {self.user_id}"
+            parse_end = time.time_ns()
+
+            with self._batch_span("batch.inputs", message.batch_index, parse_start) as span:
+                span.record_child("parse", parse_start, parse_end)
+                with self._tracer.span("process_input_data"):
+                    images = self._process_input_data(message.data)
+                MESSAGE_DECODE_SECONDS.observe(time.perf_counter() - decode_start, kind="inputs")
+                logging.info(
+                    f"action: receive_inputs | result: success | batch_index: {message.batch_index} | is_last_batch: {message.is_last_batch}"
                 )
-                return
 
-            self.store_inputs(batch_index=message.batch_index, inputs=images, labels=np.array(list(message.labels)), original_body=body, persist=True)
+                if message.batch_index in self._batches and self._batches[message.batch_index][DataType.INPUTS] is not None:
+                    # Duplicate batch index received
+                    logging.warning(
+                        f"Duplicate inputs for batch {message.batch_index} from client {self.user_id}"
+                    )
+                    span.set_attribute("duplicate", True)
+                    self._ack(ack)
+                    return
+
+                if self._lean_inputs:
+                    self._held_inputs[message.batch_index] = (self._lean_inputs_body(message), ack)
+                self.store_inputs(batch_index=message.batch_index, inputs=images, labels=np.array(list(message.labels)), original_body=body, persist=True)
+                if not self._lean_inputs:
+                    self._ack(ack)
 
-            if message.is_last_batch:
-                self._inputs_eof = True
+                if message.is_last_batch:
+                    self._inputs_eof = True
+
+                if self._inputs_eof and self._outputs_eof:
+                    self._handle_eof()
 
-            if self._inputs_eof and self._outputs_eof:
-                self._handle_eof()
-                
         except Exception as e:
             logging.error(
                 f"Error handling data message for client {self.user_id}: {e}"
             )
             raise e
         
+    def _lean_inputs_body(self, message):
+        # Same message without `data`: enough to rebuild the labels and EOF state on restore
+        lean = dataset_service_pb2.DataBatchLabeled()
+        lean.labels.extend(message.labels)
+        lean.batch_index = message.batch_index
+        lean.is_last_batch = message.is_last_batch
+        return lean.SerializeToString()
+
+    def _batch_span(self, name, batch_index, start_time_ns):
+        return self._tracer.batch_span(
+            name, self._session_id, batch_index, start_time_ns=start_time_ns, stage=self.uq.stage.name
+        )
+
     def _handle_eof(self):
+        self._coalescer.flush()
         self.uq.update_stage(CalibrationStage.FINISHED)
         self._on_eof()  
 
@@ -190,11 +290,13 @@ class BatchHandler:
     def store_outputs(self, batch_index: int, probs: Union[List[float], np.ndarray], original_body: bytes = None, persist: bool = True):
         self._store_data(batch_index, DataType.PROBS, probs, process_entry=persist)
         if persist:
-            self._db.write_outputs(
-                session_id=self._session_id,
-                outputs=original_body,
-                batch_index=batch_index,
-            )
+            with DB_WRITE_SECONDS.time(operation="write_outputs"), self._tracer.span("db.write_outputs"):
+                self._db.write_outputs(
+                    session_id=self._session_id,
+                    outputs=original_body,
+                    batch_index=batch_index,
+                )
+            self._release_joined_inputs(batch_index)
 
     def store_inputs(
         self,
@@ -207,12 +309,33 @@ class BatchHandler:
         self._store_data(batch_index, DataType.INPUTS, inputs, process_entry=persist)
         self._store_data(batch_index, DataType.LABELS, labels, process_entry=persist)
         if persist:
+            if batch_index in self._held_inputs:
+                self._release_joined_inputs(batch_index)
+            else:
+                self._write_inputs(batch_index, original_body)
+
+    def _write_inputs(self, batch_index: int, body: bytes):
+        with DB_WRITE_SECONDS.time(operation="write_inputs"), self._tracer.span("db.write_inputs"):
             self._db.write_inputs(
                 session_id=self._session_id,
-                inputs=original_body,
+                inputs=body,
                 batch_index=batch_index,
             )
 
+    def _release_joined_inputs(self, batch_index: int):
+        """Lean mode: once a batch joined (its images went to MLflow), store its inputs without them and ack."""
+        batch = self._batches.get(batch_index)
+        if batch_index not in self._held_inputs or not all(batch[kind] is not None for kind in DataType):
+            return
+        lean_body, ack = self._held_inputs.pop(batch_index)
+        self._write_inputs(batch_index, lean_body)
+        self._ack(ack)
+
+    @staticmethod
+    def _ack(ack):
+        if ack is not None:
+            ack()
+
 
     def _store_data(
         self, batch_index: int, kind: DataType, data: np.ndarray, process_entry: bool = True
@@ -224,18 +347,82 @@ class BatchHandler:
                 DataType.LABELS: None,
             }
 
+        previous = self._batches[batch_index][kind]
+        self._track_bytes(self._resident_bytes(data) - self._resident_bytes(previous))
+        if isinstance(previous, np.memmap):
+            self._discard_spilled(batch_index, kind, previous)
         self._batches[batch_index][kind] = data
         entry = self._batches[batch_index]
+        if process_entry:
+            self._first_seen.setdefault(batch_index, time.monotonic())
 
         if process_entry and all(
             entry[kind] is not None
             for kind in [DataType.INPUTS, DataType.PROBS, DataType.LABELS]
         ):
-            self.uq.process_entry(entry)
-            self.send_mlflow_msg(batch_index, entry)
+            BATCH_JOIN_WAIT_SECONDS.observe(time.monotonic() - self._first_seen.pop(batch_index))
+            self._coalescer.add(batch_index, entry)
+            with self._tracer.span("send_mlflow_msg"):
+                self.send_mlflow_msg(batch_index, entry)
             # del self._batches[batch_index]
 
+        if self._spill_store is not None and self._held_bytes > self._memory_budget_bytes:
+            self._spill_to_budget()
+
+    def _process_micro_batch(self, batch_indices: List[int], entry: Dict[DataType, np.ndarray]):
+        stage = self.uq.stage.name
+        with PROCESS_ENTRY_SECONDS.time(stage=stage), self._tracer.span("process_entry", stage=stage):
+            self.uq.process_entry(entry, batch_indices=batch_indices)
+
+    @staticmethod
+    def _resident_bytes(data) -> int:
+        # Spilled arrays are file-backed mappings and do not count against the budget
+        return 0 if isinstance(data, np.memmap) else getattr(data, "nbytes", 0)
+
+    def _spill_to_budget(self):
+        """Move arrays to the spill store, least needed first, until the session fits its budget."""
+        candidates = sorted(
+            (self._spill_priority(batch, kind), batch_index, kind.value)
+            for batch_index, batch in self._batches.items()
+            for kind in (DataType.INPUTS, DataType.PROBS)
+            if self._resident_bytes(batch[kind])
+        )
+        for _, batch_index, kind_value in candidates:
+            if self._held_bytes <= self._memory_budget_bytes:
+                break
+            kind = DataType(kind_value)
+            array = self._batches[batch_index][kind]
+            self._batches[batch_index][kind] = self._spill_store.spill(self._spill_key(batch_index, kind), array)
+            self._track_bytes(-array.nbytes)
+            self._spilled_bytes += array.nbytes
+            SPILLED_BYTES.inc(array.nbytes)
+        logging.info(
+            f"action: spill | session_id: {self._session_id} | resident_bytes: {self._held_bytes} | spilled_bytes: {self._spilled_bytes}"
+        )
+
+    @staticmethod
+    def _spill_priority(batch, kind) -> int:
+        # Inputs of processed batches are only kept around; probabilities are read again for the report
+        if kind == DataType.INPUTS:
+            return 0 if batch[DataType.PROBS] is not None else 1
+        return 2
+
+    @staticmethod
+    def _spill_key(batch_index: int, kind: DataType) -> str:
+        return f"{batch_index}-{kind.name.lower()}"
+
+    def _discard_spilled(self, batch_index: int, kind: DataType, array: np.memmap):
+        self._spilled_bytes -= array.nbytes
+        SPILLED_BYTES.dec(array.nbytes)
+        self._spill_store.discard(self._spill_key(batch_index, kind))
+
+    def _track_bytes(self, delta: int):
+        if delta:
+            self._held_bytes += delta
+            BATCHES_BYTES.inc(delta)
+
     def send_mlflow_msg(self, batch_index, entry):
+        start = time.perf_counter()
         mlflow_msg = mlflow_probs_pb2.MlflowProbs()
         for p in entry[DataType.PROBS]:
             prob = mlflow_probs_pb2.PredictionList()
@@ -255,6 +442,7 @@ class BatchHandler:
                 routing_key=MLFLOW_ROUTING_KEY,
                 body=mlflow_body,
             )
+        MLFLOW_PUBLISH_SECONDS.observe(time.perf_counter() - start)
         logging.info(
             f"action: send_mlflow_message | "
             f"user_id: {self.user_id} | "
@@ -1,22 +1,25 @@
-from http import HTTPStatus
+import functools
 import logging
-from multiprocessing import Process, Queue
 import os
+from multiprocessing import Process, Queue
 import signal
 import threading
-from time import time, sleep
 from middleware.consumer import Consumer
 from server.batch_handler import BatchHandler
-import requests
 from enum import Enum
 import pika.exceptions
 
 from src.database.db import Database
+from src.database.wal import WalCheckpointer, WalDatabase, WriteAheadLog
 from src.lib.db_engine import get_engine
-from src.lib.session_status import SessionStatus
+from src.lib.metrics import MetricsPusher
+from src.lib.profiler import SamplingProfiler, pop_profile_request, profile_path, write_profile_request
+from src.lib.spill_store import build_spill_store
+from src.lib.tracing import get_tracer
+from src.server.session_lifecycle import STATUS_FLUSH_TIMEOUT_SECONDS, SessionLifecycle
 
 
-class ClientManager(Process):
+class ClientManager(SessionLifecycle, Process):
     def __init__(
         self,
         user_id: str,
@@ -28,6 +31,10 @@ class ClientManager(Process):
         utrace_calculator_factory,
         inputs_format=None,
         recipient_email=None,
+        connections_client=None,
+        timeout_scheduler=None,
+        database_factory=None,
+        metrics_queue=None,
     ):
         """
         Initialize ClientManager as a Process.
@@ -36,104 +43,86 @@ class ClientManager(Process):
             user_id: The client ID (parsed by Listener before process creation)
             middleware_config: Middleware config object (NOT the middleware instance itself)
             clients_to_remove_queue: Queue to send removal requests to parent process
+            connections_client: Client used to report session status (defaults to the process-wide one)
+            timeout_scheduler: Scheduler watching the inactivity timer (defaults to the process-wide one)
+            database_factory: Callable returning the session's Database (defaults to one on config.database_url)
+            metrics_queue: Queue to push this process' metrics to the Server (None when sharing its process)
         """
         super().__init__()
-        self.logger = logging.getLogger(f"client-manager-{user_id}")
+        self._init_session(
+            user_id,
+            session_id,
+            clients_to_remove_queue,
+            config,
+            report_builder,
+            utrace_calculator_factory,
+            inputs_format=inputs_format,
+            recipient_email=recipient_email,
+            connections_client=connections_client,
+            timeout_scheduler=timeout_scheduler,
+        )
         self.logger.info(f"Initializing ClientManager for client {user_id}")
-        self.user_id = user_id
         self.middleware = middleware
-        self.clients_to_remove_queue = clients_to_remove_queue
-        self.consumer = None
-        self.batch_handler = None
-        self.shutdown_initiated = False
-        self.report_builder = report_builder
-        self.database = None
-        self.session_id = session_id
-        self.inputs_format = inputs_format
-        self.recipient_email = recipient_email
-        self.utrace_calculator_factory = utrace_calculator_factory
-        self.utrace_calculator = None
-        self.config = config
-
-        # Timeout management
-        self.connections_service_url = os.getenv("CONNECTIONS_SERVICE_URL", "http://connections-service:8000")
-        self.last_message_time = time()
-        self.last_message_time_lock = threading.Lock()
-        self.timeout_checker_handler = threading.Thread(target=self._timeout_checker)
-        self.timeout_checker_handler.daemon = True
-
-        self.status_lock = threading.Lock()
-        self.status = SessionStatus.IN_PROGRESS
+        self.database_factory = database_factory
+        self.metrics_queue = metrics_queue
+
+        # On-demand profiling of the thread running the session
+        self._session_thread_id = None
+        self._profiler = None
+        self._wal = None
+        self._wal_checkpointer = None
+        self._profiler_lock = threading.Lock()
+        self._profile_requested = threading.Event()
         
         logging.info(f"ClientManager for client {user_id} initialized")
 
-    def _timeout_checker(self):
-        """Periodically check for timeouts in BatchHandler."""
-        check_interval = self.config.server_config.client_timeout_seconds / 2
-    
-        while not self.shutdown_initiated:
-            with self.last_message_time_lock:
-                if (time() - self.last_message_time > self.config.server_config.client_timeout_seconds):
-                    logging.info(f"Client {self.user_id} timed out due to inactivity.")
-                    self.update_session_status(SessionStatus.TIMEOUT)
-                    self._initiate_shutdown(source_thread=threading.current_thread())
-                    return
-
-            for _ in range(int(check_interval * 10)):  
-                if self.shutdown_initiated:
-                    return
-                sleep(0.1)
-
+    def _schedule_shutdown(self):
+        self._initiate_shutdown(source_thread=threading.current_thread())
 
     def _handle_shutdown_signal(self, signum, frame):
         """Handle SIGTERM signal for graceful shutdown (or process end)."""
         self.logger.info(f"Received shutdown signal for client {self.user_id}")
         self._initiate_shutdown(source_thread=threading.current_thread())
 
-    def _initiate_shutdown(self, source_thread=None):
-        if self.shutdown_initiated:
-            return
-        
-        self.shutdown_initiated = True
-        
-        if self.consumer:
-            self.consumer.handle_sigterm()
-        if self.batch_handler:
-            self.batch_handler.handle_sigterm()
-            
-        if (self.timeout_checker_handler.is_alive() and 
-            self.timeout_checker_handler is not source_thread): 
-            
-            self.timeout_checker_handler.join(timeout=2)
-
     def run(self):
         """
         Main process loop: parse message, setup queues, create consumer, and start processing.
         Each process creates its own RabbitMQ connection to avoid conflicts.
         """
-        signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
-        self.timeout_checker_handler.start()
-        self.database = Database(get_engine(self.config.database_url))
+        self._session_thread_id = threading.get_ident()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
+            self._start_profile_requests()
+            signal.signal(signal.SIGUSR1, self._handle_profile_signal)
+        metrics_pusher = None
+        if self.metrics_queue is not None:
+            metrics_pusher = MetricsPusher(
+                self.metrics_queue, self.config.server_config.metrics_push_interval_seconds, logger=self.logger
+            )
+            metrics_pusher.start()
+        self._start_inactivity_timer()
+        if self.database_factory is not None:
+            self.database = self.database_factory()
+        else:
+            self.database = Database(get_engine(self.config.database_url, self.config.database_config))
+        self.database = self._open_wal(self.database)
         self.utrace_calculator = self.utrace_calculator_factory(database=self.database, session_id=self.session_id)
+        spill_store = build_spill_store(self.config.server_config, self.session_id, logger=self.logger)
 
         try:
             logging.info(f"ClientManager process started for client {self.user_id}")
             self.batch_handler = BatchHandler(
-                user_id=self.user_id,
-                session_id=self.session_id,
-                on_eof=self._handle_EOF_message,    
                 middleware=self.middleware,
                 database=self.database,
-                inputs_format=self.inputs_format,
-                utrace_calculator=self.utrace_calculator,
+                spill_store=spill_store,
+                call_later=self.middleware.call_later,
+                **self._batch_handler_settings(),
             )
 
             self.consumer = Consumer(
                 middleware=self.middleware,
-                user_id=self.user_id,
-                predictions_callback=self._handle_predictions_message,
-                inputs_callback=self._handle_inputs_message,
-                logger=self.logger,
+                before_ack=self._wal.sync if self._wal else None,
+                **self._consumer_settings(),
             )
             self.batch_handler._build_state()
 
@@ -149,62 +138,150 @@ class ClientManager(Process):
         except Exception as e:
             self.logger.error(f"Error setting up client {self.user_id}: {e}")
         finally:
+            if self.connections_client:
+                self.connections_client.flush(timeout=STATUS_FLUSH_TIMEOUT_SECONDS)
+            if metrics_pusher:
+                metrics_pusher.stop()
+            get_tracer().flush()
+            self._close_wal()
+            self._record_session_end()
+            if spill_store:
+                spill_store.close()
+            self._stop_profiling()
             self.logger.info(f"ClientManager process for client {self.user_id} terminating")
 
+    def _open_wal(self, database):
+        """
+        With WAL_DIR set, the session's writes go to a local write-ahead log and
+        are acked once fsynced there. Records left by a previous run are applied
+        to the database first, so the state is restored from up-to-date rows.
+        """
+        database_config = self.config.database_config
+        if not database_config.wal_dir:
+            return database
+        self._wal = WriteAheadLog(
+            os.path.join(database_config.wal_dir, str(self.session_id)), database_config.wal_segment_bytes, logger=self.logger
+        )
+        self._wal_checkpointer = WalCheckpointer(
+            self._wal, database, self.session_id, database_config.wal_checkpoint_interval_seconds, logger=self.logger
+        )
+        replayed = self._wal_checkpointer.checkpoint()
+        if replayed:
+            self.logger.info(f"action: wal_replay | result: success | session_id: {self.session_id} | records: {replayed}")
+        self._wal_checkpointer.start()
+        return WalDatabase(database, self._wal)
+
+    def _close_wal(self):
+        if self._wal is None:
+            return
+        try:
+            self._wal_checkpointer.stop()
+        except Exception as e:
+            # The records stay in the log and are replayed when the session is restored
+            self.logger.error(f"action: wal_checkpoint | result: fail | session_id: {self.session_id} | error: {e}")
+            self._wal.close()
+            return
+        self._wal.remove()
+
+    def start_profiling(self, duration_seconds=None, output_format=None) -> bool:
+        """
+        Sample the session's thread for a bounded window and dump the profile
+        to config.server_config.profile_dir. Runs in the session's process;
+        returns False if a profile is already in progress.
+        """
+        server_config = self.config.server_config
+        duration = min(float(duration_seconds or server_config.profile_default_seconds), server_config.profile_max_seconds)
+        output_format = output_format or server_config.profile_format
+        with self._profiler_lock:
+            if self._session_thread_id is None or (self._profiler and self._profiler.is_alive()):
+                self.logger.warning(f"action: profile | result: skipped | session_id: {self.session_id}")
+                return False
+            self._profiler = SamplingProfiler(
+                thread_id=self._session_thread_id,
+                output_path=profile_path(server_config.profile_dir, self.session_id, output_format),
+                duration_seconds=duration,
+                interval_seconds=server_config.profile_interval_seconds,
+                output_format=output_format,
+                logger=self.logger,
+            )
+            self._profiler.start()
+        self.logger.info(f"action: profile | result: started | session_id: {self.session_id} | seconds: {duration}")
+        return True
+
+    def _stop_profiling(self):
+        with self._profiler_lock:
+            profiler = self._profiler
+        if profiler and profiler.is_alive():
+            profiler.stop()
+            profiler.join()
+
+    def _handle_profile_signal(self, signum, frame):
+        """SIGUSR1: profile with the parameters left by request_profile, or the defaults."""
+        # The signal may interrupt the session thread while it holds _profiler_lock, so the
+        # handler only wakes the thread serving the requests
+        self._profile_requested.set()
+
+    def _start_profile_requests(self):
+        threading.Thread(
+            target=self._serve_profile_requests, name=f"profile-requests-{self.session_id}", daemon=True
+        ).start()
+
+    def _serve_profile_requests(self):
+        while True:
+            self._profile_requested.wait()
+            self._profile_requested.clear()
+            request = pop_profile_request(self.config.server_config.profile_dir, os.getpid())
+            try:
+                self.start_profiling(request.get("duration_seconds"), request.get("format"))
+            except Exception as e:
+                self.logger.error(f"action: profile | result: fail | error: {e}")
+
+    def request_profile(self, duration_seconds=None, output_format=None):
+        """Called from the Listener's process: ask this ClientManager process to profile itself."""
+        if self.pid is None or not self.is_alive():
+            return False
+        write_profile_request(self.config.server_config.profile_dir, self.pid, duration_seconds, output_format)
+        os.kill(self.pid, signal.SIGUSR1)
+        return True
+
     def _handle_predictions_message(self, ch, method, properties, body):
         """Callback for replies queue - calls BatchHandler._handle_predictions_message"""
         self.logger.info(f"Received predictions message for client {self.user_id}")
-        with self.last_message_time_lock:
-            self.last_message_time = time()
-        self.batch_handler._handle_predictions_message(ch, body)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.inactivity_timer.touch()
+        self.batch_handler._handle_predictions_message(ch, body, ack=functools.partial(self.consumer.ack, ch, method.delivery_tag))
 
 
 
     def _handle_inputs_message(self, ch, method, properties, body):
         """Callback for inputs queue - calls BatchHandler._handle_inputs_message"""
         self.logger.info(f"Received inputs message for client {self.user_id}")
-        with self.last_message_time_lock:
-            self.last_message_time = time()
-        self.batch_handler._handle_inputs_message(ch, body)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        self.inactivity_timer.touch()
+        # BatchHandler acks once the message is persisted, which may be after later messages
+        self.batch_handler._handle_inputs_message(ch, body, ack=functools.partial(self.consumer.ack, ch, method.delivery_tag))
 
 
-    def update_session_status(self, session_status):
-        """Update the session status to the given status in the connections service."""
-        try:
-            logging.info(f"Updating session {self.session_id} status to {session_status.name()}")
-            status = session_status.name().lower()
-            url = f"{self.connections_service_url}/sessions/{self.session_id}/status/{status}"
-            headers = {"Content-Type": "application/json"}
-            response = requests.put(url, json={"user_id": self.user_id}, headers=headers)
-            with self.status_lock:
-                self.status = session_status
-
-            if response.status_code == HTTPStatus.OK:
-                self.logger.info(f"Session {self.session_id} status updated to {session_status.name()}.")
-            else:
-                self.logger.error(f"Failed to update session {self.session_id} status. Response code: {response.status_code}, Response body: {response.text}. Status: {session_status.name()}")
-        except Exception as e:
-            self.logger.error(f"Error updating session {self.session_id} status: {e}")
+    def _stop_after_eof(self):
+        self.consumer.handle_sigterm()
+        self.batch_handler.handle_sigterm()
 
-    def send_report(self):
-        """
-        Build and send report when both labeled and replies data are complete.
-        """
-        self.report_builder.generate_report(self.batch_handler.get_calibration_results())  
 
-        logging.info(f"Sending report to {self.recipient_email} for client {self.user_id}")
-        self.report_builder.send_report(self.recipient_email)
+class ClientManagerThread(threading.Thread):
+    """
+    Runs a ClientManager in a thread of the current process instead of its own
+    process, for transports that cannot be shared across processes (the
+    in-memory broker). Exposes the same interface the Listener uses.
+    """
 
-    def _handle_EOF_message(self):
-        """Handle end-of-file message: stop consumer and batch handler, then remove client from active_clients."""
+    def __init__(self, client_manager: ClientManager):
+        super().__init__(target=client_manager.run, name=f"client-manager-{client_manager.user_id}", daemon=True)
+        self.client_manager = client_manager
+        self.session_id = client_manager.session_id
 
-        if self.config.environment == "PRODUCTION":
-            self.send_report()
+    def terminate(self):
+        """Equivalent of SIGTERM: the shutdown runs on the session's consuming thread."""
+        cm = self.client_manager
+        cm.middleware.add_callback_threadsafe(lambda: cm._handle_shutdown_signal(signal.SIGTERM, None))
 
-        self.logger.info(f"Received EOF message for client {self.user_id}")
-        self.consumer.handle_sigterm()
-        self.batch_handler.handle_sigterm()
-        self.update_session_status(SessionStatus.COMPLETED)
-        
+    def request_profile(self, duration_seconds=None, output_format=None):
+        """The session shares this process, so the profiler can be started directly."""
+        return self.client_manager.start_profiling(duration_seconds, output_format)
@@ -2,12 +2,15 @@ import logging
 import threading
 from typing import Dict
 from multiprocessing import Queue
-from lib.config import CONNECTION_QUEUE_NAME
-from server.client_manager import ClientManager
+from lib.config import CONNECTION_QUEUE_NAME, CONTROL_QUEUE_NAME
+from server.client_manager import ClientManager, ClientManagerThread
+from server.async_client_manager import AsyncClientManager
 import json
 import pika.exceptions
 from src.lib.client_manager_handler import ClientManagerHandler
 from src.lib.inputs_format_parser import parse_inputs_format
+from src.lib.metrics import ACTIVE_SESSIONS
+from src.lib.profiler import PROFILE_FORMATS
 
 
 class Listener:
@@ -21,6 +24,9 @@ class Listener:
         utrace_calculator_factory,
         database=None,
         logger=None,
+        session_engine=None,
+        database_factory=None,
+        metrics_queue=None,
     ):
         self.middleware = middleware
 
@@ -33,6 +39,12 @@ class Listener:
         self.cm_middleware_factory = cm_middleware_factory
         self.report_builder_factory = report_builder_factory
         self.utrace_calculator_factory = utrace_calculator_factory
+        # When set, sessions run on this AsyncSessionEngine instead of in their own process
+        self.session_engine = session_engine
+        # Builds each session's Database; ClientManager opens one on config.database_url by default
+        self.database_factory = database_factory
+        # ClientManager processes push their metrics here; sessions sharing this process record them directly
+        self.metrics_queue = metrics_queue
 
         # Control de procesos cliente
         self._active_clients: Dict[str, ClientManager] = {}
@@ -43,6 +55,8 @@ class Listener:
 
         # Colas para comunicación entre hilos
         self.clients_to_remove_queue = Queue()
+        # Profiling and other requests for the sessions of this replica
+        self.control_queue_name = f"{CONTROL_QUEUE_NAME}_{self.config.server_config.pod_name}"
         
         self.logger.info(f"Listener initialized for queue: {CONNECTION_QUEUE_NAME}")
 
@@ -71,6 +85,7 @@ class Listener:
             while not self.shutdown_initiated:
                 try:
                     if not self.shutdown_initiated:
+                        self._consume_control_queue()
                         self.middleware.basic_consume(
                             channel=self.channel,
                             queue_name=CONNECTION_QUEUE_NAME,
@@ -94,6 +109,62 @@ class Listener:
             self.logger.info("Listener stopped consumption...")
 
 
+    def _consume_control_queue(self):
+        try:
+            self.middleware.setup_control_queue(self.channel, self.control_queue_name)
+            self.middleware.basic_consume(
+                channel=self.channel,
+                queue_name=self.control_queue_name,
+                callback_function=self._handle_control_message,
+            )
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.ChannelClosedByBroker):
+            raise
+        except Exception as e:
+            self.logger.error(f"action: setup_control_queue | result: fail | error: {e}")
+
+    def _handle_control_message(self, ch, method, properties, body):
+        """
+        Control messages are broadcast to every replica; only the one running
+        the session acts on them. Example:
+        {"action": "profile", "session_id": "...", "duration_seconds": 30, "format": "collapsed"}
+        """
+        # Acked first: nothing below may raise, or the wrapper would nack an acked tag and close the channel
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        try:
+            request = json.loads(body.decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError(f"expected a JSON object, got {type(request).__name__}")
+            if request.get("action") != "profile":
+                raise ValueError(f"unknown action: {request.get('action')}")
+            duration_seconds, output_format = self._profile_parameters(request)
+        except ValueError as e:
+            self.logger.warning(f"action: control_message | result: fail | error: {e}")
+            return
+
+        session_id = request.get("session_id")
+        with self._active_clients_lock:
+            handler = next((h for h in self._active_clients.values() if h.session_id == session_id), None)
+        if handler is None:
+            return
+        try:
+            started = handler.request_profile(duration_seconds, output_format)
+        except Exception as e:
+            self.logger.error(f"action: profile_request | session_id: {session_id} | result: fail | error: {e}")
+            return
+        self.logger.info(f"action: profile_request | session_id: {session_id} | result: {'success' if started else 'skipped'}")
+
+    @staticmethod
+    def _profile_parameters(request: dict):
+        """duration_seconds and format of a profile request; raises ValueError if they are invalid."""
+        duration_seconds = request.get("duration_seconds")
+        if duration_seconds is not None:
+            if isinstance(duration_seconds, bool) or not isinstance(duration_seconds, (int, float)) or duration_seconds <= 0:
+                raise ValueError(f"invalid duration_seconds: {duration_seconds!r}")
+        output_format = request.get("format")
+        if output_format is not None and output_format not in PROFILE_FORMATS:
+            raise ValueError(f"invalid format: {output_format!r}, expected one of {PROFILE_FORMATS}")
+        return duration_seconds, output_format
+
     def reconnect_to_middleware(self):
         self.middleware.connect()
         self.channel = self.middleware.create_channel(prefetch_count=self.config.server_config.upper_bound_clients)
@@ -124,17 +195,34 @@ class Listener:
             )
             raise RuntimeError("Shutdown initiated") 
         
-        client_manager = ClientManager(
-            user_id=user_id,
-            session_id=session_id,
-            middleware=self.cm_middleware_factory(self.config.middleware_config),
-            clients_to_remove_queue=self.clients_to_remove_queue,
-            report_builder=self.report_builder_factory(user_id=user_id),
-            utrace_calculator_factory=self.utrace_calculator_factory,
-            config=self.config,
-            inputs_format=inputs_format,
-            recipient_email=recipient_email,
-        )
+        if self.session_engine is not None:
+            client_manager = AsyncClientManager(
+                engine=self.session_engine,
+                user_id=user_id,
+                session_id=session_id,
+                clients_to_remove_queue=self.clients_to_remove_queue,
+                report_builder=self.report_builder_factory(user_id=user_id),
+                utrace_calculator_factory=self.utrace_calculator_factory,
+                config=self.config,
+                inputs_format=inputs_format,
+                recipient_email=recipient_email,
+            )
+        else:
+            client_manager = ClientManager(
+                user_id=user_id,
+                session_id=session_id,
+                middleware=self.cm_middleware_factory(self.config.middleware_config),
+                clients_to_remove_queue=self.clients_to_remove_queue,
+                report_builder=self.report_builder_factory(user_id=user_id),
+                utrace_calculator_factory=self.utrace_calculator_factory,
+                config=self.config,
+                inputs_format=inputs_format,
+                recipient_email=recipient_email,
+                database_factory=self.database_factory,
+                metrics_queue=self.metrics_queue if self.config.server_config.session_engine != "thread" else None,
+            )
+            if self.config.server_config.session_engine == "thread":
+                client_manager = ClientManagerThread(client_manager)
         self.logger.info(f"Created ClientManager for client {user_id}")
         self._add_client(user_id, client_manager, ch, method.delivery_tag)
 
@@ -151,6 +239,7 @@ class Listener:
                 except Exception as e:
                     self.logger.error(f"Error sending ACK for client {user_id}: {e}")
                 del self._active_clients[user_id]
+                ACTIVE_SESSIONS.set(len(self._active_clients))
                 self.logger.info(f"Removed ClientManager for client {user_id}")
 
     def _add_client(self, user_id: str, process_handler: ClientManager, ch: pika.channel.Channel, delivery_tag: int):
@@ -163,6 +252,7 @@ class Listener:
                     delivery_tag=delivery_tag
                 )
                 self._active_clients[user_id] = handler
+                ACTIVE_SESSIONS.set(len(self._active_clients))
                 self.logger.info(f"Added ClientManager for client {user_id}")
 
 
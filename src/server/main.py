@@ -1,8 +1,10 @@
 import logging
 import signal
+from multiprocessing import Queue
 from middleware.middleware import Middleware
 from server.listener import Listener
 from lib.config import CONNECTION_QUEUE_NAME
+from src.lib.metrics import MetricsCollector, MetricsServer
 
 
 class Server():
@@ -10,7 +12,7 @@ class Server():
     Server handles RabbitMQ server operations for client notifications.
     """
 
-    def __init__(self, config, middleware_cls, cm_middleware_factory, report_builder_factory, utrace_calculator_factory, database):
+    def __init__(self, config, middleware_cls, cm_middleware_factory, report_builder_factory, utrace_calculator_factory, database, session_engine=None):
         self.config = config
         self.logger = logging.getLogger("calibration-server")
         self.logger.info("Initializing Calibration Server")
@@ -21,6 +23,20 @@ class Server():
         channel = self.middleware.create_channel(prefetch_count=self.config.server_config.upper_bound_clients)
         self.middleware.setup_connection_queue(channel, durable=True)
 
+        self.metrics_collector = None
+        self.metrics_server = None
+        if self.config.server_config.metrics_port:
+            self.metrics_collector = MetricsCollector(
+                Queue(),
+                logger=self.logger,
+                stale_after_seconds=3 * self.config.server_config.metrics_push_interval_seconds,
+            )
+            self.metrics_collector.start()
+            self.metrics_server = MetricsServer(
+                self.metrics_collector, port=self.config.server_config.metrics_port, logger=self.logger
+            )
+            self.metrics_server.start()
+
         self.logger.info("Initializing Listener...")
         self.listener = Listener(
             middleware=self.middleware,
@@ -30,7 +46,9 @@ class Server():
             report_builder_factory=report_builder_factory,
             utrace_calculator_factory=utrace_calculator_factory,
             logger=self.logger,
-            database=database
+            database=database,
+            session_engine=session_engine,
+            metrics_queue=self.metrics_collector.metrics_queue if self.metrics_collector else None,
         )
 
         self.logger.info(
@@ -39,6 +57,9 @@ class Server():
         self._shutdown_received = False
         signal.signal(signal.SIGINT, lambda s, f: self.handle_sigterm())
         signal.signal(signal.SIGTERM, lambda s, f: self.handle_sigterm())
+        # ClientManager processes inherit this until they install their profiling handler,
+        # so an early profile request cannot kill them
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
 
     def run(self):
         """
@@ -48,7 +69,18 @@ class Server():
         if self._shutdown_received:
             self.logger.info("Shutdown already received, not starting listener")
             return
-        self.listener.start()
+        try:
+            self.listener.start()
+        finally:
+            self._stop_metrics()
+
+    def _stop_metrics(self):
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.metrics_collector:
+            self.metrics_collector.stop()
+            self.metrics_collector = None
        
     def handle_sigterm(self):
         """
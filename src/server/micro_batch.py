@@ -0,0 +1,88 @@
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from src.lib.data_types import DataType
+
+
+class MicroBatchCoalescer:
+    """
+    Collects joined batches in front of UtraceCalculator.process_entry and
+    hands them over together once they hold `target_samples` samples, or once
+    the oldest has waited `max_delay_seconds`. The wait is enforced by a
+    timer set with `call_later(delay, func)` when the first batch is queued,
+    which must run `func` on the thread handling the session's messages;
+    without it, it is only checked as messages arrive. The stage logic, the
+    scores UPDATE and its log line then run once per micro-batch of about
+    `target_samples` samples, whatever the clients' batch size. Batches are
+    never split, so a micro-batch can exceed the target by less than one
+    batch. With `target_samples` 0 every batch is processed on its own.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[List[int], Dict[DataType, np.ndarray]], None],
+        target_samples: int = 0,
+        max_delay_seconds: float = 1.0,
+        clock: Callable[[], float] = time.monotonic,
+        call_later: Optional[Callable[[float, Callable[[], None]], object]] = None,
+    ):
+        self._process = process
+        self._call_later = call_later
+        self.target_samples = target_samples
+        self.max_delay_seconds = max_delay_seconds
+        self._clock = clock
+        # batch_index -> the batch's entry, read when the micro-batch is processed
+        self._pending: Dict[int, Dict[DataType, np.ndarray]] = {}
+        self._pending_samples = 0
+        self._oldest = None
+
+    @property
+    def pending(self) -> List[int]:
+        return list(self._pending)
+
+    def add(self, batch_index: int, entry: Dict[DataType, np.ndarray]):
+        """Queue a joined batch; processes the micro-batch if it is full or due."""
+        if not self._pending:
+            self._oldest = self._clock()
+        self._pending[batch_index] = entry
+        self._pending_samples += len(entry[DataType.LABELS])
+        if self._pending_samples >= self.target_samples or self._due():
+            self.flush()
+        elif len(self._pending) == 1 and self._call_later is not None:
+            # A timer left by an earlier micro-batch finds this one not yet due and does nothing
+            self._call_later(self.max_delay_seconds, self._on_timer)
+
+    def flush_if_due(self):
+        if self._pending and self._due():
+            self.flush()
+
+    def _on_timer(self):
+        try:
+            self.flush_if_due()
+        except Exception as e:
+            # The batches stay pending: the next message or the EOF processes them
+            logging.error(f"action: flush_micro_batch | result: fail | batches: {self.pending} | error: {e}")
+
+    def _due(self) -> bool:
+        return self._clock() - self._oldest >= self.max_delay_seconds
+
+    def flush(self):
+        """Process whatever is pending as one micro-batch."""
+        if not self._pending:
+            return
+        batch_indices = list(self._pending)
+        entries = list(self._pending.values())
+        if len(entries) == 1:
+            merged = {kind: entries[0][kind] for kind in (DataType.PROBS, DataType.LABELS)}
+        else:
+            merged = {
+                DataType.PROBS: np.concatenate([entry[DataType.PROBS] for entry in entries]),
+                DataType.LABELS: np.concatenate([np.ravel(entry[DataType.LABELS]) for entry in entries]),
+            }
+        self._process(batch_indices, merged)
+        self._pending.clear()
+        self._pending_samples = 0
+        self._oldest = None
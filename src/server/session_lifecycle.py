@@ -0,0 +1,163 @@
+import logging
+import threading
+
+from src.lib.metrics import REPORT_BUILD_SECONDS
+from src.lib.session_status import SessionStatus
+from src.lib.timeout_scheduler import InactivityTimer, get_timeout_scheduler
+from src.middleware.connections_client import get_connections_client
+
+STATUS_FLUSH_TIMEOUT_SECONDS = 10
+
+
+class SessionLifecycle:
+    """
+    Session lifecycle shared by the session engines, ClientManager (a process
+    or thread per session) and AsyncClientManager (sessions on one event
+    loop): inactivity timeout, status updates, the report, EOF and shutdown,
+    and the settings of the session's BatchHandler and consumer.
+
+    Engines call `_init_session` from their constructor, run the session
+    themselves and implement `_schedule_shutdown` and `_stop_after_eof`.
+    """
+
+    def _init_session(
+        self,
+        user_id: str,
+        session_id: str,
+        clients_to_remove_queue,
+        config,
+        report_builder,
+        utrace_calculator_factory,
+        inputs_format=None,
+        recipient_email=None,
+        connections_client=None,
+        timeout_scheduler=None,
+    ):
+        self.logger = logging.getLogger(f"client-manager-{user_id}")
+        self.user_id = user_id
+        self.session_id = session_id
+        self.clients_to_remove_queue = clients_to_remove_queue
+        self.config = config
+        self.report_builder = report_builder
+        self.utrace_calculator_factory = utrace_calculator_factory
+        self.utrace_calculator = None
+        self.inputs_format = inputs_format
+        self.recipient_email = recipient_email
+        self.connections_client = connections_client
+        self.consumer = None
+        self.batch_handler = None
+        self.database = None
+        self.shutdown_initiated = False
+
+        self.timeout_scheduler = timeout_scheduler
+        self.inactivity_timer = InactivityTimer(
+            timeout_seconds=self.config.server_config.client_timeout_seconds,
+            on_timeout=self._handle_timeout,
+            name=f"session-{session_id}",
+        )
+        self.status_lock = threading.Lock()
+        self.status = SessionStatus.IN_PROGRESS
+
+    def _start_inactivity_timer(self):
+        """Register the inactivity timer with the (process-wide) timeout scheduler."""
+        if self.timeout_scheduler is None:
+            self.timeout_scheduler = get_timeout_scheduler()
+        self.inactivity_timer.touch()
+        self.timeout_scheduler.schedule(self.inactivity_timer)
+
+    def _batch_handler_settings(self) -> dict:
+        """BatchHandler arguments common to both engines; each adds its middleware, database and timers."""
+        server_config = self.config.server_config
+        return dict(
+            user_id=self.user_id,
+            session_id=self.session_id,
+            on_eof=self._handle_EOF_message,
+            inputs_format=self.inputs_format,
+            utrace_calculator=self.utrace_calculator,
+            inputs_persistence=self.config.database_config.inputs_persistence,
+            memory_budget_bytes=server_config.session_memory_budget_bytes,
+            coalesce_target_samples=server_config.coalesce_target_samples,
+            coalesce_max_delay_seconds=server_config.coalesce_max_delay_seconds,
+        )
+
+    def _consumer_settings(self) -> dict:
+        """Consumer arguments common to both engines."""
+        middleware_config = self.config.middleware_config
+        return dict(
+            user_id=self.user_id,
+            predictions_callback=self._handle_predictions_message,
+            inputs_callback=self._handle_inputs_message,
+            logger=self.logger,
+            inputs_prefetch_count=middleware_config.inputs_prefetch_count,
+            outputs_prefetch_count=middleware_config.outputs_prefetch_count,
+            ack_batch_size=middleware_config.ack_batch_size,
+            ack_flush_interval_seconds=middleware_config.ack_flush_interval_seconds,
+            inputs_max_unacked_bytes=middleware_config.inputs_max_unacked_bytes,
+            outputs_max_unacked_bytes=middleware_config.outputs_max_unacked_bytes,
+            lag_report_interval_seconds=middleware_config.lag_report_interval_seconds,
+        )
+
+    def _handle_timeout(self):
+        """Called by the timeout scheduler when no message arrived within client_timeout_seconds."""
+        if self.shutdown_initiated:
+            return
+        logging.info(f"Client {self.user_id} timed out due to inactivity.")
+        self.update_session_status(SessionStatus.TIMEOUT)
+        self._schedule_shutdown()
+
+    def _schedule_shutdown(self):
+        """Run _initiate_shutdown where the engine allows it; called from the timeout scheduler's thread."""
+        raise NotImplementedError
+
+    def _initiate_shutdown(self, source_thread=None):
+        if self.shutdown_initiated:
+            return
+        self.shutdown_initiated = True
+        if self.consumer:
+            self.consumer.handle_sigterm()
+        if self.batch_handler:
+            self.batch_handler.handle_sigterm()
+        self.inactivity_timer.cancel()
+
+    def update_session_status(self, session_status):
+        """Queue an update of the session status in the connections service; does not block on the network."""
+        try:
+            logging.info(f"Updating session {self.session_id} status to {session_status.name()}")
+            if self.connections_client is None:
+                self.connections_client = get_connections_client()
+            self.connections_client.update_session_status(self.session_id, self.user_id, session_status)
+            with self.status_lock:
+                self.status = session_status
+        except Exception as e:
+            self.logger.error(f"Error updating session {self.session_id} status: {e}")
+
+    def send_report(self):
+        """
+        Build and send report when both labeled and replies data are complete.
+        """
+        with REPORT_BUILD_SECONDS.time():
+            self.report_builder.generate_report(self.batch_handler.get_calibration_results())
+
+            logging.info(f"Sending report to {self.recipient_email} for client {self.user_id}")
+            self.report_builder.send_report(self.recipient_email)
+
+    def _handle_EOF_message(self):
+        """Called by BatchHandler once both streams reached EOF: report, stop consuming, mark COMPLETED."""
+        if self.config.environment == "PRODUCTION":
+            self.send_report()
+
+        self.logger.info(f"Received EOF message for client {self.user_id}")
+        self.inactivity_timer.cancel()
+        self._stop_after_eof()
+        self.update_session_status(SessionStatus.COMPLETED)
+
+    def _stop_after_eof(self):
+        """Stop consuming once the EOF message is handled."""
+        raise NotImplementedError
+
+    def _record_session_end(self):
+        """A COMPLETED or TIMEOUT session is not resumed: its batches start counting towards DB_RETENTION_DAYS."""
+        with self.status_lock:
+            status = self.status
+        if self.database is not None and status in (SessionStatus.COMPLETED, SessionStatus.TIMEOUT):
+            self.database.mark_session_finished(self.session_id, status.name())
@@ -1,12 +1,31 @@
 import logging
 import numpy as np
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Sequence
 from src.lib.calibration_stages import CalibrationStage
-from src.lib.config import CALIBRATION_LIMIT, UNCERTAINTY_LIMIT
+from src.lib.config import CALIBRATION_LIMIT, CALIBRATION_SAMPLES, UNCERTAINTY_LIMIT, UNCERTAINTY_SAMPLES
 from src.lib.data_types import DataType
+from src.lib.metrics import DB_WRITE_SECONDS
 from utrace.uncertaintyQuantifier import UncertaintyQuantifier
 from utrace.utils.utils import flatten_batch, get_coverage
 
+
+def pack_class_scores(class_scores: List[np.ndarray]) -> bytes:
+    """Columnar form of the per-class sorted scores: int64 offsets of each class, then every float64 score."""
+    offsets = np.zeros(len(class_scores) + 1, dtype=np.int64)
+    np.cumsum([scores.size for scores in class_scores], out=offsets[1:])
+    values = np.concatenate([np.empty(0), *class_scores]).astype(np.float64)
+    return offsets.tobytes() + values.tobytes()
+
+
+def unpack_class_scores(blob: bytes, classes: int) -> List[np.ndarray]:
+    """Inverse of pack_class_scores; the arrays are read-only views of `blob`, nothing is copied."""
+    offsets = np.frombuffer(blob, dtype=np.int64, count=classes + 1)
+    values = np.frombuffer(blob, dtype=np.float64, offset=offsets.nbytes)
+    if offsets[-1] != values.size:
+        raise ValueError(f"class scores hold {values.size} scores, offsets expect {offsets[-1]}")
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 class UtraceCalculator:
     def __init__(self, database, session_id):
         self._db = database
@@ -16,6 +35,7 @@ class UtraceCalculator:
         self.stage = CalibrationStage.INITIAL_CALIBRATION
         self.uq = UncertaintyQuantifier(classes=np.arange(10))  
         self.batch_counter = 0
+        self.samples_counter = 0
 
         # Métricas en Memoria
         self.alphas_: List[float] = []
@@ -28,6 +48,8 @@ class UtraceCalculator:
         self.total_samples = 0
         self.accuracy = 0.0
         self.stored_confidences = []
+        # Batch indices already counted in the state; None when the stored session predates it
+        self.processed_batches: Optional[set] = set()
 
         self.restore_session()
 
@@ -41,12 +63,24 @@ class UtraceCalculator:
 
         # Restaurar contadores y stage
         self.batch_counter = record.batchs_counter or 0
+        self.samples_counter = record.samples_counter or 0
         self.stage = CalibrationStage.from_int(record.stage or 0)
 
         # Restaurar variables del uq
         if record.scores is not None:
             scores = np.frombuffer(record.scores, dtype=np.float64) if record.scores else np.empty(0)
-            self.uq.reset(conformity_scores_=scores)
+            # Batched calibration rebuilds the global scores from the class scores, so both are restored
+            class_scores = getattr(record, "class_scores", None)
+            if isinstance(class_scores, bytes) and class_scores:
+                class_scores = unpack_class_scores(class_scores, len(self.uq.classes))
+            else:
+                class_scores = None
+            self.uq.reset(conformity_scores_=scores, class_scores=class_scores)
+            if class_scores is None and scores.size and self.stage == CalibrationStage.INITIAL_CALIBRATION:
+                logging.warning(
+                    f"action: restore_class_scores | session_id: {self._session_id} | result: missing | "
+                    f"scores: {scores.size} | detail: calibration continues without the stored scores"
+                )
 
         if record.alpha is not None:
             alpha = record.alpha
@@ -63,30 +97,39 @@ class UtraceCalculator:
         self.correct_preds = record.correct_preds or 0
         self.total_samples = record.total_samples or 0
         self.accuracy = record.accuracy or 0.0
+        processed = getattr(record, "processed_batches", None)
+        self.processed_batches = set(processed) if isinstance(processed, (list, tuple)) else None
 
         logging.info(f"Restoring values: batch_counter={self.batch_counter}, stage={self.stage}, accuracy={self.accuracy} scores={scores if record.scores is not None else None}, alpha={alpha if record.alpha is not None else None}, alphas={self.alphas_}, uncertainties={self.U_}, coverages={self.batch_coverages}, setsizes={self.batch_setsizes}, correct_preds={self.correct_preds}, total_samples={self.total_samples}, confidences={self.stored_confidences}, correct_preds={self.correct_preds}, total_samples={self.total_samples}, accuracy={self.accuracy})")
 
-    def process_entry(self, entry: Dict[DataType, Any]):
+    def is_processed(self, batch_index: int) -> bool:
+        """Whether the batch is counted in the state; unknown batches of older sessions count as processed."""
+        return self.processed_batches is None or batch_index in self.processed_batches
+
+    def process_entry(self, entry: Dict[DataType, Any], batch_indices: Sequence[int] = None):
+        """Run the current stage on one entry, a client batch or a micro-batch of several (`batch_indices`)."""
         probs = entry[DataType.PROBS]
         labels = entry[DataType.LABELS]
+        samples = int(np.size(labels))
         
         current_metrics = {}
 
-        if self.batch_counter <= CALIBRATION_LIMIT:
+        if self._in_stage(CALIBRATION_LIMIT, CALIBRATION_SAMPLES):
             self.uq.calibrate(probs, labels, batched=True)
             current_metrics['scores'] =  self.uq.conformity_scores_.astype(np.float64).tobytes()
+            current_metrics['class_scores'] = pack_class_scores(self.uq.class_scores)
 
-            if self.batch_counter == CALIBRATION_LIMIT:
+            if self._ends_stage(CALIBRATION_LIMIT, CALIBRATION_SAMPLES, samples):
                 self.update_stage(CalibrationStage.UNCERTAINTY_ESTIMATION)
 
-        elif self.batch_counter <= UNCERTAINTY_LIMIT:
+        elif self._in_stage(UNCERTAINTY_LIMIT, UNCERTAINTY_SAMPLES):
             U, alpha = self.uq.get_uncertainty_opt(probs, labels)
             current_metrics
             self.alphas_.append(float(alpha))
             self.U_.append(float(U))
             current_metrics = {'alpha': float(alpha), 'uncertainty': float(U)}
             
-            if self.batch_counter == UNCERTAINTY_LIMIT:
+            if self._ends_stage(UNCERTAINTY_LIMIT, UNCERTAINTY_SAMPLES, samples):
                 self.update_stage(CalibrationStage.PREDICTION_SET_CONSTRUCTION)
 
         else:
@@ -107,8 +150,26 @@ class UtraceCalculator:
                 'total_samples': self.total_samples
             }
 
+        if batch_indices is not None:
+            current_metrics['batch_indices'] = [int(index) for index in batch_indices]
+        current_metrics['samples'] = samples
         self._persist_batch_state(current_metrics)
         self.batch_counter += 1
+        self.samples_counter += samples
+        if batch_indices is not None and self.processed_batches is not None:
+            self.processed_batches.update(current_metrics['batch_indices'])
+
+    def _in_stage(self, limit: int, samples_limit: int) -> bool:
+        """Whether the next entry belongs to the stage ending after entry `limit`, or `samples_limit` samples when set."""
+        if samples_limit:
+            return self.samples_counter < samples_limit
+        return self.batch_counter <= limit
+
+    def _ends_stage(self, limit: int, samples_limit: int, samples: int) -> bool:
+        """Whether the entry being processed, of `samples` samples, is the last one of its stage."""
+        if samples_limit:
+            return self.samples_counter + samples >= samples_limit
+        return self.batch_counter == limit
 
     def _persist_batch_state(self, metrics: dict):
         """
@@ -117,10 +178,12 @@ class UtraceCalculator:
         """
         updates = {
             "batchs_counter": self.batch_counter + 1,
+            "samples_counter": self.samples_counter + metrics['samples'],
             "stage": self.stage
         }
         if 'scores' in metrics:
             updates['scores'] = metrics['scores']
+            updates['class_scores'] = metrics['class_scores']
 
         if 'alpha' in metrics:
             updates['push_alphas'] = metrics['alpha'] 
@@ -136,7 +199,11 @@ class UtraceCalculator:
             updates['correct_preds'] = metrics['correct_preds']
             updates['total_samples'] = metrics['total_samples']
 
-        self._db.update_session_state(self._session_id, updates)
+        if 'batch_indices' in metrics:
+            updates['push_processed_batches'] = metrics['batch_indices']
+
+        with DB_WRITE_SECONDS.time(operation="update_session_state"):
+            self._db.update_session_state(self._session_id, updates)
 
     def _update_accuracy_stats(self, probs, labels):
         """Calcula accuracy y guarda confidencias."""
@@ -26,7 +26,11 @@ def mock_global_config():
         master_replica_id=None,
         initial_timeout=5,
         client_timeout_seconds=100,
-        pod_name="test-pod" 
+        pod_name="test-pod",
+        metrics_port=0,
+        spill_dir="",
+        coalesce_target_samples=0,
+        coalesce_max_delay_seconds=1.0,
     )
     
     middleware_config = Mock(
@@ -41,7 +45,8 @@ def mock_global_config():
         server_config=server_config,
         middleware_config=middleware_config,
         log_level="INFO",
-        database_url="sqlite:///:memory:" 
+        database_url="sqlite:///:memory:",
+        database_config=Mock(wal_dir="", inputs_persistence="full"),
     )
     
     return fake_global_config
@@ -92,8 +97,8 @@ def integration_shutdown_runs_without_errors(mock_put, mock_global_config, mock_
     def report_builder_factory(*args, **kwarg): return FakeReportBuilder()
     def db_factory(*args, **kwargs):
         mock_db = MagicMock()
-        mock_db.get_inputs_from_session.return_value = []
-        mock_db.get_outputs_from_session.return_value = []
+        mock_db.iter_inputs_from_session.return_value = []
+        mock_db.iter_outputs_from_session.return_value = []
         return mock_db
     def utrace_calculator_factory(database=None, session_id=None):
         return Mock()
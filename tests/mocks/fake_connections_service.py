@@ -0,0 +1,59 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeConnectionsService:
+    """Local stand-in for the connections service, recording every status PUT."""
+
+    def __init__(self, response_delay: float = 0, failures_before_success: int = 0, failure_code: int = 503):
+        self.requests = []
+        self.response_delay = response_delay
+        self.failures_before_success = failures_before_success
+        self.failure_code = failure_code
+        self.connections = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_PUT(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                time.sleep(fake.response_delay)
+                with fake._lock:
+                    fake.connections.add(self.client_address)
+                    if fake.failures_before_success > 0:
+                        fake.failures_before_success -= 1
+                        code = fake.failure_code
+                    else:
+                        fake.requests.append((self.path, body))
+                        code = 200
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
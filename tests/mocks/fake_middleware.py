@@ -36,6 +36,15 @@ class FakeMiddleware:
     def setup_connection_queue(self, channel, durable: bool = False):
         pass
 
+    def set_prefetch(self, channel, prefetch_count: int, global_qos: bool = False):
+        pass
+
+    def get_message_count(self, queue_name: str) -> int:
+        return len(self.messages.get(queue_name, [])) if self.messages else 0
+
+    def call_later(self, delay: float, func):
+        pass
+
     def declare_queue(self, channel, queue_name: str, durable: bool = False):
         pass
 
@@ -0,0 +1,156 @@
+import queue
+import threading
+from unittest.mock import Mock
+import pika.exceptions
+
+
+class FakeBlockingChannel:
+    """Minimal stand-in for pika's BlockingChannel; records which thread made each call."""
+
+    _numbers = iter(range(1, 1_000_000))
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.channel_number = next(self._numbers)
+        self.is_open = True
+        self.consumers = {}
+        self.acks = []
+        self.published = []
+        self.calls = []
+
+    def _record(self, name):
+        self.calls.append((name, threading.current_thread().name))
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        self._record("basic_qos")
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, consumer_tag=None):
+        self._record("basic_consume")
+        tag = consumer_tag or f"ctag-{self.channel_number}-{len(self.consumers)}"
+        self.consumers[tag] = on_message_callback
+        return tag
+
+    def basic_cancel(self, consumer_tag):
+        self._record("basic_cancel")
+        self.consumers.pop(consumer_tag, None)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._record("basic_ack")
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._record("basic_nack")
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self._record("basic_publish")
+        self.published.append((exchange, routing_key, body))
+
+    def queue_declare(self, queue, durable=False, passive=False):
+        self._record("queue_declare")
+        return Mock(method=Mock(message_count=0))
+
+    def close(self):
+        self._record("close")
+        self.is_open = False
+
+
+class FakeBlockingConnection:
+    """Minimal stand-in for pika's BlockingConnection driven by process_data_events."""
+
+    def __init__(self):
+        self.is_closed = False
+        self.channels = []
+        self._callbacks = queue.Queue()
+        self._failure = None
+
+    def channel(self):
+        channel = FakeBlockingChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        if self.is_closed:
+            raise pika.exceptions.ConnectionWrongStateError("Connection is closed")
+        self._callbacks.put(callback)
+
+    def process_data_events(self, time_limit=0):
+        if self._failure:
+            raise self._failure
+        try:
+            callback = self._callbacks.get(timeout=time_limit)
+        except queue.Empty:
+            return
+        callback()
+        while not self._callbacks.empty():
+            self._callbacks.get()()
+
+    def deliver(self, channel, body, delivery_tag=1):
+        """Simulate the broker pushing a message to every consumer of the channel."""
+        def push():
+            for callback in list(channel.consumers.values()):
+                callback(channel, Mock(delivery_tag=delivery_tag), Mock(), body)
+        self.add_callback_threadsafe(push)
+
+    def fail(self):
+        """Simulate the broker dropping the connection."""
+        self._failure = pika.exceptions.AMQPConnectionError("connection reset")
+        self._callbacks.put(lambda: None)
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeAsyncioChannel(FakeBlockingChannel):
+    """Stand-in for a pika Channel on an AsyncioConnection: RPCs report completion through `callback`."""
+
+    def __init__(self, connection):
+        super().__init__(connection)
+        self.qos = []
+        self._close_callbacks = []
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def basic_qos(self, prefetch_count=0, global_qos=False, callback=None):
+        self._record("basic_qos")
+        self.qos.append((prefetch_count, global_qos))
+        if callback:
+            callback(Mock())
+
+    def queue_declare(self, queue, durable=False, passive=False, callback=None):
+        self._record("queue_declare")
+        callback(Mock(method=Mock(message_count=0)))
+
+    def exchange_declare(self, exchange, exchange_type="direct", durable=False, callback=None):
+        self._record("exchange_declare")
+        callback(Mock())
+
+    def queue_bind(self, queue, exchange, routing_key=None, callback=None):
+        self._record("queue_bind")
+        callback(Mock())
+
+    def close(self):
+        super().close()
+        for callback in self._close_callbacks:
+            callback(self, "closed by client")
+
+
+class FakeAsyncioConnection:
+    """Stand-in for pika's AsyncioConnection; must be driven from the event loop thread."""
+
+    def __init__(self):
+        self.is_closed = False
+        self.channels = []
+
+    def channel(self, on_open_callback):
+        channel = FakeAsyncioChannel(self)
+        self.channels.append(channel)
+        on_open_callback(channel)
+
+    def deliver(self, channel, body, delivery_tag=1):
+        """Simulate the broker pushing a message to every consumer of the channel."""
+        for callback in list(channel.consumers.values()):
+            callback(channel, Mock(delivery_tag=delivery_tag), Mock(), body)
+
+    def close(self):
+        self.is_closed = True
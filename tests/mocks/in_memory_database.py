@@ -0,0 +1,100 @@
+import threading
+from types import SimpleNamespace
+
+from src.lib.calibration_stages import CalibrationStage
+
+
+class InMemoryDatabase:
+    """
+    Stand-in for Database keeping every table in dictionaries. The schema uses
+    PostgreSQL-only types (ARRAY, UUID) and functions (array_append), so SQLite
+    cannot host it; this keeps the same method surface and semantics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scores = {}
+        self._inputs = {}
+        self._outputs = {}
+
+    def get_latest_scores_record(self, session_id):
+        with self._lock:
+            record = self._scores.get(str(session_id))
+            return SimpleNamespace(**vars(record)) if record else None
+
+    def create_scores_record(self, session_id):
+        with self._lock:
+            self._scores.setdefault(
+                str(session_id),
+                SimpleNamespace(
+                    session_id=session_id,
+                    batchs_counter=0,
+                    samples_counter=0,
+                    stage=CalibrationStage.INITIAL_CALIBRATION,
+                    alpha=None,
+                    scores=None,
+                    class_scores=None,
+                    confidences=b"",
+                    alphas=[],
+                    uncertainties=[],
+                    coverages=[],
+                    setsizes=[],
+                    processed_batches=[],
+                    accuracy=0.0,
+                    correct_preds=0,
+                    total_samples=0,
+                ),
+            )
+
+    def update_session_state(self, session_id, updates):
+        with self._lock:
+            record = self._scores.get(str(session_id))
+            if record is None:
+                return
+            if "push_alphas" in updates:
+                record.alphas = record.alphas + [updates["push_alphas"]]
+            if "push_uncertainties" in updates:
+                record.uncertainties = record.uncertainties + [updates["push_uncertainties"]]
+            if "push_coverages" in updates:
+                record.coverages = record.coverages + [float(updates["push_coverages"])]
+            if "push_setsizes" in updates:
+                record.setsizes = record.setsizes + [updates["push_setsizes"]]
+            if "push_confidences" in updates:
+                record.confidences = (record.confidences or b"") + updates["push_confidences"]
+            if "push_processed_batches" in updates:
+                record.processed_batches = record.processed_batches + list(updates["push_processed_batches"])
+            for field in ["accuracy", "correct_preds", "total_samples", "alpha", "q_hat", "scores", "class_scores"]:
+                if field in updates:
+                    setattr(record, field, updates[field])
+            record.batchs_counter = updates["batchs_counter"]
+            record.samples_counter = updates.get("samples_counter", record.samples_counter)
+            record.stage = updates["stage"]
+
+    def write_inputs(self, session_id, inputs: bytes, batch_index: int):
+        with self._lock:
+            self._inputs[(str(session_id), batch_index)] = inputs
+
+    def write_outputs(self, session_id, outputs: bytes, batch_index: int):
+        with self._lock:
+            self._outputs[(str(session_id), batch_index)] = outputs
+
+    def delete_inputs(self, session_id):
+        with self._lock:
+            for key in [key for key in self._inputs if key[0] == str(session_id)]:
+                del self._inputs[key]
+
+    def mark_session_finished(self, session_id, status):
+        pass
+
+    def iter_inputs_from_session(self, session_id, columns=("inputs",), yield_per=None):
+        return self._iter_rows(self._inputs, "inputs", session_id, columns)
+
+    def iter_outputs_from_session(self, session_id, columns=("outputs",), yield_per=None):
+        return self._iter_rows(self._outputs, "outputs", session_id, columns)
+
+    def _iter_rows(self, table, body_column, session_id, columns):
+        with self._lock:
+            rows = sorted((index, body) for (sid, index), body in table.items() if sid == str(session_id))
+        for index, body in rows:
+            values = {"batch_index": index, body_column: body}
+            yield values[columns[0]] if len(columns) == 1 else tuple(values[column] for column in columns)
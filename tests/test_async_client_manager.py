@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+import pytest
+from src.middleware.async_middleware import AsyncMiddleware
+from src.server.async_client_manager import AsyncClientManager, AsyncSessionEngine, LoopPublisher
+from tests.mocks.fake_pika import FakeAsyncioConnection
+
+
+class RecordingBatchHandler:
+    """BatchHandler stand-in recording which thread handled each message; b"eof" ends the session."""
+
+    def __init__(self, on_eof, middleware, **kwargs):
+        self.on_eof = on_eof
+        self.middleware = middleware
+        self.channel = middleware.create_channel()
+        self.call_later = kwargs.get("call_later")
+        self.handled = []
+
+    def _build_state(self):
+        pass
+
+    def _handle_inputs_message(self, ch, body, ack=None):
+        time.sleep(0.01)
+        self.handled.append((body, threading.current_thread().name, list(ch.acks)))
+        if body == b"eof":
+            self.on_eof()
+        ack()
+
+    _handle_predictions_message = _handle_inputs_message
+
+    def handle_sigterm(self):
+        pass
+
+
+@pytest.fixture
+def connection():
+    return FakeAsyncioConnection()
+
+
+@pytest.fixture
+def engine(connection):
+    async def connect():
+        return connection
+
+    engine = AsyncSessionEngine(Mock(), max_workers=4, middleware=AsyncMiddleware(Mock(), connection_factory=connect))
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+@pytest.fixture
+def config():
+    return SimpleNamespace(
+        environment="DEVELOPMENT",
+        database_url="sqlite:///:memory:",
+        server_config=SimpleNamespace(
+            client_timeout_seconds=30, spill_dir="", session_memory_budget_bytes=0,
+            coalesce_target_samples=0, coalesce_max_delay_seconds=1.0,
+        ),
+        middleware_config=SimpleNamespace(
+            inputs_prefetch_count=4,
+            outputs_prefetch_count=4,
+            ack_batch_size=1,
+            ack_flush_interval_seconds=0.05,
+            inputs_max_unacked_bytes=0,
+            outputs_max_unacked_bytes=0,
+            lag_report_interval_seconds=0,
+        ),
+        database_config=SimpleNamespace(inputs_persistence="full", wal_dir=""),
+    )
+
+
+def start_session(engine, config, removals, name):
+    client_manager = AsyncClientManager(
+        engine=engine,
+        user_id=name,
+        session_id=f"session-{name}",
+        clients_to_remove_queue=removals,
+        config=config,
+        report_builder=Mock(),
+        utrace_calculator_factory=lambda database=None, session_id=None: Mock(),
+        connections_client=Mock(),
+        timeout_scheduler=Mock(),
+    )
+    client_manager.start()
+    deadline = time.monotonic() + 2
+    while client_manager.consumer is None or not client_manager.consumer.inputs_stream.channel or \
+            not client_manager.consumer.inputs_stream.channel.consumers:
+        assert time.monotonic() < deadline, "session did not start consuming"
+        time.sleep(0.01)
+    return client_manager
+
+
+def deliver(engine, connection, channel, bodies):
+    for tag, body in enumerate(bodies, start=1):
+        engine.call_soon(connection.deliver, channel, body, tag)
+
+
+@patch("src.server.async_client_manager.Database")
+@patch("src.server.async_client_manager.get_engine")
+@patch("src.server.async_client_manager.BatchHandler", RecordingBatchHandler)
+def test_messages_are_handled_in_order_off_the_loop_and_acked_after(mock_get_engine, MockDatabase, engine, connection, config):
+    removals = queue.Queue()
+    client_manager = start_session(engine, config, removals, "a")
+    channel = client_manager.consumer.inputs_stream.channel
+
+    deliver(engine, connection, channel, [b"1", b"2", b"3", b"eof"])
+    client_manager.join(timeout=5)
+
+    handled = client_manager.batch_handler.handled
+    assert [body for body, _, _ in handled] == [b"1", b"2", b"3", b"eof"]
+    assert all(thread.startswith("session-worker") for _, thread, _ in handled)
+    # Each message is acked only after it was handled, before the next one starts
+    assert [acks for _, _, acks in handled] == [[], [(1, True)], [(1, True), (2, True)], [(1, True), (2, True), (3, True)]]
+    assert channel.acks[-1] == (4, True)
+    assert not client_manager.is_alive()
+    assert removals.get(timeout=1) == "a"
+    client_manager.connections_client.flush.assert_called_once()
+
+
+@patch("src.server.async_client_manager.Database")
+@patch("src.server.async_client_manager.get_engine")
+@patch("src.server.async_client_manager.BatchHandler", RecordingBatchHandler)
+def test_sessions_share_one_loop_and_connection(mock_get_engine, MockDatabase, engine, connection, config):
+    removals = queue.Queue()
+    sessions = [start_session(engine, config, removals, name) for name in ["a", "b", "c"]]
+
+    for session in sessions:
+        deliver(engine, connection, session.consumer.inputs_stream.channel, [session.user_id.encode(), b"eof"])
+    for session in sessions:
+        session.join(timeout=5)
+
+    for session in sessions:
+        assert [body for body, _, _ in session.batch_handler.handled] == [session.user_id.encode(), b"eof"]
+    assert sorted(removals.get(timeout=1) for _ in sessions) == ["a", "b", "c"]
+    # publish + inputs + outputs channel per session, all on the engine's single connection
+    assert len(connection.channels) == 9
+    assert all(not channel.is_open for channel in connection.channels)
+
+
+@patch("src.server.async_client_manager.Database")
+@patch("src.server.async_client_manager.get_engine")
+@patch("src.server.async_client_manager.BatchHandler", RecordingBatchHandler)
+def test_terminate_stops_session_without_removal(mock_get_engine, MockDatabase, engine, connection, config):
+    removals = queue.Queue()
+    client_manager = start_session(engine, config, removals, "a")
+
+    client_manager.terminate()
+    client_manager.join(timeout=5)
+
+    assert client_manager.shutdown_initiated
+    assert not client_manager.is_alive()
+    assert removals.empty()
+
+
+@patch("src.server.async_client_manager.Database")
+@patch("src.server.async_client_manager.get_engine")
+@patch("src.server.async_client_manager.BatchHandler", RecordingBatchHandler)
+def test_batch_handler_timers_run_on_the_session_workers(mock_get_engine, MockDatabase, engine, connection, config):
+    client_manager = start_session(engine, config, queue.Queue(), "a")
+    handler = client_manager.batch_handler
+    fired = []
+    handler.call_later(0.05, lambda: fired.append(threading.current_thread().name))
+
+    deliver(engine, connection, client_manager.consumer.inputs_stream.channel, [b"1"])
+    time.sleep(0.3)
+    deliver(engine, connection, client_manager.consumer.inputs_stream.channel, [b"eof"])
+    client_manager.join(timeout=5)
+
+    assert len(fired) == 1
+    assert fired[0].startswith("session-worker")
+
+
+def test_publish_is_forwarded_to_the_loop(engine, connection):
+    channel = engine.submit(engine.middleware.create_channel()).result()
+    publisher = LoopPublisher(engine.middleware, channel)
+    assert publisher.create_channel() is channel
+    publisher.basic_send(channel, "mlflow", "key", b"payload")
+    time.sleep(0.1)
+
+    assert channel.published == [("mlflow", "key", b"payload")]
+    assert [thread for name, thread in channel.calls if name == "basic_publish"] == ["session-loop"]
@@ -1,17 +1,22 @@
+import os
 import pytest
 import numpy as np
 from unittest.mock import Mock, patch
+from proto import calibration_pb2, dataset_service_pb2, mlflow_probs_pb2
 from src.lib.data_types import DataType
+from src.lib.inputs_format_parser import parse_inputs_format
+from src.lib.spill_store import SpillStore
 from src.server.batch_handler import BatchHandler
 from src.lib.calibration_stages import CalibrationStage
+from tests.mocks.in_memory_database import InMemoryDatabase
 
 def report_builder_factory(user_id: str):
     return Mock()   
 
 def db_mock():
     db = Mock()
-    db.get_inputs_from_session.return_value = []
-    db.get_outputs_from_session.return_value = []
+    db.iter_inputs_from_session.return_value = []
+    db.iter_outputs_from_session.return_value = []
     
     record_mock = Mock()
     record_mock.setsizes = []
@@ -69,3 +74,144 @@ def test_handle_predictions_message(MockPredictions, handler):
 
     mock_msg.ParseFromString.assert_called_once_with(b"body")
     handler._store_data.assert_called_once()
+
+
+def test_lean_inputs_are_written_once_their_batch_joins_and_acked_then():
+    db = InMemoryDatabase()
+    db.write_inputs = Mock(side_effect=db.write_inputs)
+
+    def lean_handler():
+        uq = Mock(stage=CalibrationStage.INITIAL_CALIBRATION)
+        return BatchHandler(
+            user_id="client1", session_id="session1", on_eof=Mock(), middleware=Mock(), database=db,
+            utrace_calculator=uq, inputs_format=parse_inputs_format("(28, 28, 1)"), inputs_persistence="lean",
+        )
+
+    def inputs(batch_index):
+        return dataset_service_pb2.DataBatchLabeled(
+            data=np.ones((4, 28, 28, 1), dtype=np.float32).tobytes(), labels=[0, 1, 1, 0],
+            batch_index=batch_index, is_last_batch=batch_index == 1,
+        ).SerializeToString()
+
+    def predictions(batch_index):
+        message = calibration_pb2.Predictions(batch_index=batch_index)
+        for _ in range(4):
+            message.pred.add().values.extend([0.7, 0.3])
+        return message.SerializeToString()
+
+    handler = lean_handler()
+    acks = {batch_index: Mock() for batch_index in [0, 1]}
+    for batch_index in [0, 1]:
+        handler._handle_inputs_message(Mock(), inputs(batch_index), ack=acks[batch_index])
+    db.write_inputs.assert_not_called()
+    predictions_ack = Mock()
+    handler._handle_predictions_message(Mock(), predictions(0), ack=predictions_ack)
+    assert handler.uq.process_entry.call_count == 1
+
+    # Batch 0 joined: its inputs are written once, without images, then acked; batch 1 stays unacked
+    assert db.write_inputs.call_count == 1
+    [joined] = list(db.iter_inputs_from_session("session1"))
+    assert len(joined) < 32
+    acks[0].assert_called_once()
+    predictions_ack.assert_called_once()
+    acks[1].assert_not_called()
+
+    # Restart between the inputs and the predictions of batch 1: its inputs come back from the broker
+    restored = lean_handler()
+    restored._build_state()
+    assert restored._batches[0][DataType.LABELS].tolist() == [0, 1, 1, 0]
+    assert restored._batches[0][DataType.PROBS].shape == (4, 2)
+    assert 1 not in restored._batches
+    redelivered = Mock()
+    restored._handle_inputs_message(Mock(), inputs(1), ack=redelivered)
+    assert restored._inputs_eof
+    restored._handle_predictions_message(Mock(), predictions(1), ack=Mock())
+
+    sent = mlflow_probs_pb2.MlflowProbs()
+    sent.ParseFromString(restored._middleware.basic_send.call_args[1]["body"])
+    assert sent.batch_index == 1
+    assert len(sent.data) == 4 * 28 * 28 * 4
+    redelivered.assert_called_once()
+    assert db.write_inputs.call_count == 2
+    assert all(len(body) < 32 for body in db.iter_inputs_from_session("session1"))
+
+
+def test_arrays_beyond_the_memory_budget_are_spilled_to_memmaps(tmp_path):
+    store = SpillStore(str(tmp_path / "session1"))
+    uq = Mock(stage=CalibrationStage.INITIAL_CALIBRATION)
+    handler = BatchHandler(
+        user_id="client1", session_id="session1", on_eof=Mock(), middleware=Mock(), database=Mock(),
+        utrace_calculator=uq, inputs_format=None, spill_store=store, memory_budget_bytes=5000,
+    )
+    handler.send_mlflow_msg = Mock()
+    images = [np.full((4, 16, 16), i, dtype=np.float32) for i in range(3)]  # 4 KiB each
+
+    handler.store_inputs(0, images[0], np.array([0, 1, 0, 1]), persist=False)
+    handler._store_data(0, DataType.PROBS, np.full((4, 2), 0.5, dtype=np.float32), process_entry=True)
+    handler.store_inputs(1, images[1], np.array([1, 1, 0, 0]), persist=False)
+    assert not isinstance(handler._batches[1][DataType.INPUTS], np.memmap)
+    # Inputs of the processed batch go first
+    assert isinstance(handler._batches[0][DataType.INPUTS], np.memmap)
+
+    handler.store_inputs(2, images[2], np.array([0, 0, 0, 0]), persist=False)
+    assert isinstance(handler._batches[1][DataType.INPUTS], np.memmap)
+    assert handler._held_bytes <= 5000
+    assert handler._spilled_bytes == 2 * images[0].nbytes
+    np.testing.assert_array_equal(handler._batches[1][DataType.INPUTS], images[1])
+    assert sorted(os.listdir(tmp_path / "session1")) == ["0-inputs.npy", "1-inputs.npy"]
+
+    handler._store_data(1, DataType.INPUTS, np.zeros(1, dtype=np.float32), process_entry=False)
+    assert os.listdir(tmp_path / "session1") == ["0-inputs.npy"]
+    store.close()
+    assert not os.path.exists(tmp_path / "session1")
+
+
+def coalescing_handler(uq, database):
+    handler = BatchHandler(
+        user_id="client1", session_id="session1", on_eof=Mock(), middleware=Mock(), database=database,
+        utrace_calculator=uq, inputs_format=None, coalesce_target_samples=8,
+    )
+    handler.send_mlflow_msg = Mock()
+    return handler
+
+
+def test_joined_batches_are_processed_in_micro_batches():
+    uq = Mock(stage=CalibrationStage.INITIAL_CALIBRATION)
+    handler = coalescing_handler(uq, Mock())
+    for batch_index in range(3):
+        handler.store_inputs(batch_index, np.zeros((4, 2)), np.array([0, 1, 1, 0]), original_body=b"inputs")
+        handler.store_outputs(batch_index, np.full((4, 2), 0.5, dtype=np.float32), original_body=b"outputs")
+
+    # MLflow still gets every batch as soon as it is joined
+    assert handler.send_mlflow_msg.call_count == 3
+    uq.process_entry.assert_called_once()
+    entry, = uq.process_entry.call_args[0]
+    assert uq.process_entry.call_args[1] == {"batch_indices": [0, 1]}
+    assert entry[DataType.PROBS].shape == (8, 2)
+
+    handler._handle_eof()
+    assert uq.process_entry.call_args[1] == {"batch_indices": [2]}
+    assert uq.method_calls[-1] == ("update_stage", (CalibrationStage.FINISHED,), {})
+
+
+def test_restore_feeds_batches_left_out_of_the_stored_state():
+    db = InMemoryDatabase()
+    for batch_index in range(3):
+        inputs = dataset_service_pb2.DataBatchLabeled(
+            data=np.ones((4, 2, 2, 1), dtype=np.float32).tobytes(), labels=[0, 1, 1, 0], batch_index=batch_index,
+        )
+        db.write_inputs("session1", inputs.SerializeToString(), batch_index)
+        predictions = calibration_pb2.Predictions(batch_index=batch_index)
+        for _ in range(4):
+            predictions.pred.add().values.extend([0.7, 0.3])
+        db.write_outputs("session1", predictions.SerializeToString(), batch_index)
+
+    # The previous run stopped with batches 1 and 2 still waiting in a micro-batch
+    uq = Mock(stage=CalibrationStage.INITIAL_CALIBRATION, is_processed=lambda batch_index: batch_index == 0)
+    handler = coalescing_handler(uq, db)
+    handler._inputs_format = parse_inputs_format("(2, 2, 1)")
+    handler._build_state()
+
+    uq.process_entry.assert_called_once()
+    assert uq.process_entry.call_args[1] == {"batch_indices": [1, 2]}
+    handler.send_mlflow_msg.assert_not_called()
@@ -1,8 +1,11 @@
 import time
 import pytest
-import signal
-from unittest.mock import patch, Mock, MagicMock
-from src.server.client_manager import ClientManager
+from unittest.mock import patch, Mock
+from src.server.client_manager import ClientManager, ClientManagerThread
+from src.lib.session_status import SessionStatus
+from src.lib.timeout_scheduler import TimeoutScheduler
+from src.middleware.connections_client import ConnectionsServiceClient
+from tests.mocks.fake_connections_service import FakeConnectionsService
 
 
 @pytest.fixture
@@ -15,7 +18,7 @@ def client_manager(mock_middleware):
         return Mock()
     def utrace_calculator_factory(database=None, session_id=None):
         return Mock()
-    return ClientManager(user_id="client123", session_id="session123", recipient_email="", middleware=mock_middleware, clients_to_remove_queue=None, config=Mock(client_timeout_seconds=30), report_builder=report_builder_factory(user_id="client123"), utrace_calculator_factory=utrace_calculator_factory, inputs_format=None)
+    return ClientManager(user_id="client123", session_id="session123", recipient_email="", middleware=mock_middleware, clients_to_remove_queue=None, config=Mock(client_timeout_seconds=30, database_config=Mock(wal_dir=""), server_config=Mock(spill_dir="", coalesce_target_samples=0, coalesce_max_delay_seconds=1.0)), report_builder=report_builder_factory(user_id="client123"), utrace_calculator_factory=utrace_calculator_factory, inputs_format=None)
 
 
 def test_initialization(client_manager):
@@ -52,18 +55,18 @@ def test_run_success(MockConsumer, MockBatchHandler, mock_signal, MockDatabase,
     mock_consumer_instance = MockConsumer.return_value
     mock_batch_instance = MockBatchHandler.return_value
     
-    client_manager.timeout_checker_handler = Mock()
+    client_manager.timeout_scheduler = Mock()
     client_manager.clients_to_remove_queue = Mock()
     client_manager.config.database_url = "sqlite:///:memory:"
 
     client_manager.run()
-    mock_get_engine.assert_called_once_with("sqlite:///:memory:")
+    mock_get_engine.assert_called_once_with("sqlite:///:memory:", client_manager.config.database_config)
     MockDatabase.assert_called_once()
     
     MockBatchHandler.assert_called_once()
     MockConsumer.assert_called_once()
     
-    client_manager.timeout_checker_handler.start.assert_called_once()
+    client_manager.timeout_scheduler.schedule.assert_called_once_with(client_manager.inactivity_timer)
     
     mock_consumer_instance.start.assert_called_once()
     
@@ -78,7 +81,7 @@ def test_run_success(MockConsumer, MockBatchHandler, mock_signal, MockDatabase,
 def test_run_with_exception(MockConsumer, MockBatchHandler, mock_signal, MockDatabase, mock_get_engine, client_manager):
     MockBatchHandler.side_effect = Exception("boom")
     client_manager.logger = Mock()
-    client_manager.timeout_checker_handler = Mock() 
+    client_manager.timeout_scheduler = Mock()
 
     client_manager.run()
 
@@ -89,28 +92,33 @@ def test_run_with_exception(MockConsumer, MockBatchHandler, mock_signal, MockDat
 def test_handle_predictions_message_calls_batchhandler(client_manager):
     mock_batch = Mock()
     client_manager.batch_handler = mock_batch
+    client_manager.consumer = Mock()
     
     mock_ch = Mock()
     mock_method = Mock()
     
     client_manager._handle_predictions_message(mock_ch, mock_method, None, b"xyz")
     
-    mock_batch._handle_predictions_message.assert_called_once_with(mock_ch, b"xyz")
-    mock_ch.basic_ack.assert_called_once_with(delivery_tag=mock_method.delivery_tag)
+    mock_batch._handle_predictions_message.assert_called_once()
+    assert mock_batch._handle_predictions_message.call_args.args == (mock_ch, b"xyz")
+    # BatchHandler acks once the message is persisted
+    client_manager.consumer.ack.assert_not_called()
+    mock_batch._handle_predictions_message.call_args.kwargs["ack"]()
+    client_manager.consumer.ack.assert_called_once_with(mock_ch, mock_method.delivery_tag)
 
 
-@patch("requests.put")
-def test_handle_EOF_message_stops_processing(mock_put, client_manager):
+def test_handle_EOF_message_stops_processing(client_manager):
     """Verifica que _handle_EOF_message detenga batch_handler y consumer."""
     client_manager.batch_handler = Mock()
     client_manager.consumer = Mock()
-    mock_response = Mock()
-    mock_response.status_code = 200
-    mock_put.return_value = mock_response
+    client_manager.connections_client = Mock()
     client_manager._handle_EOF_message()
 
     client_manager.batch_handler.handle_sigterm.assert_called_once()
     client_manager.consumer.handle_sigterm.assert_called_once()
+    client_manager.connections_client.update_session_status.assert_called_once_with(
+        "session123", "client123", SessionStatus.COMPLETED
+    )
     
     
 def test_timeout_triggers_status_update():
@@ -130,16 +138,62 @@ def test_timeout_triggers_status_update():
     
     manager._initiate_shutdown = Mock()
 
-    with patch("requests.put") as mock_put:
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_put.return_value = mock_response
-        
-        manager.timeout_checker_handler.start()
+    service = FakeConnectionsService().start()
+    manager.connections_client = ConnectionsServiceClient(base_url=service.url)
+    manager.timeout_scheduler = TimeoutScheduler()
+    try:
+        manager._start_inactivity_timer()
         time.sleep(0.3)
-        manager.shutdown_initiated = True
-        manager.timeout_checker_handler.join()
-        
-        mock_put.assert_called()
-        args, kwargs = mock_put.call_args
-        assert "/sessions/abc/status/timeout" in args[0]
\ No newline at end of file
+        manager._initiate_shutdown.assert_called_once()
+        assert manager.connections_client.flush(timeout=5)
+    finally:
+        manager.timeout_scheduler.stop()
+        manager.connections_client.close()
+        service.stop()
+
+    paths = [path for path, _ in service.requests]
+    assert "/sessions/abc/status/timeout" in paths
+
+
+def test_messages_postpone_timeout():
+    config_mock = Mock()
+    config_mock.server_config.client_timeout_seconds = 0.2
+
+    manager = ClientManager(
+        user_id="123",
+        session_id="abc",
+        middleware=None,
+        clients_to_remove_queue=None,
+        config=config_mock,
+        report_builder=None,
+        utrace_calculator_factory=lambda database=None, session_id=None: Mock(),
+        connections_client=Mock(),
+        timeout_scheduler=TimeoutScheduler(),
+    )
+    manager.batch_handler = Mock()
+    manager.consumer = Mock()
+    manager._initiate_shutdown = Mock()
+
+    manager._start_inactivity_timer()
+    for _ in range(5):
+        time.sleep(0.1)
+        manager._handle_inputs_message(Mock(), Mock(), None, b"xyz")
+    manager._initiate_shutdown.assert_not_called()
+
+    time.sleep(0.4)
+    manager._initiate_shutdown.assert_called_once()
+    manager.timeout_scheduler.stop()
+
+
+def test_client_manager_thread_terminates_on_consuming_thread(client_manager):
+    client_manager.consumer = Mock()
+    client_manager.batch_handler = Mock()
+    runner = ClientManagerThread(client_manager)
+
+    runner.terminate()
+
+    scheduled = client_manager.middleware.add_callback_threadsafe.call_args[0][0]
+    assert not client_manager.shutdown_initiated
+    scheduled()
+    assert client_manager.shutdown_initiated
+    client_manager.consumer.handle_sigterm.assert_called_once()
@@ -0,0 +1,35 @@
+import numpy as np
+from benchmarks.db_codecs import main, quantized, run_suite
+from benchmarks.synthetic import SessionSpec, SyntheticSession
+from src.proto import dataset_service_pb2
+
+
+def test_codecs_round_trip_and_report_sizes(tmp_path):
+    output = tmp_path / "codecs.json"
+    results = main([
+        "--codecs", "none,zlib", "--sessions", "2", "--batches", "3", "--batch-size", "4",
+        "--image-shape", "8,8,1", "--output", str(output),
+    ])
+
+    assert set(results) == {"none", "zlib"}
+    assert results["none"]["ratio"] == 1.0
+    assert sum(results["zlib"]["stored_bytes"].values()) < sum(results["none"]["stored_bytes"].values())
+    assert results["zlib"]["restore_session_ms"]["p50"] > 0
+    assert output.exists()
+
+
+def test_quantized_pixels_take_few_values():
+    inputs, _ = SyntheticSession(SessionSpec(batches=1, batch_size=2, image_shape=(4, 4, 1))).batch(0)
+    message = dataset_service_pb2.DataBatchLabeled()
+    message.ParseFromString(quantized(inputs, 4))
+    assert len(np.unique(np.frombuffer(message.data, dtype=np.float32))) <= 4
+    assert quantized(inputs, 0) == inputs
+
+
+def test_shared_datasets_are_stored_once():
+    spec = SessionSpec(batches=2, batch_size=2, image_shape=(4, 4, 1))
+    results = run_suite(["none"], spec, sessions=4, datasets=1)
+
+    stored = results["none"]["stored_bytes"]
+    assert stored["inputs"] == 0
+    assert results["none"]["raw_bytes"] > 3 * stored["input_blobs"]
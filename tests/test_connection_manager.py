@@ -0,0 +1,162 @@
+import threading
+import time
+from unittest.mock import Mock
+import pika.exceptions
+import pytest
+from src.middleware.connection_manager import ConnectionManager, SessionMiddleware
+from tests.mocks.fake_pika import FakeBlockingConnection
+
+
+@pytest.fixture
+def connections():
+    return []
+
+
+@pytest.fixture
+def manager(connections):
+    def factory():
+        connection = FakeBlockingConnection()
+        connections.append(connection)
+        return connection
+
+    manager = ConnectionManager(Mock(max_retries=0), max_connections=2, sessions_per_connection=2, connection_factory=factory)
+    yield manager
+    manager.close()
+
+
+def start_session(manager, received, name):
+    session = SessionMiddleware(config=Mock(), connection_manager=manager)
+    channel = session.create_channel()
+    session.basic_consume(channel, f"{name}_queue", lambda ch, method, props, body: received.append((name, body, threading.current_thread().name)))
+    errors = []
+
+    def consume():
+        try:
+            session.start_consuming(channel)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=consume, name=f"session-{name}")
+    thread.start()
+    return session, channel, thread, errors
+
+
+def test_session_middleware_connects_lazily(manager, connections):
+    SessionMiddleware(config=Mock(), connection_manager=manager)
+    assert connections == []
+
+
+def test_sessions_share_a_small_pool_of_connections(manager, connections):
+    sessions = [SessionMiddleware(config=Mock(), connection_manager=manager) for _ in range(5)]
+    for session in sessions:
+        session.create_channel()
+
+    assert len(connections) == 2
+    assert sorted(manager.stats()) == [2, 3]
+
+    sessions[0].close_connection()
+    assert sorted(manager.stats()) == [2, 2]
+
+
+def test_channel_calls_run_on_io_thread(manager, connections):
+    session = SessionMiddleware(config=Mock(), connection_manager=manager)
+    channel = session.create_channel()
+
+    channel.basic_ack(delivery_tag=3, multiple=True)
+
+    fake_channel = connections[0].channels[0]
+    assert fake_channel.acks == [(3, True)]
+    assert all(thread == "amqp-io" for _, thread in fake_channel.calls)
+
+
+def test_deliveries_run_on_session_thread(manager, connections):
+    received = []
+    session, channel, thread, errors = start_session(manager, received, "a")
+
+    connections[0].deliver(connections[0].channels[0], b"hello")
+    time.sleep(0.2)
+    session.stop_consuming(channel)
+    thread.join(timeout=2)
+
+    assert received == [("a", b"hello", "session-a")]
+    assert errors == []
+
+
+def test_connection_loss_only_affects_its_sessions(manager, connections):
+    received = []
+    sessions = [start_session(manager, received, name) for name in ["a", "b", "c"]]
+    assert len(connections) == 2
+
+    broken = connections[0]
+    broken.fail()
+    time.sleep(0.3)
+
+    broken_sessions, healthy_sessions = sessions[:2], sessions[2:]
+    for _, _, thread, errors in broken_sessions:
+        thread.join(timeout=2)
+        assert isinstance(errors[0], pika.exceptions.AMQPConnectionError)
+
+    healthy_session, healthy_channel, healthy_thread, healthy_errors = healthy_sessions[0]
+    assert healthy_thread.is_alive()
+    connections[1].deliver(connections[1].channels[0], b"still-alive")
+    time.sleep(0.2)
+    healthy_session.stop_consuming(healthy_channel)
+    healthy_thread.join(timeout=2)
+    assert healthy_errors == []
+    assert ("c", b"still-alive", "session-c") in received
+
+    # New sessions fill the healthy connection, then a replacement is opened for the broken one
+    for _ in range(2):
+        SessionMiddleware(config=Mock(), connection_manager=manager).create_channel()
+    assert len(connections) == 3
+    assert sorted(manager.stats()) == [1, 2]
+
+
+def test_call_later_runs_on_session_thread(manager):
+    fired = []
+    session, channel, thread, _ = start_session(manager, [], "a")
+    session.call_later(0.05, lambda: fired.append(threading.current_thread().name))
+
+    time.sleep(0.3)
+    session.stop_consuming(channel)
+    thread.join(timeout=2)
+
+    assert fired == ["session-a"]
+
+
+def test_a_slow_connect_does_not_block_other_sessions(connections):
+    release_first = threading.Event()
+
+    def factory():
+        if not connections:
+            connections.append(None)
+            release_first.wait(timeout=5)
+        connection = FakeBlockingConnection()
+        connections.append(connection)
+        return connection
+
+    manager = ConnectionManager(Mock(max_retries=0), max_connections=2, sessions_per_connection=1, connection_factory=factory)
+    slow = SessionMiddleware(config=Mock(), connection_manager=manager)
+    thread = threading.Thread(target=slow.connect)
+    thread.start()
+    time.sleep(0.1)
+
+    # The first connection is still being opened: the manager answers and opens the second one
+    assert manager.stats() == [1]
+    SessionMiddleware(config=Mock(), connection_manager=manager).create_channel()
+    assert manager.stats() == [1, 1]
+
+    release_first.set()
+    thread.join(timeout=2)
+    assert slow._connection is not None and not slow._connection.broken
+    manager.close()
+
+
+def test_sessions_waiting_on_a_failed_connect_are_released(connections):
+    def factory():
+        raise OSError("broker unreachable")
+
+    manager = ConnectionManager(Mock(max_retries=0), max_connections=1, sessions_per_connection=4, connection_factory=factory)
+    with pytest.raises(pika.exceptions.AMQPConnectionError):
+        SessionMiddleware(config=Mock(), connection_manager=manager).connect()
+    assert manager.stats() == []
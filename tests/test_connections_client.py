@@ -0,0 +1,104 @@
+import time
+import pytest
+from src.lib.session_status import SessionStatus
+from src.middleware.connections_client import ConnectionsServiceClient
+from tests.mocks.fake_connections_service import FakeConnectionsService
+
+
+@pytest.fixture
+def service():
+    fake = FakeConnectionsService().start()
+    yield fake
+    fake.stop()
+
+
+def make_client(url, **kwargs):
+    kwargs.setdefault("backoff_factor", 0)
+    return ConnectionsServiceClient(base_url=url, **kwargs)
+
+
+def test_update_is_sent_to_service(service):
+    client = make_client(service.url)
+
+    client.update_session_status("session-1", "user-1", SessionStatus.COMPLETED)
+    assert client.flush(timeout=5)
+    client.close()
+
+    assert service.requests == [("/sessions/session-1/status/completed", {"user_id": "user-1"})]
+
+
+def test_update_does_not_block_on_slow_service():
+    service = FakeConnectionsService(response_delay=0.5).start()
+    client = make_client(service.url)
+
+    start = time.monotonic()
+    client.update_session_status("session-1", "user-1", SessionStatus.TIMEOUT)
+    assert time.monotonic() - start < 0.1
+
+    assert client.flush(timeout=5)
+    client.close()
+    service.stop()
+    assert len(service.requests) == 1
+
+
+def test_pending_updates_are_coalesced_per_session():
+    service = FakeConnectionsService(response_delay=0.3).start()
+    client = make_client(service.url)
+
+    client.update_session_status("session-1", "user-1", SessionStatus.IN_PROGRESS)
+    time.sleep(0.1)  # first update is now in flight
+    client.update_session_status("session-2", "user-2", SessionStatus.IN_PROGRESS)
+    client.update_session_status("session-2", "user-2", SessionStatus.COMPLETED)
+    client.update_session_status("session-1", "user-1", SessionStatus.TIMEOUT)
+
+    assert client.flush(timeout=5)
+    client.close()
+    service.stop()
+
+    assert [path for path, _ in service.requests] == [
+        "/sessions/session-1/status/in_progress",
+        "/sessions/session-2/status/completed",
+        "/sessions/session-1/status/timeout",
+    ]
+
+
+def test_connections_are_reused(service):
+    client = make_client(service.url)
+
+    for i in range(5):
+        assert client.send_session_status(f"session-{i}", "user", SessionStatus.COMPLETED)
+    client.close()
+
+    assert len(service.requests) == 5
+    assert len(service.connections) == 1
+
+
+def test_transient_failures_are_retried():
+    service = FakeConnectionsService(failures_before_success=2).start()
+    client = make_client(service.url, max_retries=3)
+
+    assert client.send_session_status("session-1", "user-1", SessionStatus.COMPLETED)
+    client.close()
+    service.stop()
+    assert len(service.requests) == 1
+
+
+def test_retries_are_bounded():
+    service = FakeConnectionsService(failures_before_success=10).start()
+    client = make_client(service.url, max_retries=2)
+
+    assert not client.send_session_status("session-1", "user-1", SessionStatus.COMPLETED)
+    client.close()
+    service.stop()
+    assert service.failures_before_success == 7
+
+
+def test_timeout_is_enforced():
+    service = FakeConnectionsService(response_delay=1).start()
+    client = make_client(service.url, read_timeout_seconds=0.2, max_retries=0)
+
+    start = time.monotonic()
+    assert not client.send_session_status("session-1", "user-1", SessionStatus.COMPLETED)
+    assert time.monotonic() - start < 1
+    client.close()
+    service.stop()
@@ -0,0 +1,204 @@
+import asyncio
+from unittest.mock import Mock, call
+import pytest
+import src.lib.metrics as metrics
+from src.lib.metrics import STREAM_LAG_MESSAGES, STREAM_UNACKED_BYTES, STREAM_UNACKED_MESSAGES, get_registry
+from src.middleware.async_middleware import AsyncConsumer
+from src.middleware.consumer import Consumer
+
+
+@pytest.fixture
+def middleware():
+    middleware = Mock()
+    middleware.create_channel.side_effect = lambda prefetch_count=1: Mock(is_open=True, prefetch=prefetch_count)
+    return middleware
+
+
+def make_consumer(middleware, **kwargs):
+    return Consumer(middleware=middleware, user_id="client1", **kwargs)
+
+
+def deliver(consumer, stream, tag, body=b"x"):
+    callback = consumer._inputs_callback if stream is consumer.inputs_stream else consumer._predictions_callback
+    callback(stream.channel, Mock(delivery_tag=tag), None, body)
+    consumer.ack(stream.channel, tag)
+
+
+def test_each_queue_gets_its_own_channel_and_prefetch(middleware):
+    consumer = make_consumer(middleware, inputs_prefetch_count=2, outputs_prefetch_count=32)
+
+    consumer._setup_queues()
+
+    assert consumer.inputs_stream.channel is not consumer.outputs_stream.channel
+    assert consumer.inputs_stream.channel.prefetch == 2
+    assert consumer.outputs_stream.channel.prefetch == 32
+    assert middleware.basic_consume.call_args_list == [
+        call(consumer.inputs_stream.channel, "client1_inputs_cal_queue", consumer._inputs_callback),
+        call(consumer.outputs_stream.channel, "client1_outputs_cal_queue", consumer._predictions_callback),
+    ]
+
+
+def test_acks_are_sent_in_groups_per_stream(middleware):
+    consumer = make_consumer(middleware, inputs_prefetch_count=4, outputs_prefetch_count=4, ack_batch_size=3)
+    inputs, outputs = consumer.inputs_stream, consumer.outputs_stream
+
+    for tag in range(1, 4):
+        deliver(consumer, inputs, tag)
+        deliver(consumer, outputs, tag)
+
+    inputs.channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+    outputs.channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+
+def test_partial_group_is_flushed_by_timer(middleware):
+    consumer = make_consumer(middleware, inputs_prefetch_count=8, outputs_prefetch_count=8, ack_batch_size=8)
+    ch = consumer.outputs_stream.channel
+
+    deliver(consumer, consumer.outputs_stream, 1)
+    deliver(consumer, consumer.outputs_stream, 2)
+    ch.basic_ack.assert_not_called()
+    middleware.call_later.assert_called_once()
+
+    delay, flush = middleware.call_later.call_args.args
+    assert delay == consumer.ack_flush_interval_seconds
+    flush()
+    ch.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+
+
+def test_ack_batch_size_is_bounded_by_prefetch(middleware):
+    consumer = make_consumer(middleware, inputs_prefetch_count=1, outputs_prefetch_count=2, ack_batch_size=50)
+    assert consumer.inputs_stream.ack_batch_size == 1
+    assert consumer.outputs_stream.ack_batch_size == 2
+
+
+def test_byte_limit_flushes_group_and_shrinks_window(middleware):
+    consumer = make_consumer(
+        middleware, inputs_prefetch_count=10, outputs_prefetch_count=10, ack_batch_size=10,
+        inputs_max_unacked_bytes=3000,
+    )
+    inputs = consumer.inputs_stream
+
+    deliver(consumer, inputs, 1, body=b"x" * 1000)
+    middleware.set_prefetch.assert_called_once_with(inputs.channel, 3, global_qos=True)
+    assert inputs.effective_prefetch_count == 3
+
+    deliver(consumer, inputs, 2, body=b"x" * 1000)
+    inputs.channel.basic_ack.assert_not_called()
+    deliver(consumer, inputs, 3, body=b"x" * 1000)
+    inputs.channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+
+def test_lag_is_sampled_per_stream(middleware):
+    middleware.get_message_count.side_effect = lambda queue: 7 if "inputs" in queue else 0
+    consumer = make_consumer(middleware, lag_report_interval_seconds=5)
+
+    consumer._report_lag()
+
+    stats = consumer.stream_stats()
+    assert stats["inputs"]["lag"] == 7
+    assert stats["outputs"]["lag"] == 0
+    middleware.call_later.assert_called_once_with(5, consumer._report_lag)
+
+
+def stream_gauges(stream):
+    snapshot = get_registry().snapshot()
+    return tuple(
+        snapshot[gauge.name]["samples"][(stream,)]
+        for gauge in (STREAM_LAG_MESSAGES, STREAM_UNACKED_MESSAGES, STREAM_UNACKED_BYTES)
+    )
+
+
+def test_lag_and_unacked_messages_are_exported_per_stream(middleware, monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", None)
+    middleware.get_message_count.side_effect = lambda queue: 7 if "inputs" in queue else 0
+    consumers = [
+        make_consumer(middleware, inputs_prefetch_count=8, ack_batch_size=8, lag_report_interval_seconds=5)
+        for _ in range(2)
+    ]
+    deliver(consumers[0], consumers[0].inputs_stream, 1, body=b"x" * 100)
+
+    for consumer in consumers:
+        consumer._report_lag()
+    # Sessions of a process add up
+    assert stream_gauges("inputs") == (14, 1, 100)
+    assert stream_gauges("outputs") == (0, 0, 0)
+
+    middleware.get_message_count.side_effect = lambda queue: 2
+    consumers[0].flush_acks()
+    consumers[0]._report_lag()
+    assert stream_gauges("inputs") == (9, 0, 0)
+
+    consumers[1].finish()
+    assert stream_gauges("inputs") == (2, 0, 0)
+
+
+def test_async_consumer_exports_lag(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", None)
+
+    async def get_message_count(queue):
+        return 3
+
+    middleware = Mock(get_message_count=get_message_count)
+    consumer = AsyncConsumer(middleware=middleware, user_id="client1", lag_report_interval_seconds=5)
+
+    asyncio.run(consumer._report_lag_async())
+
+    assert stream_gauges("inputs") == (3, 0, 0)
+    assert stream_gauges("outputs") == (3, 0, 0)
+    middleware.call_later.assert_called_once_with(5, consumer._report_lag)
+
+
+def test_pending_acks_are_flushed_on_finish(middleware):
+    consumer = make_consumer(middleware, inputs_prefetch_count=8, outputs_prefetch_count=8, ack_batch_size=8)
+    deliver(consumer, consumer.inputs_stream, 5)
+
+    consumer.finish()
+
+    consumer.inputs_stream.channel.basic_ack.assert_called_once_with(delivery_tag=5, multiple=True)
+    middleware.close_channel.assert_has_calls([call(consumer.inputs_stream.channel), call(consumer.outputs_stream.channel)])
+
+
+def test_sigterm_stops_both_streams(middleware):
+    consumer = make_consumer(middleware)
+
+    consumer.handle_sigterm()
+
+    middleware.stop_consuming.assert_has_calls(
+        [call(consumer.outputs_stream.channel), call(consumer.inputs_stream.channel)]
+    )
+
+
+def test_before_ack_runs_once_per_group(middleware):
+    events = []
+    consumer = make_consumer(middleware, inputs_prefetch_count=4, ack_batch_size=2, before_ack=lambda: events.append("sync"))
+    channel = consumer.inputs_stream.channel
+    channel.basic_ack.side_effect = lambda **kwargs: events.append("ack")
+
+    deliver(consumer, consumer.inputs_stream, 1)
+    assert events == []
+    deliver(consumer, consumer.inputs_stream, 2)
+    consumer.flush_acks()
+
+    assert events == ["sync", "ack"]
+
+
+def test_a_held_delivery_is_not_covered_by_later_group_acks(middleware):
+    consumer = make_consumer(middleware, inputs_prefetch_count=8, outputs_prefetch_count=8, ack_batch_size=2)
+    inputs = consumer.inputs_stream
+    for tag in range(1, 5):
+        consumer._inputs_callback(inputs.channel, Mock(delivery_tag=tag), None, b"x")
+
+    # 2 is held by its callback (lean inputs waiting for their batch to join)
+    consumer.ack(inputs.channel, 1)
+    consumer.ack(inputs.channel, 3)
+    consumer.ack(inputs.channel, 4)
+    consumer.flush_acks()
+    assert inputs.channel.basic_ack.call_args_list == [
+        call(delivery_tag=1, multiple=True), call(delivery_tag=3, multiple=False), call(delivery_tag=4, multiple=False),
+    ]
+
+    inputs.channel.basic_ack.reset_mock()
+    consumer._inputs_callback(inputs.channel, Mock(delivery_tag=5), None, b"x")
+    consumer.ack(inputs.channel, 2)
+    consumer.ack(inputs.channel, 5)
+    assert inputs.channel.basic_ack.call_args_list == [call(delivery_tag=5, multiple=True)]
@@ -0,0 +1,196 @@
+import sys
+import threading
+import types
+import uuid
+import pytest
+from sqlalchemy import create_engine, event, func, select
+import src.database.db as db_module
+import src.lib.metrics as metrics
+from src.database.codecs import get_codec
+from src.database.db import Database
+from src.lib.metrics import DB_QUERY_SECONDS, get_registry
+from src.models.input_blobs import InputBlobs
+from src.models.inputs import ModelInputs
+from src.models.outputs import ModelOutputs
+from src.models.stored_sessions import StoredSessions
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", None)
+    engine = create_engine("sqlite://")
+    # The scores table needs PostgreSQL; the batch tables work on SQLite
+    database = Database(engine, slow_query_seconds=60)
+    InputBlobs.__table__.create(engine, checkfirst=True)
+    ModelInputs.__table__.create(engine, checkfirst=True)
+    ModelOutputs.__table__.create(engine, checkfirst=True)
+    StoredSessions.__table__.create(engine, checkfirst=True)
+    return database
+
+
+def statements(method):
+    samples = get_registry().snapshot()[DB_QUERY_SECONDS.name]["samples"]
+    return samples[(method,)]["count"]
+
+
+def test_write_is_a_single_upsert(db):
+    assert not db.dedup_inputs  # opt-in: it adds statements to every inputs write
+    session_id = uuid.uuid4()
+    db.write_outputs(session_id, b"first", 0)
+    db.write_outputs(session_id, b"second", 0)
+    db.write_inputs(session_id, b"inputs", 0)
+
+    assert list(db.iter_outputs_from_session(session_id)) == [b"second"]
+    assert list(db.iter_inputs_from_session(session_id)) == [b"inputs"]
+    # One upsert per write, plus the session's registration in stored_sessions on its first write
+    assert statements("write_outputs") == 3
+
+
+def test_checkpoint_writes_chunk_and_keep_the_last_duplicate(db, monkeypatch):
+    monkeypatch.setattr(db_module, "BULK_WRITE_CHUNK_ROWS", 2)
+    session_id = uuid.uuid4()
+    db.write_outputs(session_id, b"old", 1)
+
+    db.apply_checkpoint(session_id, outputs=[(0, b"a"), (1, b"b"), (2, b"c"), (0, b"a2")])
+
+    assert list(db.iter_outputs_from_session(session_id)) == [b"a2", b"b", b"c"]
+    assert statements("apply_checkpoint") == 2
+
+
+def test_restore_streams_rows_in_batch_order(db):
+    session_id = uuid.uuid4()
+    for batch_index, body in [(2, b"c"), (0, b"a"), (1, b"b")]:
+        db.write_inputs(session_id, body, batch_index)
+    db.write_inputs(uuid.uuid4(), b"other session", 0)
+
+    stream = db.iter_inputs_from_session(session_id, yield_per=2)
+    assert ("iter_inputs_from_session",) not in get_registry().snapshot()[DB_QUERY_SECONDS.name]["samples"]
+    assert next(stream) == b"a"
+    assert list(stream) == [b"b", b"c"]
+    assert statements("iter_inputs_from_session") == 1
+
+    rows = list(db.iter_inputs_from_session(session_id, columns=("batch_index",)))
+    assert rows == [0, 1, 2]
+
+
+def test_codec_is_recorded_per_row_and_decoded_on_read(db):
+    session_id = uuid.uuid4()
+    body = b"softmax " * 100
+    db.write_inputs(session_id, body, 0)
+    db.codec = get_codec("zlib")
+    db.write_inputs(session_id, body, 1)
+    db.write_inputs(session_id, b"", 2)
+
+    with db.engine.connect() as connection:
+        rows = connection.execute(select(ModelInputs.batch_index, ModelInputs.codec, ModelInputs.inputs).order_by(ModelInputs.batch_index)).all()
+    assert [row.codec for row in rows] == ["none", "zlib", "zlib"]
+    assert len(rows[1].inputs) < len(body)
+
+    assert list(db.iter_inputs_from_session(session_id)) == [body, body, b""]
+    assert list(db.iter_inputs_from_session(session_id)) == [body, body, b""]
+    restored = list(db.iter_inputs_from_session(session_id, columns=("inputs", "batch_index")))
+    assert restored[1].inputs == body and restored[1].batch_index == 1
+
+
+def test_codec_selection(monkeypatch):
+    monkeypatch.setenv("DB_CODEC", "zlib")
+    assert Database(create_engine("sqlite://"), slow_query_seconds=60).codec.name == "zlib"
+    # A fast codec whose package is missing falls back to zlib
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+    assert get_codec("zstd").name == "zlib"
+    with pytest.raises(ValueError):
+        get_codec("brotli")
+
+
+def test_zstd_compressors_are_not_shared_between_threads(monkeypatch):
+    created = []
+
+    class Recording:
+        def __init__(self, **kwargs):
+            created.append((type(self).__name__, threading.get_ident()))
+
+        def compress(self, body):
+            return body[::-1]
+
+        decompress = compress
+
+    zstandard = types.SimpleNamespace(
+        ZstdCompressor=type("ZstdCompressor", (Recording,), {}),
+        ZstdDecompressor=type("ZstdDecompressor", (Recording,), {}),
+    )
+    monkeypatch.setitem(sys.modules, "zstandard", zstandard)
+    codec = get_codec("zstd")
+    # Both threads stay alive until both are done, so their idents differ
+    both_done = threading.Barrier(2)
+
+    def round_trip():
+        assert codec.decompress(codec.compress(b"abc")) == b"abc"
+        assert codec.decompress(codec.compress(b"de")) == b"de"
+        both_done.wait(timeout=5)
+
+    threads = [threading.Thread(target=round_trip) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # One compressor and one decompressor per thread, reused for its later bodies
+    assert len(created) == 4
+    assert len({ident for _, ident in created}) == 2
+
+
+def blobs(db):
+    with db.engine.connect() as connection:
+        return dict(connection.execute(select(InputBlobs.digest, InputBlobs.refcount)).all())
+
+
+def test_identical_inputs_are_stored_once_and_reference_counted(db):
+    db.dedup_inputs = True
+    first, second = uuid.uuid4(), uuid.uuid4()
+    db.apply_checkpoint(first, inputs=[(0, b"dataset batch 0"), (1, b"dataset batch 1")])
+    db.apply_checkpoint(second, inputs=[(0, b"dataset batch 0"), (1, b"dataset batch 1"), (2, b"dataset batch 0")])
+
+    assert sorted(blobs(db).values()) == [2, 3]
+    with db.engine.connect() as connection:
+        assert connection.execute(select(func.count()).where(ModelInputs.inputs.is_not(None))).scalar() == 0
+    assert list(db.iter_inputs_from_session(second)) == [b"dataset batch 0", b"dataset batch 1", b"dataset batch 0"]
+
+    # Redelivering a batch keeps its reference; replacing it moves the reference
+    db.write_inputs(first, b"dataset batch 0", 0)
+    db.write_inputs(first, b"dataset batch 2", 1)
+    assert sorted(blobs(db).values()) == [1, 1, 3]
+
+    db.delete_inputs(second)
+    assert sorted(blobs(db).values()) == [1, 1]
+    assert list(db.iter_inputs_from_session(first)) == [b"dataset batch 0", b"dataset batch 2"]
+    db.delete_inputs(first)
+    assert blobs(db) == {}
+
+
+def test_blob_rows_are_locked_and_written_in_digest_order(db):
+    db.dedup_inputs = True
+    executed = []
+    event.listen(db.engine, "before_cursor_execute", lambda conn, cursor, sql, params, context, many: executed.append((sql, params)))
+    session_id = uuid.uuid4()
+    db.apply_checkpoint(session_id, inputs=[(batch_index, f"body {batch_index}".encode()) for batch_index in range(8)])
+    db.apply_checkpoint(session_id, inputs=[(batch_index, f"new body {batch_index}".encode()) for batch_index in range(8)])
+
+    locks = [sql for sql, _ in executed if sql.lstrip().startswith("SELECT input_blobs.digest")]
+    assert locks and all("ORDER BY input_blobs.digest" in sql for sql in locks)
+    inserted = [params for sql, params in executed if sql.lstrip().startswith("INSERT INTO input_blobs")]
+    assert inserted
+    for params in inserted:
+        digests = [value for value in params if isinstance(value, str) and len(value) == 64]
+        assert digests == sorted(digests)
+    assert sorted(blobs(db).values()) == [1] * 8
+
+
+def test_turning_dedup_off_still_releases_the_blobs_of_replaced_rows(db):
+    session_id = uuid.uuid4()
+    db.dedup_inputs = True
+    db.write_inputs(session_id, b"deduplicated", 0)
+    db.dedup_inputs = False
+    db.write_inputs(session_id, b"plain", 0)
+    db.write_inputs(session_id, b"plain", 1)
+
+    assert blobs(db) == {}
+    assert list(db.iter_inputs_from_session(session_id)) == [b"plain", b"plain"]
@@ -0,0 +1,54 @@
+import sqlite3
+from types import SimpleNamespace
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+import src.lib.metrics as metrics
+from src.lib.db_engine import TimedQueuePool, _count_checkouts, get_engine, planned_connections
+from src.lib.metrics import DB_POOL_CHECKED_OUT, DB_POOL_TIMEOUTS_TOTAL, DB_POOL_WAIT_SECONDS, get_registry
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", None)
+
+
+def sample(metric):
+    return get_registry().snapshot()[metric.name]["samples"][()]
+
+
+def test_engine_is_shared_within_a_process(tmp_path):
+    url = f"sqlite:///{tmp_path / 'shared.db'}"
+    assert get_engine(url) is get_engine(url)
+    assert get_engine(url) is not get_engine(f"sqlite:///{tmp_path / 'other.db'}")
+
+
+def test_pool_reports_checkouts_waits_and_timeouts():
+    engine = create_engine(
+        "sqlite://", poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.05,
+        creator=lambda: sqlite3.connect(":memory:", check_same_thread=False),
+    )
+    _count_checkouts(engine)
+
+    connection = engine.connect()
+    assert sample(DB_POOL_CHECKED_OUT) == 1
+    with pytest.raises(PoolTimeoutError):
+        engine.connect()
+    assert sample(DB_POOL_TIMEOUTS_TOTAL) == 1
+    connection.close()
+
+    assert sample(DB_POOL_CHECKED_OUT) == 0
+    waits = sample(DB_POOL_WAIT_SECONDS)
+    assert waits["count"] == 2 and waits["sum"] >= 0.05
+
+
+def test_planned_connections():
+    database_config = SimpleNamespace(pool_size=2, pool_max_overflow=3)
+    config = SimpleNamespace(
+        database_config=database_config,
+        server_config=SimpleNamespace(session_engine="process", upper_bound_clients=100),
+    )
+    # The server's pool plus one per ClientManager process
+    assert planned_connections(config) == 101 * 5
+    config.server_config.session_engine = "thread"
+    assert planned_connections(config) == 5
@@ -0,0 +1,14 @@
+from benchmarks.e2e_throughput import MIN_BATCHES, E2EBenchmark
+from benchmarks.synthetic import SessionSpec
+
+
+def test_benchmark_drives_sessions_to_their_report():
+    spec = SessionSpec(batches=MIN_BATCHES, batch_size=8, num_classes=10, image_shape=(4, 4, 1))
+
+    results = E2EBenchmark(spec, sessions=2, timeout_seconds=60).run()
+
+    assert results["completed_sessions"] == 2
+    assert results["batches_processed"] == 2 * MIN_BATCHES
+    assert results["batches_per_second"] > 0
+    assert results["batch_latency_ms"]["p50"] <= results["batch_latency_ms"]["p99"]
+    assert results["time_to_report_seconds"]["max"] is not None
@@ -0,0 +1,153 @@
+import threading
+from unittest.mock import Mock
+import pika.exceptions
+import pytest
+from src.lib.config import INPUTS_QUEUE_NAME, OUTPUTS_QUEUE_NAME
+from src.middleware.connection_manager import ConnectionManager, SessionMiddleware
+from src.middleware.consumer import Consumer
+from src.middleware.memory_broker import InMemoryBroker, InMemoryMiddleware
+
+
+@pytest.fixture
+def broker():
+    return InMemoryBroker()
+
+
+def drain(connection):
+    for _ in range(3):
+        connection.process_data_events(time_limit=0)
+
+
+def test_routing_by_exchange_type(broker):
+    channel = broker.connect().channel()
+    for name in ["direct_q", "fanout_a", "fanout_b", "topic_q", "plain_q"]:
+        channel.queue_declare(queue=name)
+    channel.exchange_declare(exchange="direct", exchange_type="direct")
+    channel.exchange_declare(exchange="fanout", exchange_type="fanout")
+    channel.exchange_declare(exchange="topic", exchange_type="topic")
+    channel.queue_bind(queue="direct_q", exchange="direct", routing_key="a.key")
+    channel.queue_bind(queue="fanout_a", exchange="fanout", routing_key="")
+    channel.queue_bind(queue="fanout_b", exchange="fanout", routing_key="")
+    channel.queue_bind(queue="topic_q", exchange="topic", routing_key="mlflow.#")
+
+    channel.basic_publish(exchange="direct", routing_key="a.key", body=b"1")
+    channel.basic_publish(exchange="direct", routing_key="other", body=b"dropped")
+    channel.basic_publish(exchange="fanout", routing_key="ignored", body=b"2")
+    channel.basic_publish(exchange="topic", routing_key="mlflow.key.v2", body=b"3")
+    channel.basic_publish(exchange="", routing_key="plain_q", body=b"4")
+
+    ready = {name: stats["ready"] for name, stats in broker.queue_stats().items()}
+    assert ready == {"direct_q": 1, "fanout_a": 1, "fanout_b": 1, "topic_q": 1, "plain_q": 1}
+    assert channel.queue_declare(queue="plain_q", passive=True).method.message_count == 1
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        channel.queue_declare(queue="missing", passive=True)
+    assert not channel.is_open
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        broker.connect().channel().basic_publish(exchange="missing", routing_key="", body=b"")
+
+
+def test_prefetch_limits_unacked_and_multi_ack_frees_the_window(broker):
+    connection = broker.connect()
+    channel = connection.channel()
+    channel.queue_declare(queue="q")
+    channel.basic_qos(prefetch_count=2)
+    received = []
+    channel.basic_consume(queue="q", on_message_callback=lambda ch, method, props, body: received.append(method.delivery_tag))
+    for i in range(5):
+        channel.basic_publish(exchange="", routing_key="q", body=str(i).encode())
+
+    drain(connection)
+    assert received == [1, 2]
+    assert broker.queue_stats()["q"] == {"ready": 3, "unacked": 2, "consumers": 1}
+
+    channel.basic_ack(delivery_tag=2, multiple=True)
+    drain(connection)
+    assert received == [1, 2, 3, 4]
+
+    channel.basic_qos(prefetch_count=1, global_qos=True)
+    channel.basic_ack(delivery_tag=4, multiple=True)
+    drain(connection)
+    assert received == [1, 2, 3, 4, 5]
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        channel.basic_ack(delivery_tag=99)
+
+
+def test_nack_and_channel_close_redeliver(broker):
+    connection = broker.connect()
+    first, second = connection.channel(), connection.channel()
+    first.queue_declare(queue="q")
+    deliveries = []
+
+    def record(ch, method, props, body):
+        deliveries.append((ch.channel_number, body, method.redelivered))
+
+    first.basic_consume(queue="q", on_message_callback=record)
+    first.basic_publish(exchange="", routing_key="q", body=b"m")
+    drain(connection)
+    first.basic_nack(delivery_tag=1, requeue=True)
+    drain(connection)
+    assert deliveries == [(first.channel_number, b"m", False), (first.channel_number, b"m", True)]
+
+    second.basic_consume(queue="q", on_message_callback=record)
+    first.close()  # unacked delivery goes back to the queue and to the remaining consumer
+    drain(connection)
+    assert deliveries[-1] == (second.channel_number, b"m", True)
+
+
+def test_consumer_runs_unchanged_on_in_memory_middleware(broker):
+    middleware = InMemoryMiddleware(Mock(), broker)
+    user_id = "client1"
+    setup = middleware.create_channel()
+    setup.queue_declare(queue=f"{user_id}_{OUTPUTS_QUEUE_NAME}")
+    handled = []
+
+    def on_inputs(ch, method, properties, body):
+        handled.append(body)
+        consumer.ack(ch, method.delivery_tag)
+        if body == b"last":
+            consumer.handle_sigterm()
+
+    consumer = Consumer(middleware, user_id, inputs_callback=on_inputs, inputs_prefetch_count=2, ack_batch_size=2)
+    consumer._setup_queues()
+    for body in [b"a", b"b", b"c", b"last"]:
+        setup.basic_publish(exchange="", routing_key=f"{user_id}_{INPUTS_QUEUE_NAME}", body=body)
+    consumer.start()
+
+    assert handled == [b"a", b"b", b"c", b"last"]
+    assert broker.queue_stats()[f"{user_id}_{INPUTS_QUEUE_NAME}"] == {"ready": 0, "unacked": 0, "consumers": 0}
+
+
+def test_session_middleware_pool_on_in_memory_broker(broker):
+    manager = ConnectionManager(Mock(max_retries=0), max_connections=1, connection_factory=broker.connect)
+    session = SessionMiddleware(config=Mock(), connection_manager=manager)
+    channel = session.create_channel()
+    channel.queue_declare(queue="q")
+    received = []
+
+    def on_message(ch, method, props, body):
+        received.append((body, threading.current_thread().name))
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        session.stop_consuming(ch)
+
+    session.basic_consume(channel, "q", on_message)
+    channel.basic_publish(exchange="", routing_key="q", body=b"hello")
+    session.start_consuming(channel)
+    manager.close()
+
+    assert received == [(b"hello", threading.current_thread().name)]
+    assert broker.queue_stats()["q"]["unacked"] == 0
+
+
+def test_lag_of_a_missing_queue_leaves_the_consuming_channel_open(broker):
+    middleware = InMemoryMiddleware(Mock(), broker)
+    consuming = middleware.create_channel()
+    consuming.queue_declare(queue="q")
+    consuming.basic_consume(queue="q", on_message_callback=lambda *args: None)
+
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        middleware.get_message_count("missing")
+    assert consuming.is_open
+    # The closed management channel is replaced on the next sample
+    consuming.queue_declare(queue="backlog")
+    consuming.basic_publish(exchange="", routing_key="backlog", body=b"x")
+    assert middleware.get_message_count("backlog") == 1
@@ -0,0 +1,128 @@
+import time
+import urllib.request
+from multiprocessing import Process, Queue
+from unittest.mock import Mock
+import numpy as np
+import pytest
+import src.lib.metrics as metrics
+from src.lib.metrics import (
+    BATCH_JOIN_WAIT_SECONDS,
+    BATCHES_BYTES,
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsCollector,
+    MetricsPusher,
+    MetricsServer,
+    get_registry,
+    render,
+)
+from src.server.batch_handler import BatchHandler
+
+REQUESTS = Counter("test_requests_total", "Requests", ("kind",))
+IN_FLIGHT = Gauge("test_in_flight", "In flight")
+LATENCY = Histogram("test_latency_seconds", "Latency", buckets=(0.1, 1.0))
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", None)
+
+
+def sample(snapshot, name, key=()):
+    return snapshot[name]["samples"][key]
+
+
+def test_exposition_format():
+    REQUESTS.inc(kind="inputs")
+    REQUESTS.inc(2, kind="inputs")
+    IN_FLIGHT.set(3)
+    for value in [0.05, 0.5, 5]:
+        LATENCY.observe(value)
+
+    text = render(get_registry().snapshot())
+
+    assert "# TYPE test_requests_total counter" in text
+    assert 'test_requests_total{kind="inputs"} 3' in text
+    assert "test_in_flight 3" in text
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{le="1"} 2' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in text
+    assert "test_latency_seconds_count 3" in text
+    with pytest.raises(ValueError):
+        REQUESTS.inc(kind="inputs", extra="x")
+
+
+def test_forked_process_starts_with_an_empty_registry(monkeypatch):
+    REQUESTS.inc(kind="inputs")
+    monkeypatch.setattr(metrics, "_registry_pid", -1)  # as seen from a child process
+    assert get_registry().snapshot() == {}
+
+
+def record_and_push(queue):
+    REQUESTS.inc(5, kind="inputs")
+    IN_FLIGHT.inc()
+    MetricsPusher(queue, interval_seconds=60).stop()
+
+
+def test_collector_sums_processes_and_drops_gauges_of_finished_ones():
+    REQUESTS.inc(kind="inputs")
+    collector = MetricsCollector(Queue())
+    collector.receive(101, {"test_in_flight": {**IN_FLIGHT.describe(), "samples": {(): 2}}})
+    collector.start()
+    child = Process(target=record_and_push, args=(collector.metrics_queue,))
+    child.start()
+    child.join()
+    collector.stop()
+
+    snapshot = collector.snapshot()
+    assert sample(snapshot, "test_requests_total", ("inputs",)) == 6
+    assert sample(snapshot, "test_in_flight") == 2  # the child's gauge left with it
+
+
+def test_collector_drops_gauges_of_processes_that_stopped_pushing():
+    collector = MetricsCollector(Queue(), stale_after_seconds=0.05)
+    pushed = {
+        "test_in_flight": {**IN_FLIGHT.describe(), "samples": {(): 2}},
+        "test_requests_total": {**REQUESTS.describe(), "samples": {("inputs",): 3}},
+    }
+    collector.receive(101, pushed)
+    assert sample(collector.snapshot(), "test_in_flight") == 2
+
+    time.sleep(0.1)
+    snapshot = collector.snapshot()
+    assert "test_in_flight" not in snapshot
+    assert sample(snapshot, "test_requests_total", ("inputs",)) == 3
+    # A slow process that pushes again is live again
+    collector.receive(101, pushed)
+    assert sample(collector.snapshot(), "test_in_flight") == 2
+
+
+def test_metrics_endpoint():
+    LATENCY.observe(0.2)
+    server = MetricsServer(MetricsCollector(Queue()), host="127.0.0.1", port=0)
+    server.start()
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            body = response.read().decode()
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    finally:
+        server.stop()
+    assert "test_latency_seconds_count 1" in body
+
+
+def test_batch_handler_tracks_join_wait_and_held_bytes():
+    handler = BatchHandler(
+        user_id="client1", session_id="session1", on_eof=Mock(), middleware=Mock(),
+        database=Mock(), utrace_calculator=Mock(), inputs_format=None,
+    )
+    inputs, probs, labels = np.zeros((2, 4), dtype=np.float32), np.ones((2, 3), dtype=np.float32), np.array([0, 1])
+
+    handler.store_inputs(0, inputs, labels, original_body=b"")
+    handler.store_outputs(0, probs, original_body=b"")
+
+    snapshot = get_registry().snapshot()
+    assert sample(snapshot, BATCH_JOIN_WAIT_SECONDS.name)["count"] == 1
+    assert sample(snapshot, BATCHES_BYTES.name) == inputs.nbytes + probs.nbytes + labels.nbytes
+    handler.handle_sigterm()
+    assert sample(get_registry().snapshot(), BATCHES_BYTES.name) == 0
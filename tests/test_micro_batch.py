@@ -0,0 +1,104 @@
+import numpy as np
+from unittest.mock import Mock
+from src.lib.data_types import DataType
+from src.server.micro_batch import MicroBatchCoalescer
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def batch(samples, value=0.5):
+    return {
+        DataType.INPUTS: np.zeros((samples, 2)),
+        DataType.PROBS: np.full((samples, 2), value, dtype=np.float32),
+        DataType.LABELS: np.arange(samples).reshape(samples, 1),
+    }
+
+
+def test_batches_are_processed_together_once_the_target_is_reached():
+    process = Mock()
+    coalescer = MicroBatchCoalescer(process, target_samples=8, clock=Clock())
+
+    coalescer.add(0, batch(3, 0.1))
+    coalescer.add(1, batch(3, 0.2))
+    process.assert_not_called()
+    assert coalescer.pending == [0, 1]
+
+    coalescer.add(2, batch(3, 0.3))
+    (batch_indices, merged), _ = process.call_args
+    assert batch_indices == [0, 1, 2]
+    assert merged[DataType.PROBS].shape == (9, 2)
+    assert merged[DataType.PROBS][3, 0] == np.float32(0.2)
+    assert merged[DataType.LABELS].tolist() == [0, 1, 2] * 3
+    assert DataType.INPUTS not in merged
+    assert coalescer.pending == []
+
+
+def test_pending_batches_are_processed_after_the_max_delay():
+    process = Mock()
+    clock = Clock()
+    coalescer = MicroBatchCoalescer(process, target_samples=100, max_delay_seconds=1.0, clock=clock)
+
+    coalescer.add(5, batch(2))
+    clock.now = 0.5
+    coalescer.flush_if_due()
+    process.assert_not_called()
+
+    clock.now = 1.0
+    coalescer.flush_if_due()
+    assert process.call_args[0][0] == [5]
+
+    coalescer.flush()
+    assert process.call_count == 1
+
+
+def test_without_a_target_every_batch_is_processed_alone():
+    process = Mock()
+    coalescer = MicroBatchCoalescer(process)
+    entry = batch(4)
+    coalescer.add(7, entry)
+    (batch_indices, merged), _ = process.call_args
+    assert batch_indices == [7]
+    assert merged[DataType.PROBS] is entry[DataType.PROBS]
+
+
+def test_failed_micro_batch_stays_pending():
+    process = Mock(side_effect=[RuntimeError("database down"), None])
+    coalescer = MicroBatchCoalescer(process, target_samples=2)
+    try:
+        coalescer.add(0, batch(2))
+    except RuntimeError:
+        pass
+    assert coalescer.pending == [0]
+    coalescer.flush()
+    assert coalescer.pending == []
+
+
+def test_a_timer_processes_the_micro_batch_when_no_message_arrives():
+    process = Mock()
+    clock = Clock()
+    timers = []
+    coalescer = MicroBatchCoalescer(
+        process, target_samples=100, max_delay_seconds=2.0, clock=clock,
+        call_later=lambda delay, func: timers.append((delay, func)),
+    )
+
+    coalescer.add(0, batch(2))
+    coalescer.add(1, batch(2))
+    assert [delay for delay, _ in timers] == [2.0]
+
+    clock.now = 2.0
+    timers[0][1]()
+    assert process.call_args[0][0] == [0, 1]
+
+    # A failing flush leaves the batches for the next message or the EOF
+    process.side_effect = RuntimeError("database down")
+    coalescer.add(2, batch(2))
+    clock.now = 4.0
+    timers[1][1]()
+    assert coalescer.pending == [2]
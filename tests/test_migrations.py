@@ -0,0 +1,53 @@
+import pytest
+from sqlalchemy import create_engine, event, inspect, select, text
+from src.database.db import Database
+from src.database.migrations import MIGRATIONS, Migration, migrate, schema_migrations
+
+
+def create_table(name):
+    def apply(connection, today, partition_days):
+        connection.execute(text(f"CREATE TABLE {name} (id INTEGER PRIMARY KEY)"))
+    return apply
+
+
+def applied_versions(engine):
+    with engine.connect() as connection:
+        return connection.execute(select(schema_migrations.c.version)).scalars().all()
+
+
+def test_pending_migrations_run_once_in_version_order():
+    engine = create_engine("sqlite://")
+    migrations = [Migration(2, "second", create_table("b")), Migration(1, "first", create_table("a"))]
+
+    assert migrate(engine, migrations=migrations) == [1, 2]
+    assert migrate(engine, migrations=migrations) == []
+    assert migrate(engine, migrations=migrations + [Migration(3, "third", create_table("c"))]) == [3]
+    assert applied_versions(engine) == [1, 2, 3]
+    assert {"a", "b", "c"} <= set(inspect(engine).get_table_names())
+
+
+def test_failed_migration_is_not_recorded():
+    engine = create_engine("sqlite://")
+
+    def fail(connection, today, partition_days):
+        connection.execute(text("SELECT * FROM missing_table"))
+
+    with pytest.raises(Exception):
+        migrate(engine, migrations=[Migration(1, "first", create_table("a")), Migration(2, "broken", fail)])
+    assert applied_versions(engine) == [1]
+
+
+def test_database_issues_no_statements_on_construction():
+    engine = create_engine("sqlite://")
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+
+    Database(engine, slow_query_seconds=60)
+
+    assert statements == []
+    assert inspect(engine).get_table_names() == []
+
+
+def test_migration_versions_are_unique():
+    versions = [migration.version for migration in MIGRATIONS]
+    assert versions == sorted(set(versions))
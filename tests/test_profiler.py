@@ -0,0 +1,131 @@
+import json
+import os
+import pstats
+import threading
+import time
+from unittest.mock import Mock
+import pytest
+from src.lib.profiler import SamplingProfiler, write_profile_request
+from src.server.client_manager import ClientManager
+from src.server.listener import Listener
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(i * i for i in range(1000))
+
+
+@pytest.fixture
+def busy_thread():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stop,), daemon=True)
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+
+def run_profiler(thread, path, output_format):
+    profiler = SamplingProfiler(thread.ident, str(path), duration_seconds=0.2, interval_seconds=0.002, output_format=output_format)
+    profiler.start()
+    profiler.join()
+    return profiler
+
+
+def test_collapsed_and_pstats_output(busy_thread, tmp_path):
+    run_profiler(busy_thread, tmp_path / "session.collapsed", "collapsed")
+    lines = (tmp_path / "session.collapsed").read_text().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("busy_loop (test_profiler.py" in line for line in lines)
+
+    profiler = run_profiler(busy_thread, tmp_path / "session.prof", "pstats")
+    stats = pstats.Stats(str(tmp_path / "session.prof"))
+    busy = next(key for key in stats.stats if key[2] == "busy_loop")
+    cc, nc, tt, ct, callers = stats.stats[busy]
+    assert nc == sum(profiler.samples.values())
+    assert ct == pytest.approx(nc * 0.002)
+
+
+def test_client_manager_profiles_its_session_thread_on_signal(busy_thread, tmp_path):
+    server_config = Mock(
+        client_timeout_seconds=30, profile_dir=str(tmp_path), profile_default_seconds=30,
+        profile_max_seconds=0.1, profile_interval_seconds=0.002, profile_format="collapsed",
+    )
+    cm = ClientManager(
+        user_id="client1", session_id="session1", middleware=Mock(), clients_to_remove_queue=None,
+        config=Mock(server_config=server_config), report_builder=Mock(), utrace_calculator_factory=Mock(),
+    )
+    assert not cm.start_profiling()  # the session has not started yet
+    cm._session_thread_id = busy_thread.ident
+
+    cm._start_profile_requests()
+
+    write_profile_request(str(tmp_path), os.getpid(), duration_seconds=60, output_format="pstats")
+    with cm._profiler_lock:
+        # A signal arriving while the session thread holds the lock must not wait for it
+        cm._handle_profile_signal(None, None)
+    deadline = time.monotonic() + 5
+    while cm._profiler is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not cm.start_profiling()  # one profile at a time
+    cm._profiler.join()
+
+    assert not os.path.exists(tmp_path / ".requests" / f"{os.getpid()}.json")
+    assert cm._profiler.duration_seconds == 0.1  # capped at profile_max_seconds
+    [output] = [name for name in os.listdir(tmp_path) if name.endswith(".prof")]
+    assert output.startswith("session1-")
+
+
+def test_listener_routes_profile_requests_to_the_session():
+    listener = Listener(
+        middleware=Mock(), channel=Mock(), config=Mock(), cm_middleware_factory=Mock(),
+        report_builder_factory=Mock(), utrace_calculator_factory=Mock(),
+    )
+    target, other = Mock(session_id="session-a"), Mock(session_id="session-b")
+    listener._add_client("user-a", target, Mock(), 1)
+    listener._add_client("user-b", other, Mock(), 2)
+    ch = Mock()
+
+    body = json.dumps({"action": "profile", "session_id": "session-a", "duration_seconds": 5, "format": "pstats"})
+    listener._handle_control_message(ch, Mock(delivery_tag=7), None, body.encode())
+    listener._handle_control_message(ch, Mock(delivery_tag=8), None, b"not json")
+
+    target.request_profile.assert_called_once_with(5, "pstats")
+    other.request_profile.assert_not_called()
+    assert ch.basic_ack.call_count == 2
+
+
+@pytest.mark.parametrize("body", [
+    b"[1, 2]",
+    b'{"action": "profile", "session_id": "session-a", "duration_seconds": "abc"}',
+    b'{"action": "profile", "session_id": "session-a", "duration_seconds": -1}',
+    b'{"action": "profile", "session_id": "session-a", "format": "svg"}',
+])
+def test_listener_drops_invalid_profile_requests_without_raising(body):
+    listener = Listener(
+        middleware=Mock(), channel=Mock(), config=Mock(), cm_middleware_factory=Mock(),
+        report_builder_factory=Mock(), utrace_calculator_factory=Mock(),
+    )
+    target = Mock(session_id="session-a")
+    listener._add_client("user-a", target, Mock(), 1)
+    ch = Mock()
+
+    listener._handle_control_message(ch, Mock(delivery_tag=7), None, body)
+
+    target.request_profile.assert_not_called()
+    ch.basic_ack.assert_called_once_with(delivery_tag=7)
+
+
+def test_listener_survives_a_failing_profile_request():
+    listener = Listener(
+        middleware=Mock(), channel=Mock(), config=Mock(), cm_middleware_factory=Mock(),
+        report_builder_factory=Mock(), utrace_calculator_factory=Mock(),
+    )
+    target = Mock(session_id="session-a")
+    target.request_profile.side_effect = OSError("no such process")
+    listener._add_client("user-a", target, Mock(), 1)
+    body = json.dumps({"action": "profile", "session_id": "session-a", "duration_seconds": 5})
+
+    listener._handle_control_message(Mock(), Mock(delivery_tag=7), None, body.encode())
+
+    target.request_profile.assert_called_once_with(5, None)
@@ -0,0 +1,63 @@
+import logging
+import uuid
+import pytest
+from sqlalchemy import create_engine, text
+import src.lib.metrics as metrics
+from src.database.db import Database
+from src.database.query_timing import db_method, instrument_engine, parameter_sizes
+from src.lib.metrics import DB_QUERY_SECONDS, DB_SLOW_QUERIES_TOTAL, get_registry
+from src.models.input_blobs import InputBlobs
+from src.models.inputs import ModelInputs
+from src.models.stored_sessions import StoredSessions
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", None)
+
+
+def query_counts():
+    samples = get_registry().snapshot().get(DB_QUERY_SECONDS.name, {"samples": {}})["samples"]
+    return {key[0]: value["count"] for key, value in samples.items()}
+
+
+def test_statements_are_grouped_by_database_method(caplog):
+    engine = create_engine("sqlite://")
+    # The scores table needs PostgreSQL; model_inputs works on SQLite
+    db = Database(engine, slow_query_seconds=60, dedup_inputs=False)
+    InputBlobs.__table__.create(engine, checkfirst=True)
+    ModelInputs.__table__.create(engine, checkfirst=True)
+    StoredSessions.__table__.create(engine, checkfirst=True)
+    session_id = uuid.uuid4()
+
+    db.write_inputs(session_id, b"x" * 1000, 0)
+    db.write_inputs(session_id, b"y" * 10, 0)
+    assert list(db.iter_inputs_from_session(session_id)) == [b"y" * 10]
+
+    counts = query_counts()
+    # One upsert per write; the first also registers the session and checks it has no deduplicated rows
+    assert counts["write_inputs"] == 4
+    assert counts["iter_inputs_from_session"] == 1
+    assert not any("slow_query" in record.message for record in caplog.records)
+
+
+def test_slow_statements_are_logged_with_parameter_sizes(caplog):
+    engine = create_engine("sqlite://")
+    instrument_engine(engine, slow_query_seconds=0)
+    with caplog.at_level(logging.WARNING, logger="slow-queries"), db_method("write_outputs"):
+        with engine.connect() as connection:
+            connection.execute(text("select :a, :b"), {"a": b"z" * 2048, "b": "abc"})
+
+    [record] = [r for r in caplog.records if "slow_query" in r.message]
+    assert "method: write_outputs" in record.message
+    assert "params_bytes: 2051" in record.message
+    assert "largest_param: a (2048 bytes)" in record.message
+    assert "zzzz" not in record.message
+    assert get_registry().snapshot()[DB_SLOW_QUERIES_TOTAL.name]["samples"] == {("write_outputs",): 1}
+    # Installing again only updates the threshold
+    assert instrument_engine(engine, slow_query_seconds=1).slow_query_seconds == 1
+
+
+def test_parameter_sizes_of_executemany():
+    sizes = parameter_sizes([{"inputs": b"12345", "batch_index": 1}, {"inputs": b"1", "batch_index": 2}], executemany=True)
+    assert sizes == {"rows": 2, "total_bytes": 22, "largest": "batch_index", "largest_bytes": 8}
@@ -0,0 +1,125 @@
+import datetime
+import uuid
+from unittest.mock import Mock
+import pytest
+from sqlalchemy import create_engine, func, select
+import src.lib.metrics as metrics
+from src.database.db import Database
+from src.database.partitions import Partition, parse_bounds, partition_name, partition_range
+from src.database.retention import RetentionJob
+from src.models.input_blobs import InputBlobs
+from src.models.inputs import ModelInputs
+from src.models.outputs import ModelOutputs
+from src.models.stored_sessions import StoredSessions
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, **delta):
+        self.now += datetime.timedelta(**delta)
+
+
+@pytest.fixture
+def clock():
+    return Clock(datetime.datetime(2026, 3, 1, 12, 0))
+
+
+@pytest.fixture
+def db(monkeypatch, clock):
+    monkeypatch.setattr(metrics, "_registry", None)
+    engine = create_engine("sqlite://")
+    # The scores table needs PostgreSQL; the batch tables work on SQLite
+    database = Database(engine, slow_query_seconds=60, clock=clock, dedup_inputs=True)
+    for model in (InputBlobs, ModelInputs, ModelOutputs, StoredSessions):
+        model.__table__.create(engine, checkfirst=True)
+    return database
+
+
+def write_session(db, session_id, batches=2, body=b"shared inputs"):
+    for batch_index in range(batches):
+        db.write_inputs(session_id, body, batch_index)
+        db.write_outputs(session_id, b"outputs %d" % batch_index, batch_index)
+
+
+def count(db, model):
+    with db.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(model)).scalar()
+
+
+def test_rows_keep_the_partition_day_of_the_sessions_first_write(db, clock):
+    session_id = uuid.uuid4()
+    db.write_inputs(session_id, b"before midnight", 0)
+    clock.advance(hours=13)
+    db.write_outputs(session_id, b"after midnight", 0)
+    # A later run of the session reads its day back from stored_sessions
+    restarted = Database(db.engine, slow_query_seconds=60, clock=clock)
+    restarted.write_inputs(session_id, b"after restart", 1)
+
+    with db.engine.connect() as connection:
+        days = set(connection.execute(select(ModelInputs.partition_day)).scalars())
+        days |= set(connection.execute(select(ModelOutputs.partition_day)).scalars())
+    assert days == {datetime.date(2026, 3, 1)}
+
+
+def test_purge_removes_only_expired_sessions(db, clock):
+    finished_long_ago, finished_recently, running, abandoned = (uuid.uuid4() for _ in range(4))
+    write_session(db, abandoned, body=b"abandoned inputs")
+    clock.advance(days=5)
+    for session_id in (finished_long_ago, finished_recently, running):
+        write_session(db, session_id)
+    db.mark_session_finished(finished_long_ago, "COMPLETED")
+    clock.advance(days=3)
+    db.mark_session_finished(finished_recently, "TIMEOUT")
+
+    assert db.purge_expired(retention_days=2, abandoned_days=7) == 2
+
+    for session_id in (finished_long_ago, abandoned):
+        assert list(db.iter_inputs_from_session(session_id)) == []
+        assert list(db.iter_outputs_from_session(session_id)) == []
+    for session_id in (finished_recently, running):
+        assert list(db.iter_inputs_from_session(session_id)) == [b"shared inputs"] * 2
+        assert len(list(db.iter_outputs_from_session(session_id))) == 2
+    # The shared blob lost the purged session's references; the abandoned session's own blob is gone
+    with db.engine.connect() as connection:
+        assert connection.execute(select(InputBlobs.refcount)).scalars().all() == [4]
+    assert count(db, StoredSessions) == 2
+
+
+def test_purge_without_abandoned_days_keeps_unfinished_sessions(db, clock):
+    write_session(db, uuid.uuid4())
+    clock.advance(days=365)
+    assert db.purge_expired(retention_days=1) == 0
+    assert count(db, ModelInputs) == 2
+
+
+def test_partition_ranges_and_bounds():
+    assert partition_range(datetime.date(2026, 3, 1), 1) == (datetime.date(2026, 3, 1), datetime.date(2026, 3, 2))
+    lower, upper = partition_range(datetime.date(2026, 3, 1), 7)
+    assert lower <= datetime.date(2026, 3, 1) < upper and (upper - lower).days == 7
+    assert partition_range(upper, 7)[0] == upper
+    assert partition_name("model_inputs", lower) == f"model_inputs_p{lower:%Y%m%d}"
+
+    assert parse_bounds("FOR VALUES FROM ('2026-03-01') TO ('2026-03-02')") == (
+        datetime.date(2026, 3, 1), datetime.date(2026, 3, 2)
+    )
+    assert parse_bounds("FOR VALUES FROM (MINVALUE) TO ('2026-03-01')") == (None, datetime.date(2026, 3, 1))
+    assert parse_bounds("DEFAULT") is None
+    assert Partition("model_inputs_legacy", None, None).sibling("model_outputs", "model_inputs") == "model_outputs_legacy"
+
+
+def test_retention_job_creates_partitions_and_purges():
+    database = Mock(purge_expired=Mock(return_value=3))
+    job = RetentionJob(database, retention_days=30, abandoned_days=7)
+    assert job.run_once() == 3
+    database.ensure_partitions.assert_called_once_with()
+    database.purge_expired.assert_called_once_with(30, 7)
+
+    database.reset_mock()
+    assert RetentionJob(database, retention_days=0).run_once() == 0
+    database.ensure_partitions.assert_called_once_with()
+    database.purge_expired.assert_not_called()
@@ -0,0 +1,17 @@
+from benchmarks.db_retention import main
+
+
+def test_retention_keeps_stored_rows_flat(tmp_path):
+    output = tmp_path / "retention.json"
+    results = main([
+        "--days", "5", "--sessions", "2", "--batches", "2", "--body-bytes", "64",
+        "--retention-days", "1", "--output", str(output),
+    ])
+
+    kept = [day["stored_rows"] for day in results["keep"]]
+    purged = [day["stored_rows"] for day in results["retention"]]
+    # 2 sessions x 2 batches x (inputs + outputs) per day
+    assert kept == [0, 8, 16, 24, 32]
+    assert purged == [0, 8, 8, 8, 8]
+    assert results["retention"][-1]["write_batch_ms"]["p50"] > 0
+    assert output.exists()
@@ -0,0 +1,65 @@
+import threading
+import time
+from unittest.mock import Mock
+import pytest
+from src.lib.timeout_scheduler import InactivityTimer, TimeoutScheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = TimeoutScheduler()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_timer_fires_after_timeout(scheduler):
+    callback = Mock()
+    scheduler.schedule(InactivityTimer(0.1, callback))
+
+    time.sleep(0.3)
+    callback.assert_called_once()
+    assert len(scheduler) == 0
+
+
+def test_touch_postpones_timeout(scheduler):
+    callback = Mock()
+    timer = InactivityTimer(0.2, callback)
+    scheduler.schedule(timer)
+
+    for _ in range(4):
+        time.sleep(0.1)
+        timer.touch()
+    callback.assert_not_called()
+
+    time.sleep(0.35)
+    callback.assert_called_once()
+
+
+def test_cancelled_timer_does_not_fire(scheduler):
+    callback = Mock()
+    timer = InactivityTimer(0.1, callback)
+    scheduler.schedule(timer)
+    timer.cancel()
+
+    time.sleep(0.3)
+    callback.assert_not_called()
+
+
+def test_many_timers_share_one_thread(scheduler):
+    fired = []
+    threads_before = threading.active_count()
+    for i in range(200):
+        scheduler.schedule(InactivityTimer(0.05 + i * 0.001, lambda i=i: fired.append(i)))
+
+    assert threading.active_count() == threads_before + 1
+    time.sleep(0.6)
+    assert fired == list(range(200))
+
+
+def test_failing_callback_does_not_stop_scheduler(scheduler):
+    callback = Mock()
+    scheduler.schedule(InactivityTimer(0.05, Mock(side_effect=Exception("boom"))))
+    scheduler.schedule(InactivityTimer(0.1, callback))
+
+    time.sleep(0.3)
+    callback.assert_called_once()
@@ -0,0 +1,93 @@
+import json
+from unittest.mock import Mock
+import numpy as np
+from proto import calibration_pb2, dataset_service_pb2
+from src.lib.calibration_stages import CalibrationStage
+from src.lib.inputs_format_parser import parse_inputs_format
+from src.lib.tracing import FileSpanExporter, Tracer, to_otlp
+from src.server.batch_handler import BatchHandler
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+def build_handler(tracer):
+    uq = Mock(stage=CalibrationStage.INITIAL_CALIBRATION)
+    return BatchHandler(
+        user_id="client1", session_id="session1", on_eof=Mock(), middleware=Mock(), database=Mock(),
+        utrace_calculator=uq, inputs_format=parse_inputs_format("(2,)"), tracer=tracer,
+    )
+
+
+def send_batch(handler, batch_index):
+    inputs = dataset_service_pb2.DataBatchLabeled(
+        data=np.zeros((3, 2), dtype=np.float32).tobytes(), labels=[0, 1, 0], batch_index=batch_index
+    )
+    handler._handle_inputs_message(Mock(), inputs.SerializeToString())
+    predictions = calibration_pb2.Predictions(batch_index=batch_index)
+    for _ in range(3):
+        predictions.pred.add().values.extend([0.7, 0.3])
+    handler._handle_predictions_message(Mock(), predictions.SerializeToString())
+
+
+def test_batch_spans_share_a_trace_and_nest_stage_spans():
+    exporter = ListExporter()
+    tracer = Tracer(exporter, sample_rate=1.0)
+    send_batch(build_handler(tracer), batch_index=4)
+    tracer.flush()
+
+    spans = {span["name"]: span for span in exporter.spans}
+    assert set(spans) == {
+        "batch.inputs", "parse", "process_input_data", "db.write_inputs",
+        "batch.predictions", "db.write_outputs", "process_entry", "send_mlflow_msg",
+    }
+    assert {span["trace_id"] for span in exporter.spans} == {Tracer.trace_id_for("session1", 4)}
+    assert spans["process_input_data"]["parent_span_id"] == spans["batch.inputs"]["span_id"]
+    assert spans["process_entry"]["parent_span_id"] == spans["batch.predictions"]["span_id"]
+    assert spans["process_entry"]["attributes"] == {
+        "session_id": "session1", "batch_index": 4, "stage": "INITIAL_CALIBRATION"
+    }
+
+
+def test_sampling_is_decided_per_batch():
+    exporter = ListExporter()
+    tracer = Tracer(exporter, sample_rate=0.5)
+    handler = build_handler(tracer)
+    for batch_index in range(20):
+        send_batch(handler, batch_index)
+    tracer.flush()
+
+    traced = {span["attributes"]["batch_index"] for span in exporter.spans}
+    assert traced == {i for i in range(20) if tracer.is_sampled(Tracer.trace_id_for("session1", i))}
+    assert 0 < len(traced) < 20
+    # Every traced batch has both of its message spans
+    assert sum(span["name"].startswith("batch.") for span in exporter.spans) == 2 * len(traced)
+
+    disabled = Tracer(ListExporter(), sample_rate=0.0)
+    assert disabled.batch_span("batch.inputs", "session1", 0).__class__.__name__ == "_NoopSpan"
+
+
+def test_file_and_otlp_formats(tmp_path):
+    tracer = Tracer(FileSpanExporter(str(tmp_path / "spans.jsonl")), sample_rate=1.0)
+    try:
+        with tracer.batch_span("batch.inputs", "session1", 1):
+            with tracer.span("db.write_inputs"):
+                raise RuntimeError("db down")
+    except RuntimeError:
+        pass
+    tracer.flush()
+
+    spans = [json.loads(line) for line in (tmp_path / "spans.jsonl").read_text().splitlines()]
+    assert [(span["name"], span["status"]) for span in spans] == [("db.write_inputs", "error"), ("batch.inputs", "error")]
+
+    payload = to_otlp(spans, "calibration-service")
+    otlp_spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert otlp_spans[0]["parentSpanId"] == otlp_spans[1]["spanId"]
+    assert "parentSpanId" not in otlp_spans[1]
+    assert otlp_spans[0]["status"] == {"code": 2, "message": "db down"}
+    assert {"key": "batch_index", "value": {"intValue": "1"}} in otlp_spans[1]["attributes"]
@@ -0,0 +1,44 @@
+import copy
+import json
+from benchmarks.utrace_kernels import compare, main, run_suite
+
+
+def test_suite_covers_every_kernel():
+    results = run_suite(N_values=[50], Ns_values=[8], K_values=[3], repeat=1, min_time=0)
+
+    kernels = {result["kernel"] for result in results["results"].values()}
+    assert kernels == {
+        "calibrate", "calibrate_batched", "get_uncertainty_opt", "build_prediction_sets",
+        "lac", "aps", "lac_cal", "aps_cal", "get_coverage",
+    }
+    assert results["results"]["get_uncertainty_opt[N=50,Ns=8,K=3]"]["params"] == {"N": 50, "Ns": 8, "K": 3}
+    assert all(result["median_s"] > 0 for result in results["results"].values())
+
+
+def test_compare_flags_slowdowns_beyond_threshold():
+    baseline = {"results": {"a": {"median_s": 1.0}, "b": {"median_s": 1.0}, "c": {"median_s": 1.0}}}
+    current = copy.deepcopy(baseline)
+    current["results"]["a"]["median_s"] = 1.5
+    current["results"]["b"]["median_s"] = 0.5
+    current["results"]["c"]["median_s"] = 1.1
+    current["results"]["new"] = {"median_s": 1.0}
+
+    comparison = compare(current, baseline, threshold=0.2)
+
+    assert [entry["case"] for entry in comparison["regressions"]] == ["a"]
+    assert [entry["case"] for entry in comparison["improvements"]] == ["b"]
+    assert [entry["case"] for entry in comparison["unchanged"]] == ["c"]
+    assert comparison["missing_from_baseline"] == ["new"]
+
+
+def test_cli_saves_baseline_and_fails_on_regression(tmp_path):
+    baseline_path = tmp_path / "baseline.json"
+    args = ["--N", "50", "--Ns", "8", "--K", "3", "--kernels", "lac,get_coverage", "--repeat", "1", "--min-time", "0"]
+
+    assert main(args + ["--save", str(baseline_path)]) == 0
+
+    baseline = json.loads(baseline_path.read_text())
+    for result in baseline["results"].values():
+        result["median_s"] /= 1000  # pretend the baseline was much faster
+    baseline_path.write_text(json.dumps(baseline))
+    assert main(args + ["--compare", str(baseline_path)]) == 1
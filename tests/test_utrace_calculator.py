@@ -3,9 +3,12 @@ import numpy as np
 from unittest.mock import MagicMock, call, ANY
 
 # Ajusta estos imports según la ruta real de tu proyecto
-from src.server.utrace_calculator import UtraceCalculator
+from src.server.utrace_calculator import UtraceCalculator, pack_class_scores, unpack_class_scores
 from src.lib.calibration_stages import CalibrationStage
+from src.lib.config import stage_sample_limits
 from src.lib.data_types import DataType
+from tests.mocks.in_memory_database import InMemoryDatabase
+from utrace.uncertaintyQuantifier import UncertaintyQuantifier
 
 CALIB_LIMIT_MOCK = 2
 UNCERTAINTY_LIMIT_MOCK = 4 
@@ -149,4 +152,95 @@ def test_accuracy_math(calculator):
 def test_get_calibration_results_fails_wrong_stage(calculator):
     """Verifica que lance error si no está en estado FINISHED."""
     with pytest.raises(ValueError, match="Calibration results can only be retrieved"):
-        calculator.get_calibration_results()
\ No newline at end of file
+        calculator.get_calibration_results()
+
+def test_processed_batches_are_recorded_with_the_state(calculator, sample_entry, mock_db):
+    calculator.process_entry(sample_entry, batch_indices=[3, 4])
+
+    updates = mock_db.update_session_state.call_args[0][1]
+    assert updates['push_processed_batches'] == [3, 4]
+    assert calculator.is_processed(4)
+    assert not calculator.is_processed(5)
+
+def test_sessions_stored_without_processed_batches_count_every_batch_as_processed(mock_db, mock_uq):
+    mock_db.get_latest_scores_record.return_value = MagicMock(
+        batchs_counter=2, stage=CalibrationStage.INITIAL_CALIBRATION.value, scores=None, alpha=None,
+        confidences=None, processed_batches=None,
+    )
+    calculator = UtraceCalculator(database=mock_db, session_id="sess_123")
+    assert calculator.is_processed(0)
+
+def test_class_scores_round_trip_without_copies():
+    class_scores = [np.array([0.1, 0.4]), np.empty(0), np.array([0.2, 0.3, 0.9])]
+    blob = pack_class_scores(class_scores)
+    assert len(blob) == 4 * 8 + 5 * 8
+
+    restored = unpack_class_scores(blob, 3)
+    for original, array in zip(class_scores, restored):
+        np.testing.assert_array_equal(array, original)
+    assert all(not array.flags.writeable for array in restored)
+    with pytest.raises(ValueError):
+        unpack_class_scores(blob[:-8], 3)
+
+def test_uq_reset_restores_class_scores():
+    uq = UncertaintyQuantifier(classes=np.arange(2))
+    uq.reset(conformity_scores_=np.array([0.1, 0.5]), class_scores=[np.array([0.1]), np.array([0.5])])
+    uq.calibrate(np.array([[0.8, 0.2]]), np.array([0]), batched=True)
+    assert [scores.size for scores in uq.class_scores] == [2, 1]
+    assert uq.conformity_scores_.size == 3
+
+    uq.reset()
+    assert [scores.size for scores in uq.class_scores] == [0, 0]
+    with pytest.raises(ValueError):
+        uq.reset(class_scores=[np.empty(0)])
+
+def test_restart_during_calibration_keeps_every_calibrated_score(mocker):
+    mocker.patch('src.server.utrace_calculator.CALIBRATION_LIMIT', 10)
+    rng = np.random.default_rng(0)
+    batches = []
+    for _ in range(3):
+        probs = rng.dirichlet(np.ones(10), size=16)
+        batches.append({DataType.PROBS: probs, DataType.LABELS: rng.integers(0, 10, size=16)})
+
+    uninterrupted = UtraceCalculator(database=InMemoryDatabase(), session_id="sess_a")
+    for entry in batches:
+        uninterrupted.process_entry(entry)
+
+    db = InMemoryDatabase()
+    first_run = UtraceCalculator(database=db, session_id="sess_b")
+    for entry in batches[:2]:
+        first_run.process_entry(entry)
+    restarted = UtraceCalculator(database=db, session_id="sess_b")
+    restarted.process_entry(batches[2])
+
+    assert restarted.uq.conformity_scores_.size == 48
+    np.testing.assert_array_equal(restarted.uq.conformity_scores_, uninterrupted.uq.conformity_scores_)
+
+def test_stage_limits_can_count_samples(calculator, mocker):
+    mocker.patch('src.server.utrace_calculator.CALIBRATION_SAMPLES', 5)
+    mocker.patch('src.server.utrace_calculator.UNCERTAINTY_SAMPLES', 9)
+
+    def entry(samples):
+        return {DataType.PROBS: np.full((samples, 2), 0.5), DataType.LABELS: np.zeros(samples, dtype=int)}
+
+    # One entry of 2 samples and one of 4 calibrate; the stage ends with the sample that reaches 5
+    for samples in (2, 4):
+        assert calculator.stage == CalibrationStage.INITIAL_CALIBRATION
+        calculator.process_entry(entry(samples))
+    assert calculator.stage == CalibrationStage.UNCERTAINTY_ESTIMATION
+    assert calculator.samples_counter == 6
+
+    calculator.process_entry(entry(3))
+    assert calculator.stage == CalibrationStage.PREDICTION_SET_CONSTRUCTION
+    assert calculator.uq.calibrate.call_count == 2
+    assert calculator.uq.get_uncertainty_opt.call_count == 1
+    assert calculator._db.update_session_state.call_args[0][1]['samples_counter'] == 9
+
+def test_uncertainty_sample_limit_needs_the_calibration_one():
+    assert stage_sample_limits(0, 0) == (0, 0)
+    assert stage_sample_limits(50, 0) == (50, 100)
+    assert stage_sample_limits(50, 80) == (50, 80)
+    with pytest.raises(ValueError, match="requires CALIBRATION_SAMPLES"):
+        stage_sample_limits(0, 80)
+    with pytest.raises(ValueError, match="greater than CALIBRATION_SAMPLES"):
+        stage_sample_limits(50, 50)
@@ -0,0 +1,107 @@
+import os
+import uuid
+from unittest.mock import Mock
+import pytest
+from sqlalchemy import create_engine
+import src.lib.metrics as metrics
+from src.database.db import Database
+from src.database.wal import INPUTS, OUTPUTS, STATE, WalCheckpointer, WalDatabase, WalPosition, WriteAheadLog
+from src.models.input_blobs import InputBlobs
+from src.models.inputs import ModelInputs
+from src.models.outputs import ModelOutputs
+from src.models.stored_sessions import StoredSessions
+from src.server.client_manager import ClientManager
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", None)
+
+
+def test_torn_tail_is_truncated_on_open(tmp_path):
+    wal = WriteAheadLog(str(tmp_path))
+    for batch_index in range(3):
+        wal.append(INPUTS, batch_index, b"batch %d" % batch_index)
+    wal.sync()
+    end = wal.synced_position
+    wal.close()
+    with open(tmp_path / "000000000000.wal", "ab") as segment:
+        segment.write(b"\x40\x00\x00\x00partial")  # crash in the middle of a record
+
+    reopened = WriteAheadLog(str(tmp_path))
+    assert reopened.synced_position == end
+    records = list(reopened.records(WalPosition(0, 0), end))
+    assert [(kind, index, data) for _, kind, index, data in records] == [
+        (INPUTS, 0, b"batch 0"), (INPUTS, 1, b"batch 1"), (INPUTS, 2, b"batch 2")
+    ]
+
+
+def test_checkpoints_apply_durable_records_and_drop_old_segments(tmp_path):
+    engine = create_engine("sqlite://")
+    db = Database(engine, slow_query_seconds=60)
+    for model in (InputBlobs, ModelInputs, ModelOutputs, StoredSessions):
+        model.__table__.create(engine, checkfirst=True)
+    session_id = uuid.uuid4()
+    wal = WriteAheadLog(str(tmp_path), segment_bytes=64)
+    wal_db = WalDatabase(db, wal)
+    checkpointer = WalCheckpointer(wal, db, session_id)
+
+    for batch_index in range(4):
+        wal_db.write_inputs(session_id, b"inputs %d" % batch_index, batch_index)
+        wal_db.write_outputs(session_id, b"outputs %d" % batch_index, batch_index)
+    wal_db.write_inputs(session_id, b"not synced", 9)
+    # Only the segments closed by a roll were fsynced so far
+    durable = checkpointer.checkpoint()
+    assert 0 < durable < 9
+    wal.sync()
+
+    assert checkpointer.checkpoint() == 9 - durable
+    assert list(db.iter_inputs_from_session(session_id)) == [b"inputs %d" % i for i in range(4)] + [b"not synced"]
+    assert list(wal_db.iter_outputs_from_session(session_id)) == [b"outputs %d" % i for i in range(4)]
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".wal")]) == 1
+    assert not wal.pending
+
+    # A crash before the checkpoint file is written replays the records; the upserts make it a no-op
+    db.apply_checkpoint(session_id, [(0, b"inputs 0")], [(0, b"outputs 0")])
+    assert list(db.iter_inputs_from_session(session_id))[0] == b"inputs 0"
+
+
+def test_failed_checkpoint_keeps_the_records(tmp_path):
+    wal = WriteAheadLog(str(tmp_path))
+    database = Mock()
+    database.apply_checkpoint.side_effect = [RuntimeError("database down"), None]
+    checkpointer = WalCheckpointer(wal, database, "session1")
+    updates = [{"batchs_counter": 1, "stage": 0}, {"batchs_counter": 2, "stage": 0}]
+    for update in updates:
+        WalDatabase(database, wal).update_session_state("session1", update)
+    wal.sync()
+
+    with pytest.raises(RuntimeError):
+        checkpointer.checkpoint()
+    assert wal.pending
+    assert checkpointer.checkpoint() == 2
+    database.apply_checkpoint.assert_called_with("session1", {}.items(), {}.items(), updates)
+
+
+def test_client_manager_replays_the_wal_before_restoring(tmp_path):
+    wal = WriteAheadLog(str(tmp_path / "session1"))
+    wal.append(OUTPUTS, 0, b"probs")
+    wal.append(STATE, 1, {"batchs_counter": 1, "stage": 0})
+    wal.sync()
+    wal.close()
+
+    database_config = Mock(wal_dir=str(tmp_path), wal_segment_bytes=1024, wal_checkpoint_interval_seconds=60)
+    cm = ClientManager(
+        user_id="client1", session_id="session1", middleware=Mock(), clients_to_remove_queue=None,
+        config=Mock(database_config=database_config), report_builder=Mock(), utrace_calculator_factory=Mock(),
+    )
+    database = Mock()
+    wal_db = cm._open_wal(database)
+
+    database.apply_checkpoint.assert_called_once()
+    assert database.apply_checkpoint.call_args.args[3] == [{"batchs_counter": 1, "stage": 0}]
+    wal_db.write_inputs("session1", b"x", 1)
+    cm._wal.sync()
+    cm._close_wal()
+    assert database.apply_checkpoint.call_count == 2
+    assert not os.path.exists(tmp_path / "session1")
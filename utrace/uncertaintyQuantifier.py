@@ -2,7 +2,7 @@
 """
 
 import logging
-from typing import Literal, Union
+from typing import Literal, Optional, Union
 
 import numpy as np
 
@@ -38,16 +38,36 @@ class UncertaintyQuantifier:
         self.reset()
 
 
-    def reset(self, conformity_scores_:np.ndarray=np.empty(0)):
-        """Resets the scoores and alpha."""
+    def reset(self, conformity_scores_:np.ndarray=np.empty(0), class_scores:Optional[list[np.ndarray]]=None):
+        """Resets the scoores and alpha.
+
+        Parameters
+        ----------
+        conformity_scores_ : np.ndarray, optional
+            Sorted conformity scores to start from, by default empty
+        class_scores : Optional[list[np.ndarray]], optional
+            Sorted scores of each class, in the order of `classes`, that batched calibration
+            extends; by default empty
+        """
         self.conformity_scores_ = conformity_scores_
         self.__q_hat:np.float64 = np.float64('nan')
         self.__alpha:np.float64 = np.float64('nan')
-        self._class_scores:list[np.ndarray] = [np.empty(0) for _ in self.classes] if self.classes is not None else []
+        if class_scores is not None:
+            if self.classes is None or len(class_scores) != len(self.classes):
+                raise ValueError("'class_scores' must hold one array per class.")
+            self._class_scores:list[np.ndarray] = list(class_scores)
+        else:
+            self._class_scores = [np.empty(0) for _ in self.classes] if self.classes is not None else []
 
         logger.debug("UQ reset.")
 
 
+    @property
+    def class_scores(self) -> list[np.ndarray]:
+        """The sorted conformity scores of each class, in the order of `classes`."""
+        return self._class_scores
+
+
     @property
     def alpha(self) -> np.float64:
         """The alpha value used for the conformal prediction stage."""